@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Benchmark of the AAT engines on the synthetic phantom of benchmark_quantification_modes.py: the all PLD QASL fit
+    ('qasl', or the native kinetic model fit with --backend native) and the signal-weighted delay ('weighted_delay').
+    Reports runtime, and the bias (median error) and median absolute error of the AAT in the brain mask, against the
+    true AAT and against the QASL AAT.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark_quantification_modes import ANALYSIS_PARAMETERS, make_phantom, simulate_asl, summarize
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_weighted_delay import asl_weighted_delay_aat, weighted_delay_lookup_table
+
+def run_benchmark(outputdir, plds, tau, slicetime, nrepeats, noise, aCBV, inference_method, backend, seed):
+    rng = np.random.default_rng(seed)
+    truth, mask = make_phantom(rng)
+    truth['aCBV'] *= aCBV  # arterial signal on (1) or off (0), biases the weighted delay towards early PLDs
+    affine = np.diag([3.0, 3.0, 6.0, 1.0])
+    TR_M0, alpha, M0a = 4.0, 0.85, 1000.0
+    M0 = M0a * ANALYSIS_PARAMETERS['lambda'] * (1 - np.exp(-TR_M0 / ANALYSIS_PARAMETERS['T1t'])) * mask
+    PLDall = simulate_asl(truth, mask, plds, tau, slicetime / 1000, nrepeats, M0a, alpha, noise, rng)
+
+    paths = {key: os.path.join(outputdir, f'phantom_{key}.nii.gz') for key in ['M0', 'mask', 'PLDall']}
+    nib.save(nib.Nifti1Image(M0.astype(np.float32), affine), paths['M0'])
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), affine), paths['mask'])
+    nib.save(nib.Nifti1Image(PLDall.astype(np.float32), affine), paths['PLDall'])
+
+    context_data = {
+        'ASL scan': 'multi-delay Look-Locker', 'alpha': alpha, 'TR_M0': TR_M0, 'slicetime': slicetime,
+        'PLDS': list(plds), 'NPLDS': len(plds), 'tau': tau, 'PLDall_controllabel': PLDall, 'gridmask_path': paths['mask'],
+    }
+    subject = {'ASL scan': 'multi-delay Look-Locker', 'phantom': context_data, **ANALYSIS_PARAMETERS}
+    results = {}
+
+    # all PLD fit
+    start_time = time.time()
+    output_map = os.path.join(outputdir, f'QASL_allPLD_forAAT_{backend}')
+    asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, paths['PLDall'], paths['M0'], paths['mask'], output_map,
+                      plds, tau, inference_method, backend=backend)
+    results[f'qasl ({backend})'] = {'runtime_s': time.time() - start_time,
+                                    'AAT': nib.load(os.path.join(output_map, 'output', 'native', 'arrival.nii.gz')).get_fdata()}
+
+    # signal-weighted delay, the lookup tables are built in the first call (cold) and reused after (warm)
+    weighted_delay_lookup_table.cache_clear()
+    for label in ('weighted_delay (cold)', 'weighted_delay (warm)'):
+        start_time = time.time()
+        asl_weighted_delay_aat(subject, 'phantom', os.path.join(outputdir, 'weighted_delay'))
+        results[label] = {'runtime_s': time.time() - start_time, 'AAT': nib.load(context_data['QASL_AAT_path']).get_fdata()}
+
+    reference = results[f'qasl ({backend})']['AAT']
+    print("\n=== AAT engines: bias (median error) / median absolute error (s) in the brain mask ===")
+    print(f"{'engine':<24} | {'runtime (s)':>11} | {'vs true AAT':>15} | {'vs QASL AAT':>15}")
+    for engine, result in results.items():
+        bias, mae = summarize(result['AAT'], truth['AAT'], mask)
+        bias_ref, mae_ref = summarize(result['AAT'], reference, mask)
+        print(f"{engine:<24} | {result['runtime_s']:11.2f} | {f'{bias:+.3f} / {mae:.3f}':>15} | {f'{bias_ref:+.3f} / {mae_ref:.3f}':>15}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark runtime and accuracy of the AAT engines (QASL fit, signal-weighted delay) on a synthetic phantom",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_aat_engines.py
+    python benchmark_aat_engines.py --backend native --acbv 0
+    """
+    )
+    parser.add_argument("--plds", type=float, nargs='+', default=[0.2, 0.5, 0.8, 1.1, 1.4, 1.7, 2.0, 2.3], help="Post labeling delays (s)")
+    parser.add_argument("--tau", type=float, default=2.0, help="Label duration (s)")
+    parser.add_argument("--slicetime", type=float, default=35.0, help="Slice timing of the 2D readout (ms)")
+    parser.add_argument("--nrepeats", type=int, default=4, help="Number of control/label repeats per PLD")
+    parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise standard deviation per volume (M0a = 1000)")
+    parser.add_argument("--acbv", type=float, default=1.0, help="Scale of the phantom arterial blood volume (0: no arterial signal)")
+    parser.add_argument("--inference-method", type=str, default='ssvb', help="QASL inference method ('ssvb' or 'vaby')")
+    parser.add_argument("--backend", type=str, default='cli', help="Backend of the all PLD fit ('inprocess', 'cli' or 'native')")
+    parser.add_argument("--outputdir", type=str, default=None, help="Working folder for the phantom and outputs, default: temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the phantom and noise")
+    args = parser.parse_args()
+
+    outputdir = args.outputdir or tempfile.mkdtemp(prefix='clinicalasl_aat_benchmark_')
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Phantom and outputs in {outputdir}")
+    run_benchmark(outputdir, args.plds, args.tau, args.slicetime, args.nrepeats, args.noise, args.acbv,
+                  args.inference_method, args.backend, args.seed)
+
+if __name__ == "__main__":
+    main()
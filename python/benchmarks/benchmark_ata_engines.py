@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Validation of the direct ATA engine against the QASL ATA fit (PLDs 1-2, arterial component off) on the synthetic
+    phantom of benchmark_quantification_modes.py. Reports runtime, and the bias (median difference), median absolute
+    difference and correlation of the direct ATA with the QASL ATA in the brain mask, and both against the phantom
+    reference ATA (apparent perfusion of the true signal at PLDs 1-2). The direct ATA is computed with the AAT and CBF
+    maps of the all PLD fit (as in the pipeline, fit not included in its runtime) and with the single compartment model.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark_quantification_modes import ANALYSIS_PARAMETERS, make_phantom, simulate_asl, summarize
+from clinical_asl_pipeline.asl_kinetic_model import apparent_perfusion
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_direct_ata import asl_direct_ata
+from clinical_asl_pipeline.utils.pld_subsets import PLD_SUBSETS, write_pld_subsets, remove_pld_subsets
+
+def run_benchmark(outputdir, plds, tau, slicetime, nrepeats, noise, inference_method, backend, seed):
+    rng = np.random.default_rng(seed)
+    truth, mask = make_phantom(rng)
+    affine = np.diag([3.0, 3.0, 6.0, 1.0])
+    TR_M0, alpha, M0a = 4.0, 0.85, 1000.0
+    T1t, T1b, partition_coefficient = ANALYSIS_PARAMETERS['T1t'], ANALYSIS_PARAMETERS['T1b'], ANALYSIS_PARAMETERS['lambda']
+    M0 = M0a * partition_coefficient * (1 - np.exp(-TR_M0 / T1t)) * mask
+    slicedt = slicetime / 1000
+    PLDall = simulate_asl(truth, mask, plds, tau, slicedt, nrepeats, M0a, alpha, noise, rng)
+
+    first_pld, last_pld = PLD_SUBSETS['PLD1to2']
+    plds_ata = np.asarray(plds[first_pld:last_pld])[None, None, None, :] + (np.arange(mask.shape[2]) * slicedt)[None, None, :, None]
+    reference_ATA = apparent_perfusion(plds_ata, truth['CBF'], truth['AAT'], truth['aCBV'], truth['arrival_art'], tau, T1t, T1b, partition_coefficient)
+
+    paths = {key: os.path.join(outputdir, f'phantom_{key}.nii.gz') for key in ['M0', 'mask', 'PLDall']}
+    nib.save(nib.Nifti1Image(M0.astype(np.float32), affine), paths['M0'])
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), affine), paths['mask'])
+    nib.save(nib.Nifti1Image(PLDall.astype(np.float32), affine), paths['PLDall'])
+
+    context_data = {
+        'ASL scan': 'multi-delay Look-Locker', 'alpha': alpha, 'TR_M0': TR_M0, 'slicetime': slicetime,
+        'PLDS': list(plds), 'NPLDS': len(plds), 'tau': tau, 'PLDall_controllabel': PLDall, 'gridNIFTI_path': paths['M0'],
+        'gridM0_path': paths['M0'], 'gridmask_path': paths['mask'],
+        'PLD2tolast_controllabel_path': os.path.join(outputdir, 'phantom_2tolastPLD.nii.gz'),
+        'PLD1to2_controllabel_path': os.path.join(outputdir, 'phantom_1to2PLD.nii.gz'),
+    }
+    subject = {'ASL scan': 'multi-delay Look-Locker', 'phantom': context_data, **ANALYSIS_PARAMETERS}
+    results = {}
+
+    # QASL fit of PLDs 1-2 without arterial component
+    start_time = time.time()
+    write_pld_subsets(context_data)
+    output_map = os.path.join(outputdir, f'QASL_1to2PLD_forATA_{backend}')
+    asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, context_data['PLD1to2_controllabel_path'], paths['M0'], paths['mask'],
+                      output_map, plds[first_pld:last_pld], tau, inference_method, 'artoff', backend=backend)
+    remove_pld_subsets(context_data)
+    results[f'qasl ({backend})'] = {'runtime_s': time.time() - start_time,
+                                    'ATA': nib.load(os.path.join(output_map, 'output', 'native', 'calib_voxelwise', 'perfusion.nii.gz')).get_fdata()}
+
+    # all PLD fit for the AAT and CBF maps of the direct ATA
+    allPLD_map = os.path.join(outputdir, f'QASL_allPLD_forAAT_{backend}')
+    asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, paths['PLDall'], paths['M0'], paths['mask'], allPLD_map,
+                      plds, tau, inference_method, backend=backend)
+    native_allPLD = os.path.join(allPLD_map, 'output', 'native')
+
+    # direct ATA, with the all PLD AAT and CBF maps, and with the single compartment model
+    for label, location_aat, location_cbf in (
+        ('direct', os.path.join(native_allPLD, 'arrival.nii.gz'), os.path.join(native_allPLD, 'calib_voxelwise', 'perfusion.nii.gz')),
+        ('direct (no AAT)', None, None),
+    ):
+        start_time = time.time()
+        asl_direct_ata(subject, 'phantom', os.path.join(outputdir, 'direct_ATA'), location_aat=location_aat, location_cbf=location_cbf)
+        results[label] = {'runtime_s': time.time() - start_time, 'ATA': nib.load(context_data['QASL_ATA_path']).get_fdata()}
+
+    qasl_ATA = results[f'qasl ({backend})']['ATA']
+    print("\n=== ATA engines: bias (median difference) / median absolute difference (ml/100g/min) in the brain mask ===")
+    print(f"{'engine':<18} | {'runtime (s)':>11} | {'vs reference ATA':>17} | {'vs QASL ATA':>15} | {'r (QASL)':>8}")
+    for engine, result in results.items():
+        bias, mae = summarize(result['ATA'], reference_ATA, mask)
+        bias_qasl, mae_qasl = summarize(result['ATA'], qasl_ATA, mask)
+        r = np.corrcoef(result['ATA'][mask], qasl_ATA[mask])[0, 1]
+        print(f"{engine:<18} | {result['runtime_s']:11.2f} | {f'{bias:+.2f} / {mae:.2f}':>17} | {f'{bias_qasl:+.2f} / {mae_qasl:.2f}':>15} | {r:8.3f}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Validate the direct ATA engine against the QASL ATA fit on a synthetic phantom",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_ata_engines.py
+    python benchmark_ata_engines.py --backend cli --noise 5
+    """
+    )
+    parser.add_argument("--plds", type=float, nargs='+', default=[0.2, 0.5, 0.8, 1.1, 1.4, 1.7, 2.0, 2.3], help="Post labeling delays (s)")
+    parser.add_argument("--tau", type=float, default=2.0, help="Label duration (s)")
+    parser.add_argument("--slicetime", type=float, default=35.0, help="Slice timing of the 2D readout (ms)")
+    parser.add_argument("--nrepeats", type=int, default=4, help="Number of control/label repeats per PLD")
+    parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise standard deviation per volume (M0a = 1000)")
+    parser.add_argument("--inference-method", type=str, default='ssvb', help="QASL inference method ('ssvb' or 'vaby')")
+    parser.add_argument("--backend", type=str, default='cli', help="Backend of the ATA fit ('inprocess', 'cli' or 'native')")
+    parser.add_argument("--outputdir", type=str, default=None, help="Working folder for the phantom and outputs, default: temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the phantom and noise")
+    args = parser.parse_args()
+
+    outputdir = args.outputdir or tempfile.mkdtemp(prefix='clinicalasl_ata_benchmark_')
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Phantom and outputs in {outputdir}")
+    run_benchmark(outputdir, args.plds, args.tau, args.slicetime, args.nrepeats, args.noise, args.inference_method, args.backend, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Comparison of the cohort quantification (asl_cohort_quantification: one fit of the pseudo-volume of all exams, the
+    repeats averaged per PLD) with per-exam quantification (one fit per exam of all repeats), on synthetic phantom exams
+    of benchmark_quantification_modes.py with different numbers of repeats (as after outlier removal).
+    Reports per exam the median absolute difference of the all PLD fit (CBF and AAT) between cohort and per-exam
+    quantification, and the median absolute error of both against the truth, with the runtimes.
+    The native backend fits the mean over repeats in both cases (differences are numerical only); with QASL ('cli' or
+    'inprocess', inference 'vaby') the noise model sees the averaged repeats in the cohort fit, all repeats per exam.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark_quantification_modes import ANALYSIS_PARAMETERS, make_phantom, simulate_asl, summarize
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_m0_calibration import asl_m0_calibration, QASL_PERFUSION_CALIB
+from clinical_asl_pipeline.asl_cohort_quantification import CohortLayout, asl_release_dense_arrays, item_output_map, run_batch_fit
+
+def make_exam(outputdir, index, plds, tau, slicetime, nrepeats, noise, rng):
+    # Phantom exam with its own parameter maps and number of repeats, as a preprocessed subject with one context 'phantom'
+    truth, mask = make_phantom(rng)
+    affine = np.diag([3.0, 3.0, 6.0, 1.0])
+    TR_M0, alpha, M0a = 4.0, 0.85, 1000.0
+    M0 = M0a * ANALYSIS_PARAMETERS['lambda'] * (1 - np.exp(-TR_M0 / ANALYSIS_PARAMETERS['T1t'])) * mask
+    PLDall = simulate_asl(truth, mask, plds, tau, slicetime / 1000, nrepeats, M0a, alpha, noise, rng)
+
+    examdir = os.path.join(outputdir, f'exam{index}')
+    os.makedirs(examdir, exist_ok=True)
+    paths = {key: os.path.join(examdir, f'phantom_{key}.nii.gz') for key in ['M0', 'mask', 'PLDall']}
+    nib.save(nib.Nifti1Image(M0.astype(np.float32), affine), paths['M0'])
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), affine), paths['mask'])
+    nib.save(nib.Nifti1Image(PLDall.astype(np.float32), affine), paths['PLDall'])
+
+    context_data = {
+        'ASL scan': 'multi-delay Look-Locker', 'alpha': alpha, 'TR_M0': TR_M0, 'slicetime': slicetime,
+        'PLDS': list(plds), 'NPLDS': len(plds), 'tau': tau, 'PLDall_controllabel': PLDall,
+        'PLDall_controllabel_path': paths['PLDall'], 'gridM0_path': paths['M0'], 'gridmask_path': paths['mask'],
+    }
+    subject = {'ASLdir': examdir, 'DICOMinputdir': examdir, 'ASL scan': 'multi-delay Look-Locker', 'ASL_CONTEXT': ['phantom'],
+               'phantom': context_data, **ANALYSIS_PARAMETERS}
+    asl_m0_calibration(subject, context_tag='phantom')
+    return subject, truth, mask
+
+def run_benchmark(outputdir, nexams, plds, tau, slicetime, noise, inference_method, backend, seed):
+    rng = np.random.default_rng(seed)
+    parameters = {**ANALYSIS_PARAMETERS, 'inference_method': inference_method, 'qasl_backend': backend}
+    exams = [make_exam(outputdir, index, plds, tau, slicetime, int(rng.integers(2, 6)), noise, rng) for index in range(nexams)]
+
+    # per exam: all repeats, one fit per exam
+    start_time = time.time()
+    per_exam = []
+    for subject, _, _ in exams:
+        context_data = subject['phantom']
+        output_map = os.path.join(subject['ASLdir'], 'per_exam_QASL_allPLD')
+        asl_qasl_analysis(context_data, parameters, context_data['PLDall_controllabel_path'], context_data['gridM0_path'],
+                          context_data['gridmask_path'], output_map, plds, tau, inference_method, backend=backend,
+                          location_calib=context_data['calibM0_path'])
+        per_exam.append(output_map)
+    runtime_per_exam = time.time() - start_time
+
+    # cohort: brain voxels only (as in the cohort run), one fit of the pseudo-volume, repeats averaged per PLD
+    start_time = time.time()
+    items = [(asl_release_dense_arrays(subject), 'phantom') for subject, _, _ in exams]
+    masks = [mask for _, _, mask in exams]
+    run_batch_fit(items, CohortLayout(masks), masks, parameters, os.path.join(outputdir, 'batch'), 'AAT')
+    runtime_cohort = time.time() - start_time
+
+    print(f"\n=== Cohort vs per-exam quantification, all PLD fit ({backend}, {inference_method}) ===")
+    print(f"runtime per exam {runtime_per_exam:.1f} s, cohort {runtime_cohort:.1f} s")
+    print(f"{'exam':<6} | {'repeats':>7} | {'CBF cohort vs per exam':>22} | {'AAT cohort vs per exam':>22} | {'CBF MAE cohort / per exam':>25} | {'AAT MAE cohort / per exam':>25}")
+    for index, ((subject, truth, mask), per_exam_map) in enumerate(zip(exams, per_exam)):
+        cohort_map = item_output_map(subject, 'phantom', 'AAT')
+        results = {}
+        for name, folder in (('cohort', cohort_map), ('per_exam', per_exam_map)):
+            results[name] = {'CBF': nib.load(os.path.join(folder, QASL_PERFUSION_CALIB)).get_fdata(),
+                             'AAT': nib.load(os.path.join(folder, 'output', 'native', 'arrival.nii.gz')).get_fdata()}
+        nrepeats = subject['phantom']['PLDall_controllabel_voxels'].values.shape[1] // (2 * len(plds))
+        row = [f"{index:<6}", f"{nrepeats:>7}"]
+        for key in ('CBF', 'AAT'):
+            row.append(f"{summarize(results['cohort'][key], results['per_exam'][key], mask)[1]:>22.4f}")
+        for key in ('CBF', 'AAT'):
+            mae = [summarize(results[name][key], truth[key], mask)[1] for name in ('cohort', 'per_exam')]
+            row.append(f"{f'{mae[0]:.3f} / {mae[1]:.3f}':>25}")
+        print(" | ".join(row))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare cohort (pseudo-volume) and per-exam quantification on synthetic phantom exams",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_cohort_quantification.py --backend native
+    python benchmark_cohort_quantification.py --backend cli --inference-method vaby --nexams 6
+    """
+    )
+    parser.add_argument("--nexams", type=int, default=4, help="Number of phantom exams")
+    parser.add_argument("--plds", type=float, nargs='+', default=[0.2, 0.5, 0.8, 1.1, 1.4, 1.7, 2.0, 2.3], help="Post labeling delays (s)")
+    parser.add_argument("--tau", type=float, default=2.0, help="Label duration (s)")
+    parser.add_argument("--slicetime", type=float, default=35.0, help="Slice timing of the 2D readout (ms)")
+    parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise standard deviation per volume (M0a = 1000)")
+    parser.add_argument("--inference-method", type=str, default='vaby', help="QASL inference method, voxelwise for the cohort ('vaby')")
+    parser.add_argument("--backend", type=str, default='cli', help="Backend of the fits ('inprocess', 'cli' or 'native')")
+    parser.add_argument("--outputdir", type=str, default=None, help="Working folder for the phantoms and fit outputs, default: temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the phantoms and noise")
+    args = parser.parse_args()
+
+    outputdir = args.outputdir or tempfile.mkdtemp(prefix='clinicalasl_cohort_benchmark_')
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Phantoms and fit outputs in {outputdir}")
+    run_benchmark(outputdir, args.nexams, args.plds, args.tau, args.slicetime, args.noise, args.inference_method, args.backend, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Numeric comparison of the two M0 calibrations on the synthetic phantom of benchmark_quantification_modes.py:
+    the voxelwise calibration by QASL (m0_calibration 'qasl': -c M0 --calib-aslreg, output/native/calib_voxelwise) and the
+    precomputed calibration of asl_m0_calibration applied to the uncalibrated perfusion of the same fit ('native').
+    Reports the bias (median difference) and median absolute relative difference of the calibrated CBF of 'native'
+    against QASL, and of both against the true CBF. Run this on the target data before using 'native' as the default.
+    Requires QASL (in-process or the qasl command line tool).
+
+License: BSD 3-Clause License
+"""
+
+import os
+import argparse
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark_quantification_modes import ANALYSIS_PARAMETERS, make_phantom, simulate_asl, summarize
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_m0_calibration import asl_m0_calibration, QASL_PERFUSION_CALIB
+
+def run_benchmark(outputdir, plds, tau, slicetime, nrepeats, noise, inference_method, backend, seed):
+    rng = np.random.default_rng(seed)
+    truth, mask = make_phantom(rng)
+    affine = np.diag([3.0, 3.0, 6.0, 1.0])
+    TR_M0, alpha, M0a = 4.0, 0.85, 1000.0
+    M0 = M0a * ANALYSIS_PARAMETERS['lambda'] * (1 - np.exp(-TR_M0 / ANALYSIS_PARAMETERS['T1t'])) * mask
+    PLDall = simulate_asl(truth, mask, plds[1:], tau, slicetime / 1000, nrepeats, M0a, alpha, noise, rng)
+
+    paths = {key: os.path.join(outputdir, f'phantom_{key}.nii.gz') for key in ['M0', 'mask', 'PLDall']}
+    nib.save(nib.Nifti1Image(M0.astype(np.float32), affine), paths['M0'])
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), affine), paths['mask'])
+    nib.save(nib.Nifti1Image(PLDall.astype(np.float32), affine), paths['PLDall'])
+
+    context_data = {'ASL scan': 'multi-delay Look-Locker', 'alpha': alpha, 'TR_M0': TR_M0, 'slicetime': slicetime,
+                    'gridM0_path': paths['M0'], 'gridmask_path': paths['mask']}
+    subject = {'ASLdir': outputdir, 'phantom': context_data, **ANALYSIS_PARAMETERS}
+
+    # the CBF fit (PLDs 2 to last) calibrated by QASL, and with the precomputed calibration M0
+    CBF = {}
+    for calibration in ('qasl', 'native'):
+        location_calib = None
+        if calibration == 'native':
+            asl_m0_calibration(subject, context_tag='phantom')
+            location_calib = context_data['calibM0_path']
+        output_map = os.path.join(outputdir, f'QASL_2tolastPLD_forCBF_{calibration}')
+        asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, paths['PLDall'], paths['M0'], paths['mask'], output_map,
+                          plds[1:], tau, inference_method, backend=backend, location_calib=location_calib)
+        CBF[calibration] = nib.load(os.path.join(output_map, QASL_PERFUSION_CALIB)).get_fdata()
+
+    inside = mask & (CBF['qasl'] > 0)
+    relative = np.abs(CBF['native'][inside] - CBF['qasl'][inside]) / CBF['qasl'][inside]
+    bias, mae = summarize(CBF['native'], CBF['qasl'], mask)
+    print("\n=== M0 calibration: calibrated CBF (ml/100g/min), bias (median difference) / median absolute difference ===")
+    print(f"native vs QASL: {bias:+.3f} / {mae:.3f}, "
+          f"median relative difference {100 * np.median(relative):.2f} %, max {100 * relative.max():.2f} %")
+    for calibration in ('qasl', 'native'):
+        bias, mae = summarize(CBF[calibration], truth['CBF'], mask)
+        print(f"{calibration:<6} vs truth: {bias:+.3f} / {mae:.3f}")
+    return CBF
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the precomputed (native) and QASL voxelwise M0 calibration of the CBF fit on a synthetic phantom",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_m0_calibration.py
+    python benchmark_m0_calibration.py --inference-method vaby --noise 5
+    """
+    )
+    parser.add_argument("--plds", type=float, nargs='+', default=[0.2, 0.5, 0.8, 1.1, 1.4, 1.7, 2.0, 2.3], help="Post labeling delays (s)")
+    parser.add_argument("--tau", type=float, default=2.0, help="Label duration (s)")
+    parser.add_argument("--slicetime", type=float, default=35.0, help="Slice timing of the 2D readout (ms)")
+    parser.add_argument("--nrepeats", type=int, default=4, help="Number of control/label repeats per PLD")
+    parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise standard deviation per volume (M0a = 1000)")
+    parser.add_argument("--inference-method", type=str, default='ssvb', help="QASL inference method ('ssvb' or 'vaby')")
+    parser.add_argument("--backend", type=str, default='cli', help="QASL backend ('inprocess' or 'cli')")
+    parser.add_argument("--outputdir", type=str, default=None, help="Working folder for the phantom and QASL outputs, default: temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the phantom and noise")
+    args = parser.parse_args()
+
+    outputdir = args.outputdir or tempfile.mkdtemp(prefix='clinicalasl_calibration_benchmark_')
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Phantom and QASL outputs in {outputdir}")
+    run_benchmark(outputdir, args.plds, args.tau, args.slicetime, args.nrepeats, args.noise, args.inference_method, args.backend, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Benchmark of the QASL quantification modes, 'three_fit' (all PLDs for AAT, 2-to-last PLDs for CBF,
+    PLDs 1-2 without arterial component for ATA) and 'joint' (one fit of all PLDs with arterial component, ATA derived
+    with the kinetic model), on a synthetic phantom with known CBF, AAT, aCBV and arterial arrival.
+    Reports runtime and the bias (median error) and spread (median absolute error) of CBF, AAT and ATA in the brain mask.
+    The ATA reference is the apparent perfusion of the true tissue plus arterial signal at PLDs 1-2.
+    Requires QASL (in-process or the qasl command line tool).
+
+License: BSD 3-Clause License
+"""
+
+import os
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clinical_asl_pipeline.asl_kinetic_model import tissue_signal, arterial_signal, apparent_perfusion
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_joint_quantification import asl_joint_quantification_paths, asl_joint_ata
+from clinical_asl_pipeline.utils.pld_subsets import PLD_SUBSETS, write_pld_subsets, remove_pld_subsets
+
+ANALYSIS_PARAMETERS = {'T1t': 1.3, 'T1b': 1.65, 'readout': '2D', 'lambda': 0.9}
+
+def make_phantom(rng, shape=(32, 32, 8)):
+    # Smooth random parameter maps in an ellipsoid brain mask: CBF (ml/100g/min), AAT (s), aCBV (fraction), arterial arrival (s)
+    x, y, z = np.meshgrid(*(np.arange(n) for n in shape), indexing='ij')
+    mask = ((x - shape[0] / 2) ** 2 / (0.4 * shape[0]) ** 2 + (y - shape[1] / 2) ** 2 / (0.45 * shape[1]) ** 2
+            + (z - shape[2] / 2) ** 2 / (0.6 * shape[2]) ** 2) < 1
+
+    def smooth_map(low, high):
+        field = gaussian_filter(rng.random(shape), 2)
+        field = (field - field.min()) / (field.max() - field.min())
+        return low + (high - low) * field
+
+    truth = {
+        'CBF': smooth_map(20, 80),
+        'AAT': smooth_map(0.6, 1.8),
+        'aCBV': smooth_map(0.0, 0.015),
+    }
+    truth['arrival_art'] = np.clip(truth['AAT'] - 0.3, 0.1, None)
+    return truth, mask
+
+def simulate_asl(truth, mask, plds, tau, slicedt, nrepeats, M0a, alpha, noise, rng):
+    # PLD ordered control/label series (x, y, z, PLD x repeat x pair), pairs in the order of QASL --iaf=tc (tag first)
+    shape = mask.shape
+    plds_slice = np.asarray(plds)[None, None, None, :] + (np.arange(shape[2]) * slicedt)[None, None, :, None]
+    deltaM = tissue_signal(plds_slice, truth['CBF'][..., None], truth['AAT'][..., None], tau,
+                           ANALYSIS_PARAMETERS['T1t'], ANALYSIS_PARAMETERS['T1b'], ANALYSIS_PARAMETERS['lambda'])
+    deltaM = deltaM + arterial_signal(plds_slice, truth['aCBV'][..., None], truth['arrival_art'][..., None], tau, ANALYSIS_PARAMETERS['T1b'])
+    deltaM = 2 * alpha * M0a * deltaM * mask[..., None]
+
+    control = M0a * mask  # static tissue signal of the (background suppressed) ASL images
+    volumes = []
+    for pld in range(len(plds)):
+        for _ in range(nrepeats):
+            volumes.append(control - deltaM[..., pld] + rng.normal(0, noise, shape))
+            volumes.append(control + rng.normal(0, noise, shape))
+    return np.stack(volumes, axis=3)
+
+def summarize(estimate, reference, mask):
+    error = (estimate - reference)[mask]
+    return float(np.median(error)), float(np.median(np.abs(error)))
+
+def run_benchmark(outputdir, plds, tau, slicetime, nrepeats, noise, inference_method, backend, seed):
+    rng = np.random.default_rng(seed)
+    truth, mask = make_phantom(rng)
+    affine = np.diag([3.0, 3.0, 6.0, 1.0])
+    TR_M0, alpha = 4.0, 0.85
+    T1t, T1b, partition_coefficient = ANALYSIS_PARAMETERS['T1t'], ANALYSIS_PARAMETERS['T1b'], ANALYSIS_PARAMETERS['lambda']
+
+    # M0 such that the voxelwise calibration gives M0a = 1000 in the brain
+    M0a = 1000.0
+    M0 = M0a * partition_coefficient * (1 - np.exp(-TR_M0 / T1t)) * mask
+    slicedt = slicetime / 1000
+    PLDall = simulate_asl(truth, mask, plds, tau, slicedt, nrepeats, M0a, alpha, noise, rng)
+
+    # ATA reference: apparent perfusion of the true signal at PLDs 1-2, per slice
+    first_pld, last_pld = PLD_SUBSETS['PLD1to2']
+    plds_ata = np.asarray(plds[first_pld:last_pld])[None, None, None, :] + (np.arange(mask.shape[2]) * slicedt)[None, None, :, None]
+    truth['ATA'] = apparent_perfusion(plds_ata, truth['CBF'], truth['AAT'], truth['aCBV'], truth['arrival_art'], tau, T1t, T1b, partition_coefficient)
+
+    paths = {key: os.path.join(outputdir, f'phantom_{key}.nii.gz') for key in ['M0', 'mask', 'PLDall']}
+    nib.save(nib.Nifti1Image(M0.astype(np.float32), affine), paths['M0'])
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), affine), paths['mask'])
+    nib.save(nib.Nifti1Image(PLDall.astype(np.float32), affine), paths['PLDall'])
+
+    context_data = {
+        'ASL scan': 'multi-delay Look-Locker', 'alpha': alpha, 'TR_M0': TR_M0, 'slicetime': slicetime,
+        'PLDS': list(plds), 'NPLDS': len(plds), 'tau': tau, 'PLDall_controllabel': PLDall, 'gridNIFTI_path': paths['M0'],
+        'PLDall_controllabel_path': paths['PLDall'],
+        'PLD2tolast_controllabel_path': os.path.join(outputdir, 'phantom_2tolastPLD.nii.gz'),
+        'PLD1to2_controllabel_path': os.path.join(outputdir, 'phantom_1to2PLD.nii.gz'),
+    }
+    subject = {'ASLdir': outputdir, 'phantom': context_data, **ANALYSIS_PARAMETERS}
+
+    def qasl(input_path, output_name, pld_list, artoff=None):
+        asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, input_path, paths['M0'], paths['mask'],
+                          os.path.join(outputdir, output_name), pld_list, tau, inference_method, artoff, backend=backend)
+        return os.path.join(outputdir, output_name, 'output', 'native')
+
+    results = {}
+
+    # three fits
+    start_time = time.time()
+    write_pld_subsets(context_data)
+    native_AAT = qasl(context_data['PLDall_controllabel_path'], 'QASL_allPLD_forAAT', plds)
+    native_CBF = qasl(context_data['PLD2tolast_controllabel_path'], 'QASL_2tolastPLD_forCBF', plds[1:])
+    native_ATA = qasl(context_data['PLD1to2_controllabel_path'], 'QASL_1to2PLD_forATA', plds[first_pld:last_pld], 'artoff')
+    remove_pld_subsets(context_data)
+    results['three_fit'] = {
+        'runtime_s': time.time() - start_time,
+        'CBF': nib.load(os.path.join(native_CBF, 'calib_voxelwise', 'perfusion.nii.gz')).get_fdata(),
+        'AAT': nib.load(os.path.join(native_AAT, 'arrival.nii.gz')).get_fdata(),
+        'ATA': nib.load(os.path.join(native_ATA, 'calib_voxelwise', 'perfusion.nii.gz')).get_fdata(),
+    }
+
+    # joint fit
+    start_time = time.time()
+    output_map = os.path.join(outputdir, 'QASL_allPLD_joint')
+    asl_joint_quantification_paths(subject, 'phantom', output_map)
+    qasl(context_data['PLDall_controllabel_path'], 'QASL_allPLD_joint', plds)
+    asl_joint_ata(subject, 'phantom')
+    results['joint'] = {
+        'runtime_s': time.time() - start_time,
+        'CBF': nib.load(context_data['QASL_CBF_path']).get_fdata(),
+        'AAT': nib.load(context_data['QASL_AAT_path']).get_fdata(),
+        'ATA': nib.load(context_data['QASL_ATA_path']).get_fdata(),
+    }
+
+    print("\n=== Quantification modes: bias (median error) / median absolute error in the brain mask ===")
+    print(f"{'mode':<10} | {'runtime (s)':>11} | {'CBF (ml/100g/min)':>19} | {'AAT (s)':>15} | {'ATA (ml/100g/min)':>19}")
+    for mode, result in results.items():
+        row = [f"{mode:<10}", f"{result['runtime_s']:11.1f}"]
+        for key, width in (('CBF', 19), ('AAT', 15), ('ATA', 19)):
+            bias, mae = summarize(result[key], truth[key], mask)
+            row.append(f"{f'{bias:+.2f} / {mae:.2f}':>{width}}")
+        print(" | ".join(row))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark bias and runtime of the three-fit and joint QASL quantification on a synthetic phantom",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_quantification_modes.py
+    python benchmark_quantification_modes.py --plds 0.2 0.5 0.8 1.1 1.4 1.7 2.0 --noise 5 --inference-method vaby
+    """
+    )
+    parser.add_argument("--plds", type=float, nargs='+', default=[0.2, 0.5, 0.8, 1.1, 1.4, 1.7, 2.0, 2.3], help="Post labeling delays (s)")
+    parser.add_argument("--tau", type=float, default=2.0, help="Label duration (s)")
+    parser.add_argument("--slicetime", type=float, default=35.0, help="Slice timing of the 2D readout (ms)")
+    parser.add_argument("--nrepeats", type=int, default=4, help="Number of control/label repeats per PLD")
+    parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise standard deviation per volume (M0a = 1000)")
+    parser.add_argument("--inference-method", type=str, default='ssvb', help="QASL inference method ('ssvb' or 'vaby')")
+    parser.add_argument("--backend", type=str, default='cli', help="QASL backend ('inprocess' or 'cli')")
+    parser.add_argument("--outputdir", type=str, default=None, help="Working folder for the phantom and QASL outputs, default: temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the phantom and noise")
+    args = parser.parse_args()
+
+    outputdir = args.outputdir or tempfile.mkdtemp(prefix='clinicalasl_quantification_benchmark_')
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Phantom and QASL outputs in {outputdir}")
+    run_benchmark(outputdir, args.plds, args.tau, args.slicetime, args.nrepeats, args.noise, args.inference_method, args.backend, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Benchmark of the M0 stimulus to baseline registration modes ('standard' and 'fast'), runtime and alignment error.
+    A baseline M0 (and brain mask) is moved with known random rigid transforms (rotation, translation, noise) to simulate
+    the stimulus M0. Each registration mode recovers the transform, the alignment error is the mean and max displacement (mm)
+    between the true and recovered transform over the brain mask voxels.
+    Without input files a synthetic head phantom is used.
+
+License: BSD 3-Clause License
+"""
+
+import argparse
+import sys
+import os
+import time
+import ants
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter
+# the clinical_asl_pipeline package is in the parent folder (python), run the benchmarks from any folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clinical_asl_pipeline.asl_registration_stimulus_to_baseline import register_m0, REGISTRATION_SETTINGS
+from clinical_asl_pipeline.utils.ants_image import numpy_to_ants
+
+def make_phantom(rng):
+    # Synthetic M0 like head phantom (ellipsoid with smooth texture) and its brain mask on a 3x3x5 mm grid
+    affine = np.diag([3.0, 3.0, 5.0, 1.0])
+    affine[:3, 3] = [-96.0, -96.0, -50.0]
+    x, y, z = np.meshgrid(np.arange(64), np.arange(64), np.arange(20), indexing='ij')
+    mask = ((x - 32) ** 2 / 24 ** 2 + (y - 30) ** 2 / 27 ** 2 + (z - 10) ** 2 / 8 ** 2) < 1
+    M0 = gaussian_filter(mask * 1000.0, 1) + gaussian_filter(rng.random(mask.shape) * 600, 2) * mask
+    return M0, mask.astype(np.float64), affine
+
+def random_rigid_transform(center, rng, max_rotation_deg, max_translation_mm):
+    # Random rigid (Euler3D) transform around center, rotation and translation uniformly within the given maxima
+    rotation = np.deg2rad(rng.uniform(-max_rotation_deg, max_rotation_deg, 3))
+    translation = rng.uniform(-max_translation_mm, max_translation_mm, 3)
+    transform = ants.create_ants_transform(transform_type='Euler3DTransform', dimension=3, center=tuple(center))
+    transform.set_parameters(np.concatenate([rotation, translation]))
+    return transform
+
+def displacement_error(true_transform, estimated_transform, points):
+    # Mean and max distance (mm) between the points mapped by the true and the estimated fixed to moving transform
+    distances = [np.linalg.norm(np.subtract(true_transform.apply_to_point(p), estimated_transform.apply_to_point(p))) for p in points]
+    return float(np.mean(distances)), float(np.max(distances))
+
+def run_benchmark(M0, mask, affine, ntrials, max_rotation_deg, max_translation_mm, noise, seed):
+    rng = np.random.default_rng(seed)
+    fixed = numpy_to_ants(M0, affine)
+    fixed_mask = numpy_to_ants(mask, affine)
+
+    # physical points of (a subsample of) the brain mask voxels, for the alignment error
+    voxels = np.argwhere(mask > 0)
+    voxels = voxels[rng.choice(len(voxels), size=min(2000, len(voxels)), replace=False)]
+    points = [ants.transform_index_to_physical_point(fixed, tuple(int(i) for i in v)) for v in voxels]
+
+    results = {mode: {'runtime_s': [], 'mean_error_mm': [], 'max_error_mm': []} for mode in REGISTRATION_SETTINGS}
+    for trial in range(ntrials):
+        # simulated stimulus M0: baseline M0 resampled with a known rigid transform plus noise
+        transform = random_rigid_transform(ants.get_center_of_mass(fixed), rng, max_rotation_deg, max_translation_mm)
+        moving = transform.apply_to_image(fixed, reference=fixed, interpolation='linear')
+        moving = moving + numpy_to_ants(rng.normal(0, noise * M0.max(), M0.shape), affine)
+        moving_mask = transform.apply_to_image(fixed_mask, reference=fixed_mask, interpolation='nearestneighbor')
+        # registration maps fixed points to moving points, i.e. the inverse of the resampling transform
+        true_transform = transform.invert()
+
+        for mode in REGISTRATION_SETTINGS:
+            start_time = time.time()
+            reg, _ = register_m0(fixed, moving, mode, fixed_mask=fixed_mask, moving_mask=moving_mask)
+            runtime = time.time() - start_time
+            estimated_transform = ants.read_transform(reg['fwdtransforms'][0])
+            mean_error, max_error = displacement_error(true_transform, estimated_transform, points)
+            results[mode]['runtime_s'].append(runtime)
+            results[mode]['mean_error_mm'].append(mean_error)
+            results[mode]['max_error_mm'].append(max_error)
+            print(f"trial {trial + 1}/{ntrials}  {mode:<9} runtime {runtime:6.2f} s  error mean {mean_error:5.2f} mm  max {max_error:5.2f} mm")
+
+    print("\n=== Summary (median over trials) ===")
+    print(f"{'mode':<9} | {'runtime (s)':>11} | {'mean error (mm)':>15} | {'max error (mm)':>14}")
+    for mode, result in results.items():
+        print(f"{mode:<9} | {np.median(result['runtime_s']):11.2f} | {np.median(result['mean_error_mm']):15.3f} | {np.median(result['max_error_mm']):14.3f}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark runtime and alignment error of the M0 stimulus to baseline registration modes",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python benchmark_registration_stimulus_to_baseline.py
+    python benchmark_registration_stimulus_to_baseline.py --m0 /working/ASL/baseline_M0.nii.gz --mask /working/ASL/baseline_M0_brain_mask.nii.gz
+    """
+    )
+    parser.add_argument("--m0", type=str, default=None, help="Baseline M0 NIfTI, default: synthetic phantom")
+    parser.add_argument("--mask", type=str, default=None, help="Brain mask NIfTI of the baseline M0 (required with --m0)")
+    parser.add_argument("--ntrials", type=int, default=5, help="Number of simulated rigid motions")
+    parser.add_argument("--max-rotation", type=float, default=3.0, help="Maximum rotation per axis (degrees)")
+    parser.add_argument("--max-translation", type=float, default=5.0, help="Maximum translation per axis (mm)")
+    parser.add_argument("--noise", type=float, default=0.01, help="Gaussian noise standard deviation as fraction of the M0 maximum")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the simulated motions")
+    args = parser.parse_args()
+
+    if args.m0:
+        if not args.mask:
+            parser.error("--mask is required with --m0")
+        img = nib.load(args.m0)
+        M0, affine = img.get_fdata(), img.affine
+        mask = (nib.load(args.mask).get_fdata() > 0).astype(np.float64)
+    else:
+        M0, mask, affine = make_phantom(np.random.default_rng(args.seed))
+
+    run_benchmark(M0, mask, affine, args.ntrials, args.max_rotation, args.max_translation, args.noise, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Cohort quantification: the brain voxels of the contexts of many subjects with the same protocol (ASL scan, PLDs, tau,
+    slice timing and number of slices) are packed into one pseudo-volume, quantified with one QASL run per fit, and the
+    outputs are scattered back into the {context}_QASL_* output folders of every subject. The startup and I/O costs of
+    QASL are paid once per batch instead of once per exam.
+    Voxelwise inference only ('vaby' or the native backend): the spatial prior of 'ssvb' would couple the voxels of
+    different subjects. The voxels of slice z of every subject are packed into slice z of the pseudo-volume, so the
+    slice timing of the 2D Look-Locker readout is unchanged. The repeats are averaged per PLD (the number of repeats
+    differs between exams after outlier removal), and the M0 calibration is applied per subject (own M0a and alpha).
+    Averaging the repeats changes the noise model of 'vaby' compared with per-exam fits of all repeats (identical for the
+    native backend, which fits the mean over repeats): benchmarks/benchmark_cohort_quantification.py compares both.
+    The preprocessed subjects wait in memory for the whole cohort with the brain voxels of their series only
+    (asl_release_dense_arrays), not the dense arrays.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import time
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
+from clinical_asl_pipeline.asl_m0_calibration import asl_m0_calibration, asl_apply_m0_calibration
+from clinical_asl_pipeline.asl_joint_quantification import asl_joint_quantification_paths, asl_joint_ata
+from clinical_asl_pipeline.asl_weighted_delay import asl_weighted_delay_aat
+from clinical_asl_pipeline.asl_direct_ata import asl_direct_ata
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
+from clinical_asl_pipeline.utils.pld_subsets import PLD_SUBSETS, pld_series_voxels
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# QASL fits: output folder name (prefixed with the context), PLD subset (None: all PLDs), arterial component off
+COHORT_FITS = {
+    'AAT': ('QASL_allPLD_forAAT', None, None),
+    'CBF': ('QASL_2tolastPLD_forCBF', 'PLD2tolast', None),
+    'ATA': ('QASL_1to2PLD_forATA', 'PLD1to2', 'artoff'),
+    'joint': ('QASL_allPLD_joint', None, None),
+}
+# Dense arrays of the preprocessing that are not needed after it (asl_release_dense_arrays)
+DENSE_KEYS = ('PLDall_controllabel', 'M0ASL_allPLD', 'ASL_controllabel_allPLD', 'M0_allPLD')
+
+def asl_cohort_quantification(subjects, ANALYSIS_PARAMETERS, batchdir):
+    # Quantification (step 10) of all contexts of the preprocessed subjects, in batches of the same protocol
+    # Parameters:
+    #   subjects: list of subject dictionaries, preprocessed (main_pipeline.asl_preprocess_subject)
+    #   ANALYSIS_PARAMETERS: processing parameters, 'inference_method', 'qasl_backend', 'quantification_mode', engines
+    #   batchdir: working folder for the pseudo-volumes and QASL outputs of the batches
+    # Returns:
+    #   subjects, with the QASL outputs of every context in its own output folders
+    inference_method = ANALYSIS_PARAMETERS['inference_method']
+    backend = ANALYSIS_PARAMETERS.get('qasl_backend', 'cli')
+    if backend != 'native' and inference_method != 'vaby':
+        raise ValueError(f"Cohort quantification needs voxelwise inference: inference_method 'vaby' or qasl_backend 'native' (got '{inference_method}')")
+
+    # the calibration is always precomputed per context (own M0a), the pseudo-volume fits are uncalibrated
+    items = []
+    for subject in subjects:
+        for context in subject['ASL_CONTEXT']:
+            asl_m0_calibration(subject, context_tag=context)
+            items.append((subject, context))
+
+    batches = {}
+    for subject, context in items:
+        batches.setdefault(protocol_key(subject, context), []).append((subject, context))
+    logging.info(f"Cohort quantification: {len(items)} contexts of {len(subjects)} subjects in {len(batches)} protocol batch(es)")
+
+    for index, batch_items in enumerate(batches.values()):
+        quantify_batch(batch_items, ANALYSIS_PARAMETERS, os.path.join(batchdir, f'batch{index}'))
+    return subjects
+
+def asl_release_dense_arrays(subject):
+    # Free the dense arrays of a preprocessed subject that waits in memory until the whole cohort is quantified: the PLD
+    # ordered series is kept as its brain voxels only ('PLDall_controllabel_voxels', float32, see pld_subsets.pld_series_voxels),
+    # the dense intermediates of the data preparation are dropped (M0, mask and the file paths stay for the later steps)
+    released = 0
+    for context in subject['ASL_CONTEXT']:
+        context_data = subject[context]
+        mask = nib.load(context_data['gridmask_path']).get_fdata() > 0
+        context_data['PLDall_controllabel_voxels'] = MaskedVoxels.from_dense(context_data['PLDall_controllabel'], mask)
+        for key in DENSE_KEYS:
+            data = context_data.pop(key, None)
+            released += getattr(data, 'nbytes', 0)
+    logging.info(f"Cohort: dense arrays of {subject['DICOMinputdir']} released ({released / 2 ** 20:.0f} MB), brain voxels kept")
+    return subject
+
+def protocol_key(subject, context):
+    # Protocol of a context: contexts with the same key can be fitted in one pseudo-volume
+    context_data = subject[context]
+    tau = tuple(np.round(np.atleast_1d(context_data['tau']), 6))
+    key = (subject['ASL scan'], tuple(np.round(context_data['PLDS'], 6)), tau)
+    if subject['ASL scan'] == 'multi-delay Look-Locker':
+        key += (round(float(context_data.get('slicetime') or 0), 4), nib.load(context_data['gridmask_path']).shape[2])
+    return key
+
+class CohortLayout:
+    # Positions of the brain voxels of every context in the pseudo-volume (ncols, 1, nslices): the voxels of slice z of all
+    # contexts are laid out along the first axis of slice z of the pseudo-volume
+    # Attributes:
+    #   flat_index, grid_shapes: per context the flat (C order) indices of the brain voxels and the shape of its grid
+    #   columns: list of (Nvox) column of every brain voxel in the pseudo-volume, per context
+    #   slices: list of (Nvox) slice of every brain voxel, per context
+    #   shape: (ncols, 1, nslices) of the pseudo-volume
+
+    def __init__(self, masks):
+        self.flat_index = [np.flatnonzero(mask) for mask in masks]
+        self.grid_shapes = [mask.shape for mask in masks]
+        self.slices = [np.unravel_index(flat, shape)[2] for flat, shape in zip(self.flat_index, self.grid_shapes)]
+        nslices = max(shape[2] for shape in self.grid_shapes)
+        filled = np.zeros(nslices, dtype=int)
+        self.columns = []
+        for slices in self.slices:
+            # column of a voxel: number of voxels of its slice already placed (this and previous contexts)
+            order = np.argsort(slices, kind='stable')
+            columns = np.empty(slices.size, dtype=int)
+            counts = np.bincount(slices, minlength=nslices)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            columns[order] = np.arange(slices.size) - np.repeat(starts, counts) + np.repeat(filled, counts)
+            filled += counts
+            self.columns.append(columns)
+        self.shape = (int(filled.max()), 1, nslices)
+
+    def pack(self, values):
+        # Pseudo-volume (ncols, 1, nslices, ...) from the list of (Nvox, ...) voxel values per context
+        extra = np.shape(values[0])[1:]
+        pseudo = np.zeros(self.shape + extra, dtype=np.float32)
+        for columns, slices, item_values in zip(self.columns, self.slices, values):
+            pseudo[columns, 0, slices] = item_values
+        return pseudo
+
+    def unpack(self, pseudo, index):
+        # Dense volume on the grid of context index from a pseudo-volume (ncols, 1, nslices, ...)
+        values = pseudo[self.columns[index], 0, self.slices[index]]
+        dense = np.zeros((int(np.prod(self.grid_shapes[index])),) + values.shape[1:], dtype=values.dtype)
+        dense[self.flat_index[index]] = values
+        return dense.reshape(self.grid_shapes[index] + values.shape[1:])
+
+def quantify_batch(items, ANALYSIS_PARAMETERS, batchdir):
+    # Quantification of the contexts of one protocol batch, same engines and modes as main_pipeline.asl_quantification
+    start_time = time.time()
+    os.makedirs(batchdir, exist_ok=True)
+    masks = [nib.load(subject[context]['gridmask_path']).get_fdata() > 0 for subject, context in items]
+    layout = CohortLayout(masks)
+    logging.info(f"Cohort batch {batchdir}: {len(items)} contexts, {sum(mask.sum() for mask in masks)} voxels, pseudo-volume {layout.shape}")
+
+    # the engines and modes of the first subject (same config for the cohort)
+    first_subject = items[0][0]
+    quantification_mode = first_subject.get('quantification_mode', 'three_fit')
+    if quantification_mode == 'joint':
+        logging.warning("quantification_mode 'joint' is not validated against 'three_fit' (see benchmarks/benchmark_quantification_modes.py)")
+        # the ATA map is derived from the arterial component (aCBV), which the native backend does not fit
+        if ANALYSIS_PARAMETERS.get('qasl_backend', 'cli') == 'native':
+            raise ValueError("quantification_mode 'joint' needs a QASL backend ('cli' or 'inprocess'), the 'native' backend fits no arterial component")
+        for subject, context in items:
+            asl_joint_quantification_paths(subject, context, item_output_map(subject, context, 'joint'))
+        run_batch_fit(items, layout, masks, ANALYSIS_PARAMETERS, batchdir, 'joint')
+        for subject, context in items:
+            asl_joint_ata(subject, context_tag=context)
+    elif quantification_mode == 'three_fit':
+        aat_engine = first_subject.get('aat_engine', 'qasl')
+        if aat_engine == 'weighted_delay':
+            for subject, context in items:
+                asl_weighted_delay_aat(subject, context, item_output_map(subject, context, 'AAT'))
+        elif aat_engine == 'qasl':
+            run_batch_fit(items, layout, masks, ANALYSIS_PARAMETERS, batchdir, 'AAT')
+        else:
+            raise ValueError(f"Unknown aat_engine: '{aat_engine}', use 'qasl' or 'weighted_delay'")
+        run_batch_fit(items, layout, masks, ANALYSIS_PARAMETERS, batchdir, 'CBF')
+        ata_engine = first_subject.get('ata_engine', 'qasl')
+        if ata_engine == 'direct':
+            for subject, context in items:
+                context_data = subject[context]
+                asl_direct_ata(subject, context, item_output_map(subject, context, 'ATA'), context_data['calibM0_path'],
+                               location_aat=context_data['QASL_AAT_path'], location_cbf=context_data['QASL_CBF_path'])
+        elif ata_engine == 'qasl':
+            run_batch_fit(items, layout, masks, ANALYSIS_PARAMETERS, batchdir, 'ATA')
+        else:
+            raise ValueError(f"Unknown ata_engine: '{ata_engine}', use 'qasl' or 'direct'")
+    else:
+        raise ValueError(f"Unknown quantification_mode: '{quantification_mode}', use 'three_fit' or 'joint'")
+
+    logging.info(f"Cohort batch {batchdir} quantified, this took: {round(time.time() - start_time, 2)} s")
+
+def item_output_map(subject, context, fit):
+    # QASL output folder of a fit in the folders of the subject, as main_pipeline.asl_quantification
+    return os.path.join(subject['ASLdir'], f'{context}_{COHORT_FITS[fit][0]}')
+
+def run_batch_fit(items, layout, masks, ANALYSIS_PARAMETERS, batchdir, fit):
+    # One QASL fit of the pseudo-volume of a batch, outputs scattered to the output folders of the contexts
+    name, subset, artoff = COHORT_FITS[fit]
+    first_subject, first_context = items[0]
+    first_data = first_subject[first_context]
+    NPLDS = first_data['NPLDS']
+    first_pld, last_pld = PLD_SUBSETS[subset] if subset is not None else (0, None)
+    last_pld = NPLDS if last_pld is None else last_pld
+
+    # control/label pairs per PLD, mean over repeats (PLD ordered: PLD, repeat, pair)
+    series = []
+    for (subject, context), mask in zip(items, masks):
+        values = pld_series_voxels(subject[context], mask).values
+        pairs = values.reshape(values.shape[0], NPLDS, -1, 2)[:, first_pld:last_pld].mean(axis=2)
+        series.append(pairs.reshape(values.shape[0], -1))
+
+    def gather(path, mask):
+        return nib.load(path).get_fdata(dtype=np.float32)[mask]
+
+    fit_map = os.path.join(batchdir, name)
+    os.makedirs(fit_map, exist_ok=True)
+    affine = np.diag(list(nib.load(first_data['gridmask_path']).header.get_zooms()[:3]) + [1.0])
+    paths = {}
+    pseudo_volumes = {
+        'asl': layout.pack(series),
+        'mask': layout.pack([np.ones(mask.sum()) for mask in masks]),
+        'calib': layout.pack([gather(subject[context]['calibM0_path'], mask) for (subject, context), mask in zip(items, masks)]),
+    }
+    for key, data in pseudo_volumes.items():
+        paths[key] = os.path.join(fit_map, f'pseudo_{key}.nii')
+        nib.save(nib.Nifti1Image(data, affine), paths[key])
+
+    # protocol parameters of the batch; the calibration of the pseudo-volume is redone per context (own alpha)
+    batch_subject = {key: first_data[key] for key in ('alpha', 'TR_M0', 'slicetime') if key in first_data}
+    batch_subject['ASL scan'] = first_subject['ASL scan']
+    output_map = os.path.join(fit_map, 'qasl')
+    asl_qasl_analysis(batch_subject, ANALYSIS_PARAMETERS, paths['asl'], paths['calib'], paths['mask'], output_map,
+                      first_data['PLDS'][first_pld:last_pld], first_data['tau'], ANALYSIS_PARAMETERS['inference_method'], artoff,
+                      backend=ANALYSIS_PARAMETERS.get('qasl_backend', 'cli'),
+                      nslabs=ANALYSIS_PARAMETERS.get('qasl_slabs', 1),
+                      location_calib=paths['calib'])
+
+    # scatter the outputs to the QASL output folder of every context, calibrated with its own M0a and alpha
+    for folder, _, files in os.walk(os.path.join(output_map, 'output')):
+        for filename in sorted(files):
+            if not filename.endswith(('.nii', '.nii.gz')):
+                continue
+            relative_file = os.path.relpath(os.path.join(folder, filename), output_map)
+            pseudo = np.asanyarray(nib.load(os.path.join(folder, filename)).dataobj)
+            for index, (subject, context) in enumerate(items):
+                path = os.path.join(item_output_map(subject, context, fit), relative_file)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                save_data_nifti(layout.unpack(pseudo, index), path, subject[context]['gridmask_path'], 1, None, None)
+    for subject, context in items:
+        asl_apply_m0_calibration(item_output_map(subject, context, fit), subject[context]['calibM0_path'], round(subject[context]['alpha'], 2))
+    logging.info(f"Cohort fit {name}: outputs scattered to {len(items)} contexts")
@@ -0,0 +1,105 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Crop the ASL data, M0 and brain mask to the bounding box of the brain mask plus a margin, so that motion correction,
+    quantification, registration and smoothing do not process the voxels outside the head.
+    Only the in-plane dimensions are cropped: all slices are kept, as the slice timing of the 2D readout (QASL --slicedt)
+    is defined by the slice index. Results are padded back to the source NIfTI geometry at export.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Spatial arrays in context_data that are cropped together, when present
+CROP_KEYS = ('PLDall_controllabel', 'M0', 'mask', 'nanmask', 'M0ASL_allPLD', 'M0_allPLD', 'ASL_controllabel_allPLD')
+
+def asl_crop_to_brain(subject, context_tag):
+    # Crop the in-memory ASL data, M0 and mask of a context to the brain mask bounding box plus margin (in-plane)
+    # Parameters:
+    #   subject: dict containing subject information including paths and parameters, 'crop_margin' (voxels)
+    #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
+    # Returns:
+    #   cropped arrays and affine in context_data, crop box in context_data['grid_crop'],
+    #   cropped grid template NIfTI in context_data['gridNIFTI_path'], M0 and mask NIfTIs re-saved on the cropped grid
+    context_data = subject[context_tag]
+    margin = subject.get('crop_margin', 4)
+
+    crop = brain_bounding_box(context_data['mask'], margin)
+    full_shape = crop['full_shape']
+    cropped_shape = tuple(stop - start for start, stop in crop['bbox'])
+
+    for key in CROP_KEYS:
+        if context_data.get(key) is not None:
+            context_data[key] = crop_to_bbox(context_data[key], crop)
+    context_data['affine'] = cropped_affine(context_data['affine'], crop)
+    context_data['grid_crop'] = crop
+
+    # grid template of the cropped data: source header, cropped affine
+    context_data['gridNIFTI_path'] = os.path.join(subject['ASLdir'], f'{context_tag}_grid_cropped.nii.gz')
+    header = nib.load(context_data['sourceNIFTI_path']).header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(context_data['M0'].astype(np.float32), context_data['affine'], header=header), context_data['gridNIFTI_path'])
+
+    # M0 and mask on the cropped grid, as used for quantification
+    save_data_nifti(context_data['M0'], context_data['M0_path'], context_data['gridNIFTI_path'], 1, None, None)
+    save_data_nifti(context_data['mask'], context_data['mask_path'], context_data['gridNIFTI_path'], 1, None, None)
+
+    fraction = np.prod(cropped_shape) / np.prod(full_shape)
+    logging.info(f"Crop to brain: grid {full_shape} -> {cropped_shape} (margin {margin} voxels), {round(100 * fraction, 1)}% of the voxels kept")
+    return subject
+
+def brain_bounding_box(mask, margin):
+    # In-plane bounding box of the mask plus margin (clipped to the grid), all slices
+    # Returns:
+    #   crop: dict with 'bbox' ((x0, x1), (y0, y1), (z0, z1)) and 'full_shape' (x, y, z) of the uncropped grid
+    full_shape = tuple(mask.shape[:3])
+    nonzero = np.nonzero(mask)
+    bbox = []
+    for axis in range(2):
+        if nonzero[axis].size == 0:
+            bbox.append((0, full_shape[axis]))
+        else:
+            bbox.append((max(0, int(nonzero[axis].min()) - margin), min(full_shape[axis], int(nonzero[axis].max()) + 1 + margin)))
+    bbox.append((0, full_shape[2]))
+    return {'bbox': tuple(bbox), 'full_shape': full_shape}
+
+def cropped_affine(affine, crop):
+    # Affine of the cropped grid: the voxel origin moves to the first voxel of the crop box
+    affine = np.array(affine, dtype=np.float64)
+    start = np.array([start for start, _ in crop['bbox']], dtype=np.float64)
+    affine[:3, 3] = affine[:3, :3] @ start + affine[:3, 3]
+    return affine
+
+def crop_to_bbox(data, crop):
+    # Crop the spatial (first three) dimensions of data to the crop box; crop None -> data unchanged
+    if crop is None:
+        return data
+    (x0, x1), (y0, y1), (z0, z1) = crop['bbox']
+    return data[x0:x1, y0:y1, z0:z1, ...]
+
+def pad_to_source(data, crop, fill_value=0.0):
+    # Pad cropped data back to the uncropped (source NIfTI) grid; crop None -> data unchanged
+    if crop is None:
+        return data
+    (x0, x1), (y0, y1), (z0, z1) = crop['bbox']
+    padded = np.full(tuple(crop['full_shape']) + data.shape[3:], fill_value, dtype=np.result_type(data.dtype, np.asarray(fill_value).dtype))
+    padded[x0:x1, y0:y1, z0:z1, ...] = data
+    return padded
+
+def recrop(data, from_crop, to_crop, fill_value=0.0):
+    # Move data from one crop box of the source grid to another (voxel index correspondence of the source grids)
+    if from_crop == to_crop:
+        return data
+    return crop_to_bbox(pad_to_source(data, from_crop, fill_value), to_crop)
@@ -0,0 +1,90 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Direct ATA (arterial transit artefact) map from the deltaM of the early PLDs (PLD 1-2), without a QASL fit.
+    Without arterial component, the ATA fit reports the calibrated early-PLD perfusion-weighted signal; in closed form this
+    is the least squares amplitude of the tissue curve per unit CBF K over the PLDs 1-2 (the ATA definition of
+    asl_kinetic_model.apparent_perfusion):
+        ATA = sum(deltaM * K) / sum(K^2) / (2 * alpha * M0a)
+    with the voxelwise calibration M0a (asl_m0_calibration) and the PLDs of the slice (2D Look-Locker slice timing).
+    K is the tissue curve at the arrival time of the AAT map (and T1app of the CBF map) of the context, both already
+    computed; without AAT map the single compartment model (arrival before the PLD, T1b decay) is used, which underestimates
+    ATA when the early PLDs are before the tissue arrival.
+    The Look-Locker correction is already applied to the control/label data (asl_prepare_asl_data).
+
+License: BSD 3-Clause License
+"""
+
+import os
+import time
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_kinetic_model import tissue_signal, single_compartment_signal
+from clinical_asl_pipeline.asl_m0_calibration import voxelwise_calibration_m0
+from clinical_asl_pipeline.utils.pld_subsets import PLD_SUBSETS, pld_deltaM, pld_series_voxels
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+def asl_direct_ata(subject, context_tag, output_map, location_calib=None, location_aat=None, location_cbf=None):
+    # ATA map of a context from the deltaM of PLDs 1-2 of its PLD ordered control/label data (in memory)
+    # Parameters:
+    #   subject: dict containing subject information including paths and parameters, 'T1t', 'T1b', 'lambda'
+    #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
+    #   output_map: output folder, the ATA map is written as output/native/calib_voxelwise/perfusion.nii.gz (QASL layout)
+    #   location_calib: optional path to the precomputed voxelwise calibration M0 (asl_m0_calibration), else computed from the M0
+    #   location_aat: optional path to the AAT map (s) of the context, arrival time of the tissue curve, else single compartment model
+    #   location_cbf: optional path to the CBF map of the context, for the T1app of the tissue curve (with location_aat), else T1t
+    # Returns:
+    #   ATA map saved as NIfTI, context_data['QASL_ATA_path'] pointing to it
+    start_time = time.time()
+    context_data = subject[context_tag]
+    mask = nib.load(context_data['gridmask_path']).get_fdata() > 0  # on the grid of the data (single resampling: baseline grid)
+    alpha = round(context_data['alpha'], 2)
+    T1b = subject['T1b']
+
+    asl = pld_series_voxels(context_data, mask)
+    first_pld, last_pld = PLD_SUBSETS['PLD1to2']
+    deltaM = pld_deltaM(asl.values, context_data['NPLDS'], subject['ASL scan'])[:, first_pld:last_pld]
+
+    if location_calib is not None:
+        calibM0 = nib.load(location_calib).get_fdata()
+    else:
+        calibM0 = voxelwise_calibration_m0(nib.load(context_data['gridM0_path']).get_fdata(), mask, float(context_data['TR_M0']),
+                                           subject['T1t'], subject.get('lambda', 0.9))
+    calibM0 = asl.gather(calibM0, dtype=np.float64)
+
+    # PLDs 1-2 per voxel, 2D Look-Locker readout: slice z is read out z * slicetime later
+    plds = np.asarray(context_data['PLDS'][first_pld:last_pld], dtype=np.float64)
+    slicedt = (context_data.get('slicetime') or 0) / 1000 if subject['ASL scan'] == 'multi-delay Look-Locker' else 0.0
+    slice_index = np.unravel_index(asl.flat_index, asl.shape)[2]
+    voxel_plds = plds[None, :] + slice_index[:, None] * slicedt
+    tau = np.atleast_1d(np.asarray(context_data['tau'], dtype=np.float64))
+    tau = tau[first_pld:last_pld] if tau.size == context_data['NPLDS'] else tau[0]
+
+    # signal per unit CBF K (normalised to 2 * alpha * M0a) at the PLDs 1-2 of the voxel
+    if location_aat is not None:
+        AAT = asl.gather(nib.load(location_aat).get_fdata(), dtype=np.float64)[:, None]
+        CBF = asl.gather(nib.load(location_cbf).get_fdata(), dtype=np.float64)[:, None] if location_cbf is not None else 0.0
+        CBF = np.where(np.isfinite(CBF), np.clip(CBF, 0, None), 0.0)
+        # tissue curve per unit CBF with the T1app of the voxel, the unit curve itself without perfusion (T1app = T1t)
+        K = np.where(CBF > 0, tissue_signal(voxel_plds, CBF, AAT, tau, subject['T1t'], T1b, subject.get('lambda', 0.9)) / np.where(CBF > 0, CBF, 1.0),
+                     tissue_signal(voxel_plds, 1.0, AAT, tau, subject['T1t'], T1b, subject.get('lambda', 0.9)))
+    else:
+        K = single_compartment_signal(voxel_plds, 1.0, tau, T1b)
+    signal = np.divide(deltaM, 2 * alpha * calibM0[:, None], out=np.zeros_like(deltaM), where=calibM0[:, None] > 0)
+    energy = np.sum(K ** 2, axis=1)
+    ATA = np.divide(np.sum(signal * K, axis=1), energy, out=np.zeros_like(energy), where=energy > 0)
+
+    context_data['QASL_ATA_path'] = os.path.join(output_map, 'output', 'native', 'calib_voxelwise', 'perfusion.nii.gz')
+    os.makedirs(os.path.dirname(context_data['QASL_ATA_path']), exist_ok=True)
+    save_data_nifti(asl.scatter(ATA), context_data['QASL_ATA_path'], context_data['gridmask_path'], 1, None, None)
+
+    logging.info(f"ATA computed directly from the PLD 1-2 deltaM ({context_tag}): {asl.nvox} voxels, this took: {round(time.time() - start_time, 2)} s")
+    return subject
@@ -0,0 +1,84 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Joint single-fit quantification: one QASL fit of all PLDs with the arterial component enabled gives CBF (tissue
+    perfusion), AAT (tissue arrival) and, through the kinetic model, ATA (arterial transit artefact map).
+    ATA is the apparent perfusion of the tissue plus arterial signal at PLDs 1-2, as the separate 1-to-2 PLD fit without
+    arterial component reports it (asl_kinetic_model.apparent_perfusion), computed from the joint fit parameters.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_kinetic_model import apparent_perfusion
+from clinical_asl_pipeline.utils.pld_subsets import PLD_SUBSETS
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Outputs of the joint QASL fit, relative to the QASL output folder
+QASL_JOINT_OUTPUTS = {
+    'CBF': os.path.join('output', 'native', 'calib_voxelwise', 'perfusion.nii.gz'),
+    'AAT': os.path.join('output', 'native', 'arrival.nii.gz'),
+    'perfusion': os.path.join('output', 'native', 'perfusion.nii.gz'),
+    'aCBV': os.path.join('output', 'native', 'aCBV.nii.gz'),
+    'arrival_art': os.path.join('output', 'native', 'arrival_art.nii.gz'),
+}
+
+def asl_joint_quantification_paths(subject, context_tag, output_map):
+    # Point the CBF and AAT map paths of a context to the outputs of the joint fit, and the ATA path to the derived map
+    context_data = subject[context_tag]
+    context_data['QASL_joint_path'] = output_map
+    context_data['QASL_CBF_path'] = os.path.join(output_map, QASL_JOINT_OUTPUTS['CBF'])
+    context_data['QASL_AAT_path'] = os.path.join(output_map, QASL_JOINT_OUTPUTS['AAT'])
+    context_data['QASL_ATA_path'] = os.path.join(subject['ASLdir'], f'{context_tag}_QASL_allPLD_joint_ATA.nii.gz')
+    return subject
+
+def asl_joint_ata(subject, context_tag):
+    # Derive the ATA map of a context from its joint QASL fit (CBF, AAT, aCBV) with the kinetic model
+    # Parameters:
+    #   subject: dict containing subject information including paths and parameters, 'T1t', 'T1b', 'lambda'
+    #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
+    # Returns:
+    #   ATA map saved as NIfTI at context_data['QASL_ATA_path']
+    context_data = subject[context_tag]
+    output_map = context_data['QASL_joint_path']
+
+    def load_output(key):
+        return nib.load(os.path.join(output_map, QASL_JOINT_OUTPUTS[key])).get_fdata()
+
+    CBF = load_output('CBF')
+    AAT = load_output('AAT')
+    # aCBV as blood volume fraction: assumes the uncalibrated aCBV and perfusion share the scaling (M0a * alpha) of QASL,
+    # not verified against QASL (as the output file names above), the joint mode is an unvalidated opt-in
+    perfusion = load_output('perfusion')
+    aCBV = np.divide(load_output('aCBV') * CBF / 6000, perfusion, out=np.zeros_like(CBF), where=perfusion != 0)
+    # arterial arrival time, the tissue arrival when QASL does not report it
+    if os.path.exists(os.path.join(output_map, QASL_JOINT_OUTPUTS['arrival_art'])):
+        arrival_art = load_output('arrival_art')
+    else:
+        arrival_art = AAT
+
+    # PLDs of the ATA map (PLD 1 to 2) per slice, shifted by the slice timing of the 2D readout
+    first_pld, last_pld = PLD_SUBSETS['PLD1to2']
+    plds = np.asarray(context_data['PLDS'][first_pld:last_pld], dtype=np.float64)
+    slicedt = (context_data.get('slicetime') or 0) / 1000  # ms -> s
+    plds = plds[None, None, None, :] + (np.arange(CBF.shape[2]) * slicedt)[None, None, :, None]
+    tau = np.atleast_1d(context_data['tau']).astype(np.float64)
+    tau = tau[first_pld:last_pld] if tau.size == len(context_data['PLDS']) else tau[0]
+
+    ATA = apparent_perfusion(plds, np.clip(CBF, 0, None), AAT, aCBV, arrival_art, tau,
+                             subject['T1t'], subject['T1b'], subject.get('lambda', 0.9))
+    ATA[~np.isfinite(ATA)] = 0
+    save_data_nifti(ATA, context_data['QASL_ATA_path'], context_data['QASL_CBF_path'], 1, None, None)
+
+    logging.info(f"ATA map derived from the joint fit ({context_tag}): {context_data['QASL_ATA_path']}")
+    return subject
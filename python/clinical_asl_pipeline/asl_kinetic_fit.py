@@ -0,0 +1,174 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Native multi-PLD pCASL quantification: least squares fit of the Buxton general kinetic model (tissue component,
+    asl_kinetic_model) for CBF and arrival time, for all brain voxels at once.
+    The deltaM of the brain voxels is a compact (Nvox x PLD) matrix (utils/masked_array.py); every voxel has its own PLDs
+    (Look-Locker: shifted by the slice timing of the 2D readout). The fit is a batched Levenberg-Marquardt, initialised by a
+    grid search over the arrival time with the linear least squares CBF per arrival time.
+    Outputs are written in the QASL output layout (output/native/perfusion, arrival, calib_voxelwise/perfusion), so the
+    native fit can replace a QASL fit. Fast path for urgent cases and independent cross-check of QASL.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import time
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_kinetic_model import tissue_signal
+from clinical_asl_pipeline.asl_m0_calibration import voxelwise_calibration_m0
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
+from clinical_asl_pipeline.utils.pld_subsets import pld_deltaM
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Fit settings: parameter bounds (CBF ml/100g/min, arrival s), initial arrival time grid (s), Levenberg-Marquardt iterations
+CBF_BOUNDS = (0.0, 300.0)
+ARRIVAL_BOUNDS = (0.0, 3.5)
+ARRIVAL_GRID = np.arange(0.1, 3.01, 0.1)
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-6
+
+def asl_kinetic_fit(
+    subject,
+    ANALYSIS_PARAMETERS,
+    location_asl_controllabel_pld_nifti,
+    location_m0,
+    location_mask,
+    output_map,
+    pld_list,
+    tau_list,
+    artoff=None,
+    location_calib=None,
+):
+    # Native quantification of CBF and arrival time, with the same inputs and output files as asl_qasl_analysis
+    # Parameters:
+    # subject: dict containing subject information, can be different per context tag: 'ASL scan', 'TR_M0', 'alpha', 'slicetime'
+    # ANALYSIS_PARAMETERS: 'T1t', 'T1b', 'lambda'
+    # location_asl_controllabel_pld_nifti: path to ASL control/label NIfTI file, PLD blocks of repeated pairs (QASL --ibf=tis),
+    #                                      pairs tag-control for multi-delay Look-Locker, control-tag for multi-delay variable-TR
+    # location_m0: path to M0 NIfTI file; location_mask: path to brain mask NIfTI file
+    # output_map: output directory, written as output/native/{perfusion, arrival, calib_voxelwise/perfusion}.nii.gz
+    # pld_list: list of post-labeling delays (PLDs) in seconds; tau_list: bolus duration(s) in seconds
+    # artoff: accepted for compatibility with asl_qasl_analysis, the native fit has no arterial component
+    # location_calib: optional path to the precomputed voxelwise calibration M0 (asl_m0_calibration), else computed from location_m0
+    start_time = time.time()
+    T1t = ANALYSIS_PARAMETERS['T1t']
+    T1b = ANALYSIS_PARAMETERS['T1b']
+    partition_coefficient = ANALYSIS_PARAMETERS.get('lambda', 0.9)
+    alpha = round(subject['alpha'], 2)
+    plds = np.asarray(pld_list, dtype=np.float64)
+    tau = np.atleast_1d(np.asarray(tau_list, dtype=np.float64))
+    tau = tau if tau.size == plds.size else tau[0]
+
+    mask_img = nib.load(location_mask)
+    mask = mask_img.get_fdata() > 0
+    asl = MaskedVoxels.from_dense(nib.load(location_asl_controllabel_pld_nifti).get_fdata(dtype=np.float32), mask)
+    if location_calib is not None:
+        calibM0 = nib.load(location_calib).get_fdata()
+    else:
+        calibM0 = voxelwise_calibration_m0(nib.load(location_m0).get_fdata(), mask, float(subject['TR_M0']), T1t, partition_coefficient)
+    calibM0 = asl.gather(calibM0, dtype=np.float64)
+
+    # deltaM (Nvox x PLD): mean over repeats of control - tag, normalised to 2 * alpha * M0a (model units)
+    deltaM = pld_deltaM(asl.values, plds.size, subject['ASL scan'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        signal = np.where(calibM0[:, None] > 0, deltaM / (2 * alpha * calibM0[:, None]), 0.0)
+
+    # PLDs per voxel, Look-Locker 2D readout: slice z is read out z * slicetime later
+    slicedt = (subject.get('slicetime') or 0) / 1000 if subject['ASL scan'] == 'multi-delay Look-Locker' else 0.0
+    slice_index = np.unravel_index(asl.flat_index, asl.shape)[2]
+    voxel_plds = plds[None, :] + slice_index[:, None] * slicedt
+
+    logging.info(f"Native kinetic model fit: {asl.nvox} voxels x {plds.size} PLDs")
+    initial = initial_grid_search(signal, voxel_plds, tau, T1t, T1b, partition_coefficient)
+    parameters, iterations = levenberg_marquardt(signal, voxel_plds, initial,
+                                                 lower=np.array([CBF_BOUNDS[0], ARRIVAL_BOUNDS[0]]),
+                                                 upper=np.array([CBF_BOUNDS[1], ARRIVAL_BOUNDS[1]]),
+                                                 tau=tau, T1t=T1t, T1b=T1b, partition_coefficient=partition_coefficient)
+    logging.info(f"Native kinetic model fit: iterations per voxel median {int(np.median(iterations))}, max {iterations.max()}")
+
+    # outputs in the QASL layout; the uncalibrated perfusion has the QASL scaling perfusion = CBF * M0a * alpha / 6000
+    CBF = parameters[:, 0]
+    outputs = {
+        os.path.join('output', 'native', 'perfusion.nii.gz'): CBF * calibM0 * alpha / 6000,
+        os.path.join('output', 'native', 'arrival.nii.gz'): parameters[:, 1],
+        os.path.join('output', 'native', 'calib_voxelwise', 'perfusion.nii.gz'): CBF,
+    }
+    for relative_path, values in outputs.items():
+        path = os.path.join(output_map, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_data_nifti(asl.scatter(values), path, location_mask, 1, None, None)
+
+    logging.info("Native kinetic model fit finished")
+    logging.info(f"..this took: {round(time.time() - start_time, 2)} s")
+
+def initial_grid_search(signal, voxel_plds, tau, T1t, T1b, partition_coefficient=0.9):
+    # Initial CBF and arrival per voxel: for every arrival time of ARRIVAL_GRID the linear least squares CBF (tissue curve per
+    # unit CBF), keeping the arrival time with the lowest residual
+    # signal: (Nvox x PLD) normalised deltaM; voxel_plds: (Nvox x PLD) PLDs
+    # Returns: (Nvox x 2) CBF and arrival time
+    best_cost = np.full(signal.shape[0], np.inf)
+    initial = np.zeros((signal.shape[0], 2))
+    for arrival in ARRIVAL_GRID:
+        curve = tissue_signal(voxel_plds, 1.0, arrival, tau, T1t, T1b, partition_coefficient)
+        energy = np.sum(curve ** 2, axis=1)
+        cbf = np.clip(np.divide(np.sum(signal * curve, axis=1), energy, out=np.zeros_like(energy), where=energy > 0), *CBF_BOUNDS)
+        cost = np.sum((signal - cbf[:, None] * curve) ** 2, axis=1)
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        initial[better] = np.column_stack([cbf[better], np.full(better.sum(), arrival)])
+    return initial
+
+def levenberg_marquardt(signal, voxel_plds, initial, lower, upper, tau, T1t, T1b, partition_coefficient=0.9,
+                        max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    # Batched Levenberg-Marquardt: every voxel its own damping, step acceptance and convergence, solved for all
+    # active voxels at once (Jacobian by forward differences, 2x2 normal equations per voxel)
+    # signal: (Nvox x PLD); initial: (Nvox x 2) CBF, arrival; lower, upper: parameter bounds
+    # Convergence per voxel: relative cost decrease or parameter step below tolerance, or no improvement at maximal damping
+    # Returns: (Nvox x 2) fitted parameters, (Nvox) number of iterations per voxel
+    def model(parameters, plds):
+        return tissue_signal(plds, parameters[:, 0:1], parameters[:, 1:2], tau, T1t, T1b, partition_coefficient)
+
+    parameters = np.clip(initial.astype(np.float64), lower, upper)
+    damping = np.full(len(parameters), 1e-3)
+    cost = np.sum((signal - model(parameters, voxel_plds)) ** 2, axis=1)
+    active = np.flatnonzero(np.isfinite(cost))
+    step = 1e-4 * (upper - lower)
+    iterations = np.zeros(len(parameters), dtype=int)
+
+    for _ in range(max_iterations):
+        if active.size == 0:
+            break
+        iterations[active] += 1
+        p, y, plds = parameters[active], signal[active], voxel_plds[active]
+        model_signal = model(p, plds)
+        r = y - model_signal
+        # Jacobian (Nactive x PLD x 2)
+        J = np.stack([(model(p + step[k] * np.eye(2)[k], plds) - model_signal) / step[k] for k in range(2)], axis=2)
+        JtJ = np.einsum('npk,npl->nkl', J, J)
+        Jtr = np.einsum('npk,np->nk', J, r)
+        A = JtJ + damping[active, None, None] * (JtJ * np.eye(2)) + 1e-12 * np.eye(2)
+        delta = np.linalg.solve(A, Jtr[..., None])[..., 0]
+        p_new = np.clip(p + delta, lower, upper)
+        cost_new = np.sum((y - model(p_new, plds)) ** 2, axis=1)
+
+        improved = cost_new < cost[active]
+        small_step = np.all(np.abs(p_new - p) <= tolerance * (upper - lower), axis=1)
+        converged = improved & ((cost[active] - cost_new <= tolerance * cost[active]) | small_step)
+        parameters[active[improved]] = p_new[improved]
+        damping[active[improved]] /= 10
+        damping[active[~improved]] *= 10
+        converged |= ~improved & (damping[active] > 1e10)
+        cost[active[improved]] = cost_new[improved]
+        active = active[~converged]
+
+    return parameters, iterations
@@ -0,0 +1,65 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Buxton general kinetic model for pCASL (tissue component) plus the macrovascular (arterial) component, as fitted by QASL.
+    Signals are normalised to 2 * alpha * M0a (difference signal per unit blood M0), with perfusion f in ml/g/s and the arterial
+    blood volume aCBV as fraction. Used to derive the ATA map from the joint fit and for the synthetic phantom of the benchmarks.
+    The signal functions broadcast over numpy arrays, the PLDs on the last axis.
+
+License: BSD 3-Clause License
+"""
+
+import numpy as np
+
+def t1_app(cbf, T1t, partition_coefficient=0.9):
+    # Apparent tissue T1 (s) with perfusion: 1/T1app = 1/T1t + f/lambda, f = CBF/6000 (ml/100g/min -> ml/g/s)
+    return 1 / (1 / T1t + np.asarray(cbf) / 6000 / partition_coefficient)
+
+def tissue_signal(plds, cbf, att, tau, T1t, T1b, partition_coefficient=0.9):
+    # Tissue difference signal (Buxton pCASL) at the post labeling delays
+    # plds: PLDs (s), last axis; cbf: ml/100g/min; att: tissue arrival time (s); tau: label duration (s)
+    # Returns: difference signal per unit 2 * alpha * M0a
+    t = np.asarray(tau) + np.asarray(plds)  # time since start of labeling
+    att = np.asarray(att)
+    f = np.asarray(cbf) / 6000
+    T1a = t1_app(cbf, T1t, partition_coefficient)
+    during_bolus = f * T1a * np.exp(-att / T1b) * (1 - np.exp(-np.clip(t - att, 0, None) / T1a))
+    after_bolus = f * T1a * np.exp(-att / T1b) * np.exp(-(t - tau - att) / T1a) * (1 - np.exp(-tau / T1a))
+    return np.where(t < att, 0.0, np.where(t < att + tau, during_bolus, after_bolus))
+
+def single_compartment_signal(plds, cbf, tau, T1b):
+    # Single compartment (white paper) pCASL difference signal, label arrived before the PLD and decaying with T1 of blood:
+    # the tissue signal for arrival <= PLD with T1app = T1b, independent of the arrival time
+    # plds: PLDs (s), last axis; cbf: ml/100g/min; tau: label duration (s)
+    # Returns: difference signal per unit 2 * alpha * M0a
+    return np.asarray(cbf) / 6000 * T1b * np.exp(-np.asarray(plds) / T1b) * (1 - np.exp(-np.asarray(tau) / T1b))
+
+def arterial_signal(plds, acbv, aatt, tau, T1b):
+    # Macrovascular (arterial) difference signal: labeled blood passing the voxel between aatt and aatt + tau
+    # plds: PLDs (s), last axis; acbv: arterial blood volume fraction; aatt: arterial arrival time (s); tau: label duration (s)
+    # Returns: difference signal per unit 2 * alpha * M0a
+    t = np.asarray(tau) + np.asarray(plds)
+    aatt = np.asarray(aatt)
+    return np.where((t >= aatt) & (t < aatt + tau), np.asarray(acbv) * np.exp(-aatt / T1b), 0.0)
+
+def apparent_perfusion(plds, cbf, att, acbv, aatt, tau, T1t, T1b, partition_coefficient=0.9):
+    # Apparent perfusion (ml/100g/min) of the tissue plus arterial signal at the given PLDs, as a tissue-only fit (arterial
+    # component off) at these PLDs reports it, the ATA definition: least squares amplitude of the tissue curve per unit CBF
+    # (arrival fixed at att) fitted to the total signal
+    # plds: PLDs (s), shape (..., NPLDS) or (NPLDS); cbf, att, acbv, aatt: parameter maps (...), without the PLD axis
+    # Returns: apparent perfusion map (...)
+    cbf, att, acbv, aatt = (np.asarray(p, dtype=np.float64)[..., None] for p in (cbf, att, acbv, aatt))
+    S_tissue = tissue_signal(plds, cbf, att, tau, T1t, T1b, partition_coefficient)
+    S_total = S_tissue + arterial_signal(plds, acbv, aatt, tau, T1b)
+    # tissue curve per unit CBF, with the T1app of the voxel (CBF > 0), so that without arterial signal ATA = CBF
+    S_tissue_unit = np.where(cbf > 0, S_tissue / np.where(cbf > 0, cbf, 1.0), tissue_signal(plds, 1.0, att, tau, T1t, T1b, partition_coefficient))
+    numerator = np.sum(S_total * S_tissue_unit, axis=-1)
+    denominator = np.sum(S_tissue_unit ** 2, axis=-1)
+    return np.divide(numerator, denominator, out=np.zeros(np.shape(numerator)), where=denominator > 0)
@@ -11,22 +11,31 @@ Contact: j.c.w.siero@umcutrecht.nl
 
 Description:
     Function for computing Look-Locker correction factors for ASL MRI data.
+    The Look-Locker recovery is evaluated in closed form at arbitrary readout times: between readouts the labeled
+    magnetisation difference relaxes with T1 of blood, and every readout pulse scales it with cos(flip angle), so
+    relative to the difference without Look-Locker readout (M0 * exp(-t / T1b)) the measured signal is
+        sin(FA) * cos(FA) ^ ((t - t0) / deltaPLD),    t0: first readout (T1b cancels)
+    with the effective T1 approximation of a readout every deltaPLD (Brix et al MRI 1990). For a 2D readout slice z is
+    read at PLD + z * slicetime; the factors of all slices and PLDs form a (NSLICES x NPLDS) table computed in one
+    broadcast operation and cached.
 
 License: BSD 3-Clause License
 """
 
 import logging
 import numpy as np
+from functools import lru_cache
 
 def asl_look_locker_correction(subject, context_tag):
-    # Compute Look-Locker scaling correction per PLD for mDelay PCASL, by JCW SIERO 2020.
-    # This function computes the Look-Locker correction factor for each PLD in the ASL data.
+    # Compute Look-Locker scaling correction per slice and PLD for mDelay PCASL, by JCW SIERO 2020.
+    # This function computes the Look-Locker correction factor for each slice and PLD in the ASL data.
     # Parameters:   
     # subject: dictionary containing ASL parameters and data
     # context_tag: string indicating the ASL context tag for the subject's data, e.g., 'baseline', 'stimulus', etc.
-    # Returns: subject dictionary with Look-Locker correction factor for each PLD, to be used in ALS quantification (QASL)
-    # Ensure subject dictionary has required keys
-    # required_keys = ['FLIPANGLE', 'PLDS', 'T1b']s, ie correction only depends on flip angle, PLDs timing, and T1b
+    # Returns: subject dictionary with Look-Locker correction factors, to be used in ALS quantification (QASL):
+    #   'LookLocker_correction_factor_perslice': (NSLICES x NPLDS) table, applied slice-wise in asl_prepare_asl_data
+    #   'LookLocker_correction_factor_perPLD': factors of the first slice (NPLDS)
+    # The correction only depends on flip angle, PLDs timing and slice timing ('FLIPANGLE', 'PLDS', 'slicetime', 'NSLICES')
 
     # Use a shorter alias for subject[context_tag]
     context_data = subject[context_tag]
@@ -34,66 +43,44 @@ def asl_look_locker_correction(subject, context_tag):
     # Flip angle in degrees
     flip_angle = context_data['FLIPANGLE']
 
-    # Assume M0 = 1
-    M0 = 1
+    # PLDs in seconds, slice timing in milliseconds (0: all slices read at the PLD)
+    PLDS = tuple(float(pld) for pld in context_data['PLDS'])
+    slicetime = float(context_data.get('slicetime') or 0)
+    nslices = int(context_data.get('NSLICES') or 1)
 
-    # PLDs in milliseconds
-    PLD = np.array(context_data['PLDS']) * 1000  # convert from s to ms
+    LookLocker_correction_factor_perslice = look_locker_factor_table(flip_angle, PLDS, slicetime, nslices)
+    LookLocker_correction_factor_perPLD = LookLocker_correction_factor_perslice[0]
 
-    # Time vector t
-    t = np.arange(1, int(PLD[-1] * 1.1) + 1)  # MATLAB-style 1:PLD(end)*1.1
-
-    # Blood T1 in ms
-    T1_blood = subject['T1b'] * 1e3  # 1.65 * 1000
-
-    # Average delta PLD
-    delta_PLD = np.mean(np.diff(PLD))
-
-    # Effective T1 during Look-Locker
-    T1_eff_blood = 1 / (1 / T1_blood - np.log(np.cos(np.radians(flip_angle))) / delta_PLD)
-
-    # Equilibrium magnetization during LL readout, # Brix et al MRI 1990
-    Meq_LL_blood = M0 * (1 - np.exp(-delta_PLD / T1_blood)) / (1 - np.cos(np.radians(flip_angle)) * np.exp(-delta_PLD / T1_blood))
-
-    # Magnetization without Look-Locker
-    Mz_noLL_C = M0 * (1 - np.exp(-t / T1_blood)) # control data
-    Mz_noLL_L = M0 * (1 - 2 * np.exp(-t / T1_blood)) # label data
-    deltaM_noLL = Mz_noLL_C - Mz_noLL_L      
-
-    # With Look-Locker
-    Mz_LL_C = np.zeros_like(t, dtype=np.float64)
-    Mz_LL_L = np.zeros_like(t, dtype=np.float64)
-
-    t1 = np.arange(1, int(PLD[0]) + 1)
-    Mz_LL_C[t1 - 1] = M0 * (1 - np.exp(-t1 / T1_blood))
-    Mz_LL_L[t1 - 1] = M0 * (1 - 2 * np.exp(-t1 / T1_blood))
-
-    t2 = np.arange(int(PLD[0]) + 1, int(t[-1]) + 1)
-    offset = int(round(PLD[0]))
-    decay = np.exp(-t[t2 - 1 - offset] / T1_eff_blood)
-    recovery = Meq_LL_blood * (1 - decay)
-    Mz_LL_C[t2 - 1] = Mz_LL_C[offset - 1] * decay + recovery
-    Mz_LL_L[t2 - 1] = Mz_LL_L[offset - 1] * decay + recovery
-
-    deltaM_LL = Mz_LL_C - Mz_LL_L
-
-    with np.errstate(divide='ignore', invalid='ignore'):
-        deltaM_ratio_LL_noLL = deltaM_LL / deltaM_noLL
-        deltaM_ratio_LL_noLL[~np.isfinite(deltaM_ratio_LL_noLL)] = 0
-
-    # Convert to Mxy using flip angle
-    deltaMxy_ratio_LL_noLL = deltaM_ratio_LL_noLL * np.sin(np.radians(flip_angle))
-
-    # Extract values at PLD time points (rounded to nearest integer indices)
-    tpointsMxy = PLD.astype(int)
-    LookLocker_correction_factor_perPLD = np.round(deltaMxy_ratio_LL_noLL[tpointsMxy - 1],3)  # -1 for 0-based index
-    
     # Display summary
     logging.info(
         f"Look-Locker correction factor for flipangle = {flip_angle} (deg), "
-        f"PLDs(ms): {PLD.tolist()}, and deltaPLD(ms) = {delta_PLD}: "
+        f"PLDs(ms): {(np.array(PLDS) * 1000).tolist()}, and deltaPLD(ms) = {delta_pld_ms(PLDS)}: "
         f"{LookLocker_correction_factor_perPLD}, JCW SIERO 2020"
     )
-    
+    logging.info(f"Look-Locker correction factors for {nslices} slices, slicetime {slicetime} ms: "
+                 f"range {LookLocker_correction_factor_perslice.min()} - {LookLocker_correction_factor_perslice.max()}")
+
+    context_data['LookLocker_correction_factor_perslice'] = LookLocker_correction_factor_perslice
     context_data['LookLocker_correction_factor_perPLD'] = LookLocker_correction_factor_perPLD
     return subject
+
+def delta_pld_ms(PLDS):
+    # Average delta PLD (ms), the interval of the Look-Locker readouts
+    return float(np.mean(np.diff(np.array(PLDS) * 1000))) if len(PLDS) > 1 else np.inf
+
+def look_locker_factor(t, t0, flip_angle, delta_PLD):
+    # Look-Locker correction factor at readout time t (ms): measured / no Look-Locker deltaM signal (Mxy)
+    # t0: time of the first readout (ms); delta_PLD: interval of the readouts (ms); broadcasts over t and t0
+    fa = np.radians(flip_angle)
+    return np.sin(fa) * np.cos(fa) ** (np.clip(np.asarray(t) - t0, 0, None) / delta_PLD)
+
+@lru_cache(maxsize=None)
+def look_locker_factor_table(flip_angle, PLDS, slicetime, nslices):
+    # Look-Locker correction factors (NSLICES x NPLDS), rounded to 3 decimals, cached per (flip angle, PLDs, slicetime, NSLICES)
+    # PLDS: tuple of PLDs (s); slicetime: slice timing of the 2D readout (ms); slice z is read at PLD + z * slicetime, its
+    # recovery under the (slice selective) readout starts at its first readout PLD[0] + z * slicetime
+    # Returns: read-only numpy array (shared by the cache)
+    readout = np.array(PLDS)[None, :] * 1000 + np.arange(nslices)[:, None] * slicetime
+    table = np.round(look_locker_factor(readout, readout[:, :1], flip_angle, delta_pld_ms(PLDS)), 3)
+    table.setflags(write=False)
+    return table
@@ -0,0 +1,77 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Voxelwise M0 calibration, computed once per context and shared by the QASL fits (AAT, CBF, ATA) of that context.
+    The calibration is the QASL/oxasl voxelwise method: the M0 is corrected for the T1 recovery of tissue within TR_M0 and
+    divided by the tissue/blood partition coefficient, M0a = cgain * M0 / (1 - exp(-TR_M0 / T1t)) / lambda.
+    The uncalibrated QASL perfusion is then scaled as perfusion_calib = 6000 * perfusion / (M0a * alpha) (ml/100g/min).
+    The M0 is acquired within the ASL series and the ASL data are motion corrected to it, so the M0 to ASL registration
+    of QASL (--calib-aslreg) is not repeated.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Output of a QASL fit: uncalibrated and voxelwise calibrated perfusion, relative to the QASL output folder
+QASL_PERFUSION = os.path.join('output', 'native', 'perfusion.nii.gz')
+QASL_PERFUSION_CALIB = os.path.join('output', 'native', 'calib_voxelwise', 'perfusion.nii.gz')
+
+def asl_m0_calibration(subject, context_tag):
+    # Compute the voxelwise calibration M0 (M0a) of a context once, for all its QASL fits
+    # Parameters:
+    #   subject: dict containing subject information including paths and parameters, 'T1t', 'lambda'
+    #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
+    # Returns:
+    #   calibration M0 in context_data['calibM0'] and saved as NIfTI at context_data['calibM0_path'] (on the grid of 'gridM0_path')
+    context_data = subject[context_tag]
+
+    M0 = nib.load(context_data['gridM0_path']).get_fdata()
+    mask = nib.load(context_data['gridmask_path']).get_fdata() > 0
+    T1t = subject['T1t']
+    TR_M0 = float(context_data['TR_M0'])
+    partition_coefficient = subject.get('lambda', 0.9)
+
+    calibM0 = voxelwise_calibration_m0(M0, mask, TR_M0, T1t, partition_coefficient)
+
+    context_data['calibM0'] = calibM0
+    context_data['calibM0_path'] = os.path.join(subject['ASLdir'], f'{context_tag}_M0_calib_voxelwise.nii.gz')
+    save_data_nifti(calibM0, context_data['calibM0_path'], context_data['gridM0_path'], 1, None, None)
+
+    logging.info(f"Voxelwise M0 calibration computed once for all QASL fits ({context_tag}): TR_M0 {TR_M0} s, T1t {T1t} s, lambda {partition_coefficient}")
+    return subject
+
+def voxelwise_calibration_m0(M0, mask, TR_M0, T1t, partition_coefficient=0.9, cgain=1.0):
+    # Calibration M0 (blood M0, M0a) from the M0 image: saturation recovery of tissue within TR_M0 and blood/tissue
+    # partition coefficient; cgain 1.0 as --cgain 1.00 of the QASL fits. Zero outside the mask
+    calibM0 = cgain * M0 / (1 - np.exp(-TR_M0 / T1t)) / partition_coefficient
+    return np.where((mask > 0) & np.isfinite(calibM0), calibM0, 0.0)
+
+def asl_apply_m0_calibration(output_map, calibM0_path, alpha):
+    # Scale the uncalibrated perfusion of a QASL fit with the precomputed calibration M0, written as the voxelwise
+    # calibrated perfusion of QASL (output/native/calib_voxelwise/perfusion.nii.gz), so the output files are unchanged
+    # output_map: QASL output folder of the fit
+    # calibM0_path: NIfTI of the calibration M0 (asl_m0_calibration)
+    # alpha: labeling efficiency (incl. background suppression)
+    perfusion_path = os.path.join(output_map, QASL_PERFUSION)
+    perfusion_calib_path = os.path.join(output_map, QASL_PERFUSION_CALIB)
+
+    perfusion = nib.load(perfusion_path).get_fdata()
+    calibM0 = nib.load(calibM0_path).get_fdata()
+    perfusion_calib = np.zeros_like(perfusion)
+    np.divide(6000 * perfusion, calibM0 * alpha, out=perfusion_calib, where=calibM0 > 0)
+
+    os.makedirs(os.path.dirname(perfusion_calib_path), exist_ok=True)
+    save_data_nifti(perfusion_calib, perfusion_calib_path, perfusion_path, 1, None, None)
+    logging.info(f"Calibrated perfusion (voxelwise, precomputed M0) saved: {perfusion_calib_path}")
@@ -11,17 +11,32 @@ Contact: j.c.w.siero@umcutrecht.nl
 
 Description:
     Perform motion correction on 4D datasets using a reference image.
-    Method is by ANTs
+    Method is by ANTs, either serial (ants.motion_correction) or with the volumes
+    registered concurrently in a pool of worker processes.
 
 License: BSD 3-Clause License
 """
 
-import os
+import time
 import ants 
 import logging
-import nibabel as nib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from clinical_asl_pipeline.utils.append_filename import append_mc
 from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+from clinical_asl_pipeline.utils.parallel_workers import resolve_num_workers, get_spawn_context, set_itk_threads
+from clinical_asl_pipeline.utils.ants_image import numpy_to_ants, ants_to_numpy
+
+# Registration settings shared by the serial and parallel motion correction engines
+MOTIONCORRECTION_SETTINGS = {
+    'type_of_transform': 'DenseRigid',
+    'aff_metric': 'mattes',
+    'smoothing_in_mm': True,
+    'singleprecision': True,
+}
+
+# Per-process state of a motion correction worker: reference image and affine, set once by the initializer
+_worker_state = {}
 
 def asl_motion_correction(subject, context_tag):
     # perform motion correction on PLD ordered data (makes sense for CBF/AAT fit)
@@ -31,54 +46,174 @@ def asl_motion_correction(subject, context_tag):
     #   subject: dict containing subject information including paths and parameters
     #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
     # Returns:
-    #   motion-corrected PLD ordered NIFTIs, filename appended with '_mc' before '.nii.gz'
+    #   motion-corrected PLD ordered data in context_data['PLDall_controllabel'] (in memory, handed to the next step)
+    #   motion-corrected PLD ordered NIFTI (all PLDs), filename appended with '_mc' before '.nii.gz'
+    # Single resampling: when context_data holds 'grid_transforms' (see asl_registration_stimulus_to_baseline_grid), these are
+    # composed with the motion transforms and the data are resampled once, onto the grid of 'grid_shape'/'grid_affine'
 
     # Use a shorter alias for subject[context_tag]
     context_data = subject[context_tag]
 
-    inputdata_path = context_data['PLDall_controllabel_path']
-    refdata_path = context_data['M0_path']
-    outputdata_path = append_mc(inputdata_path)
-    nifti_template_path = context_data['sourceNIFTI_path']
-    NREPEATS = context_data['NREPEATS']
+    inputdata = context_data['PLDall_controllabel']
+    refdata = context_data['M0']
+    affine = context_data['affine']
+    nifti_template_path = context_data['gridNIFTI_path']
     
     # update path to motion corrected data, appending '_mc' to filename using append_mc
     context_data['PLDall_controllabel_path'] =  append_mc(context_data['PLDall_controllabel_path'])
 
+    # motion estimation: 'per_volume' registers every volume, 'per_dynamic' estimates one transform per control or label
+    # dynamic (all PLDs of a Look-Locker dynamic are read out within one TR), 'per_pair' one per control/label pair
+    volume_groups = asl_motion_estimation_groups(subject, context_tag)
+
     # perform motion correction routine, append output file name with '_mc' prefix
-    asl_motioncorrection_ants(inputdata_path, refdata_path, outputdata_path)
+    # engine: 'parallel' registers the volumes concurrently in worker processes, 'serial' uses ants.motion_correction
+    engine = subject.get('motion_correction_engine', 'serial')
+    if engine not in ('serial', 'parallel'):
+        raise ValueError(f"Unknown motion_correction_engine: '{engine}', use 'serial' or 'parallel'")
+
+    # output grid: composed with the stimulus to baseline transform for single resampling, else the native grid
+    grid = None
+    if context_data.get('grid_transforms'):
+        grid = (context_data['grid_shape'], context_data['grid_affine'], context_data['grid_transforms'])
+
+    if engine == 'serial' and volume_groups is None and grid is None:
+        PLDall_motioncorrected = asl_motioncorrection_ants(inputdata, refdata, affine)
+    else:
+        n_workers = subject.get('motion_correction_workers') if engine == 'parallel' else 1
+        PLDall_motioncorrected = asl_motioncorrection_ants_parallel(inputdata, refdata, affine,
+                                                                    n_workers=n_workers,
+                                                                    itk_threads=subject.get('itk_threads_per_worker', 1),
+                                                                    volume_groups=volume_groups,
+                                                                    grid=grid)
+
+    context_data['PLDall_controllabel'] = PLDall_motioncorrected
 
     logging.info("Saving ASL motion-corrected data interleaved label control: all PLDs")
+    save_data_nifti(PLDall_motioncorrected, context_data['PLDall_controllabel_path'], nifti_template_path, 1, None, None)
+    # the PLD subsets (2-to-last, 1-to-2) are views on PLDall_controllabel, written right before quantification (utils/pld_subsets.py)
 
-    if subject['ASL scan'] == 'multi-delay Look-Locker':
-        context_data['PLD2tolast_controllabel_path'] =  append_mc(context_data['PLD2tolast_controllabel_path'])
-        context_data['PLD1to2_controllabel_path'] =  append_mc(context_data['PLD1to2_controllabel_path'])
+    return subject
 
-        PLDall_motioncorrected = nib.load(outputdata_path).get_fdata()
-        PLD2tolast_motioncorrected = PLDall_motioncorrected[:, :, :, NREPEATS*2: ]
-        PLD1to2_motioncorrected = PLDall_motioncorrected[:, :, :, 0:NREPEATS*2*2]        
+def asl_motion_estimation_groups(subject, context_tag):
+    # Group the volumes of the PLD ordered 4D series that share one motion estimate.
+    # Volume order in the series is: PLD (outer), repeat, control/label (inner), ie index = pld * NREPEATS * 2 + repeat * 2 + control/label
+    # Returns:
+    #   None for 'per_volume' (every volume registered independently), else a list of lists of volume indices
+    context_data = subject[context_tag]
+    mode = subject.get('motion_estimation', 'per_volume')
 
-        logging.info("Saving ASL motion-corrected data interleaved label control: 2-to-last PLDs")
-        logging.info("Saving ASL motion-corrected data interleaved label control: 1-to-2 PLDs")
+    if mode == 'per_volume':
+        return None
+    if mode not in ('per_dynamic', 'per_pair'):
+        raise ValueError(f"Unknown motion_estimation: '{mode}', use 'per_volume', 'per_dynamic' or 'per_pair'")
+    if subject['ASL scan'] != 'multi-delay Look-Locker':
+        logging.warning(f"motion_estimation '{mode}' requires multi-delay Look-Locker data, using 'per_volume'")
+        return None
 
-        save_data_nifti(PLD2tolast_motioncorrected, context_data['PLD2tolast_controllabel_path'], nifti_template_path, 1, None, None)
-        save_data_nifti(PLD1to2_motioncorrected, context_data['PLD1to2_controllabel_path'], nifti_template_path, 1, None, None)
-        
-    return subject
+    NREPEATS = context_data['NREPEATS']
+    NPLDS = context_data['NPLDS']
+
+    def volume_index(pld, repeat, controllabel):
+        return pld * NREPEATS * 2 + repeat * 2 + controllabel
+
+    if mode == 'per_dynamic':
+        volume_groups = [[volume_index(pld, repeat, controllabel) for pld in range(NPLDS)]
+                         for repeat in range(NREPEATS) for controllabel in range(2)]
+    else:
+        volume_groups = [[volume_index(pld, repeat, controllabel) for pld in range(NPLDS) for controllabel in range(2)]
+                         for repeat in range(NREPEATS)]
+
+    logging.info(f"Motion estimation '{mode}': {len(volume_groups)} registrations for {NREPEATS * NPLDS * 2} volumes")
+    return volume_groups
 
-def asl_motioncorrection_ants(inputdata, refdata, outputdata):
+def asl_motioncorrection_ants(inputdata, refdata, affine):
     # Perform motion correction using ANTs
-    # inputdata: path to the input ASL data in NIfTI formatd
-    # refdata: path to the reference image for motion correction
-    # outputdata: path to save the motion-corrected output data in NIfTI format
-    logging.info(f"Perform motion correction (using ANTs): input: {os.path.basename(inputdata)}  reference: {os.path.basename(refdata)} ")
+    # inputdata: 4D numpy array (x, y, z, t) of the ASL data
+    # refdata: 3D numpy array (x, y, z) of the reference image for motion correction
+    # affine: NIfTI affine of the data grid (same for input and reference)
+    # Returns:
+    #   4D numpy array (x, y, z, t) of the motion-corrected data
+    logging.info(f"Perform motion correction (using ANTs): input: {inputdata.shape[3]} volumes, reference: M0")
     results_dict = ants.motion_correction(
-        ants.image_read(inputdata),
-        ants.image_read(refdata),
-        type_of_transform="DenseRigid",
-        aff_metric="mattes",
-        smoothing_in_mm=True,
-        singleprecision=True,
-        verbose=True
+        numpy_to_ants(inputdata, affine),
+        numpy_to_ants(refdata, affine),
+        verbose=True,
+        **MOTIONCORRECTION_SETTINGS
     )
-    ants.image_write(results_dict["motion_corrected"], outputdata)
+    return ants_to_numpy(results_dict["motion_corrected"])
+
+def asl_motioncorrection_ants_parallel(inputdata, refdata, affine, n_workers=None, itk_threads=1, volume_groups=None, grid=None):
+    # Perform motion correction using ANTs, registering the volumes concurrently in a process pool
+    # Every volume is registered to the reference independently, exactly as done by ants.motion_correction
+    # (same transform, metric, intensity normalisation and interpolation), so the output is the same as the serial engine.
+    # No registration mask: ants.motion_correction(mask=None) only uses ants.get_mask(fixed) for the framewise displacement
+    # points, the registrations themselves run unmasked (mask=None).
+    # inputdata: 4D numpy array (x, y, z, t) of the ASL data
+    # refdata: 3D numpy array (x, y, z) of the reference image for motion correction
+    # affine: NIfTI affine of the data grid (same for input and reference)
+    # n_workers: number of worker processes, None -> all available cores / itk_threads
+    # itk_threads: number of ITK threads per worker process
+    # volume_groups: optional list of lists of volume indices sharing one transform, estimated on the
+    #                summed (high SNR) image of the group and applied to all its volumes. None -> one group per volume
+    # grid: optional (shape, affine, transformlist) of an output grid, the transforms mapping that grid to the reference are
+    #       composed with the motion transforms so each volume is resampled once onto the output grid. None -> reference grid
+    # Returns:
+    #   4D numpy array (x, y, z, t) of the motion-corrected data
+    nvolumes = inputdata.shape[3]
+    if volume_groups is None:
+        volume_groups = [[k] for k in range(nvolumes)]
+    n_workers = resolve_num_workers(n_workers, n_jobs=len(volume_groups), threads_per_worker=itk_threads)
+
+    logging.info(f"Perform motion correction (using ANTs, parallel): input: {nvolumes} volumes, reference: M0")
+    logging.info(f"Registering {len(volume_groups)} motion estimates for {nvolumes} volumes with {n_workers} worker processes x {itk_threads} ITK thread(s)")
+    start_time = time.time()
+
+    initargs = (np.asarray(refdata, dtype=np.float32), affine, itk_threads, grid)
+
+    output_shape = inputdata.shape if grid is None else (*grid[0][:3], nvolumes)
+    motion_corrected = np.zeros(output_shape, dtype=np.float64)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_spawn_context(),
+                             initializer=_init_motioncorrection_worker, initargs=initargs) as executor:
+        futures = [executor.submit(_register_volume_group, np.asarray(inputdata[..., group], dtype=np.float32)) for group in volume_groups]
+        for group, future in zip(volume_groups, futures):
+            motion_corrected[..., group] = future.result()
+
+    logging.info(f"Motion correction finished, this took: {round(time.time() - start_time, 2)} s")
+    return motion_corrected
+
+def _init_motioncorrection_worker(refdata, affine, itk_threads, grid=None):
+    # Worker initializer: limit ITK threads and keep the reference image (and output grid) for all volumes of this worker
+    set_itk_threads(itk_threads)
+    _worker_state['affine'] = affine
+    _worker_state['fixed'] = numpy_to_ants(refdata, affine)
+    if grid is None:
+        _worker_state['output_grid'] = _worker_state['fixed']
+        _worker_state['grid_transforms'] = []
+    else:
+        grid_shape, grid_affine, grid_transforms = grid
+        _worker_state['output_grid'] = numpy_to_ants(np.zeros(grid_shape[:3], dtype=np.float32), grid_affine)
+        _worker_state['grid_transforms'] = list(grid_transforms)
+
+def _register_volume_group(group_data):
+    # Register a group of volumes to the reference with one transform (runs in a worker process)
+    # group_data: 4D numpy array (x, y, z, volumes in group)
+    # The transform is estimated on the sum of the group's volumes (the volume itself for a group of one)
+    # Returns:
+    #   4D numpy array (x, y, z, volumes in group) of the resampled volumes, on the output grid
+    fixed = _worker_state['fixed']
+    affine = _worker_state['affine']
+    output_grid = _worker_state['output_grid']
+    grid_transforms = _worker_state['grid_transforms']
+    volumes = [numpy_to_ants(group_data[..., k], affine) for k in range(group_data.shape[3])]
+    moving = ants.iMath(numpy_to_ants(group_data.sum(axis=3), affine), 'Normalize')
+    if moving.numpy().var() == 0:
+        # empty volume: nothing to register, as in ants.motion_correction
+        warped = [ants.iMath(volume, 'Normalize') for volume in volumes]
+        if grid_transforms:
+            warped = [ants.apply_transforms(output_grid, volume, grid_transforms) for volume in warped]
+    else:
+        reg = ants.registration(fixed, moving, mask=None, **MOTIONCORRECTION_SETTINGS) # unmasked, as ants.motion_correction
+        # output grid -> reference (grid transforms) -> volume (motion transform), one interpolation
+        warped = [ants.apply_transforms(output_grid, volume, grid_transforms + reg['fwdtransforms']) for volume in volumes]
+    return np.stack([ants_to_numpy(volume) for volume in warped], axis=3)
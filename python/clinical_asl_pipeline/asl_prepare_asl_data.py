@@ -50,6 +50,7 @@ def asl_prepare_asl_data(subject, context_tag):
         # Reverse the scaling to get raw data,  as nibabel nib.load.get_fdata consumes the slope and intercept: scaled = raw*slope + intercept 
         raw = (img.get_fdata() - intercept) / slope
         M0ASL_allPLD = raw 
+        context_data['affine'] = img.affine # affine of the data grid, used to hand data in memory to ANTs
         M0ASL_allPLD_shape = M0ASL_allPLD.shape
 
         logging.info(f"SOURCE NIFTI: {nifti_path}")    
@@ -62,15 +63,18 @@ def asl_prepare_asl_data(subject, context_tag):
         # ASL_controllabel_allPLD is 5D numpy array (x, y, z,  NREPEATS x control/label, NPLDS) with interleaved control label volumes -> fed to QASL analysis
         context_data['ASL_controllabel_allPLD'] = np.zeros((*M0ASL_allPLD_shape[:3], NREPEATS * 2, NPLDS))
 
-        # Split control/label, store in array, apply Look Locker correction
-        LookLocker_correction_factor_perPLD =  context_data['LookLocker_correction_factor_perPLD']
+        # Split control/label, store in array, apply Look Locker correction per slice and PLD (NSLICES x NPLDS)
+        LookLocker_correction_factor_perslice = context_data['LookLocker_correction_factor_perslice']
+        if LookLocker_correction_factor_perslice.shape[0] != M0ASL_allPLD_shape[2]:
+            raise ValueError(f"Look-Locker correction factors for {LookLocker_correction_factor_perslice.shape[0]} slices, data has {M0ASL_allPLD_shape[2]} slices")
         for i in range(NPLDS):
             # slice object to index array, to extract control and label volumes sorted per PLD and DYNAMIC
             idx_label = slice(i, NPLDS * NDYNS * 2, 2 * NPLDS)
             idx_control = slice(i + NPLDS, NPLDS * NDYNS * 2, 2 * NPLDS)
-            #  extract control and label volumes sorted and store in M0ASL_allPLD [x, y , z, NDYNS, NPLDS, control/label], apply Look Locker correction for each PLD
-            context_data['M0ASL_allPLD'][:, :, :, :NDYNS, i, 0] = M0ASL_allPLD[:, :, :, idx_control] / LookLocker_correction_factor_perPLD[i]
-            context_data['M0ASL_allPLD'][:, :, :, :NDYNS, i, 1] = M0ASL_allPLD[:, :, :, idx_label] / LookLocker_correction_factor_perPLD[i]
+            LookLocker_correction_factor = LookLocker_correction_factor_perslice[None, None, :, i, None]  # broadcast over x, y, dynamics
+            #  extract control and label volumes sorted and store in M0ASL_allPLD [x, y , z, NDYNS, NPLDS, control/label], apply Look Locker correction for each slice and PLD
+            context_data['M0ASL_allPLD'][:, :, :, :NDYNS, i, 0] = M0ASL_allPLD[:, :, :, idx_control] / LookLocker_correction_factor
+            context_data['M0ASL_allPLD'][:, :, :, :NDYNS, i, 1] = M0ASL_allPLD[:, :, :, idx_label] / LookLocker_correction_factor
 
         # M0 image construction
         context_data['M0_allPLD'] = np.mean(context_data['M0ASL_allPLD'][:, :, :, 0, :, :], axis=4)
@@ -91,18 +95,13 @@ def asl_prepare_asl_data(subject, context_tag):
         # Now reshape so time dimension becomes interleaved PLDs
         reordered_shape = reordered.shape    
         PLDall = reordered.reshape(*reordered_shape[:3], NPLDS * NREPEATS * 2)
-        PLD2tolast = PLDall[:, :, :, NREPEATS*2: ]
-        PLD1to2 = PLDall[:, :, :, 0:NREPEATS*2*2]
+        context_data['PLDall_controllabel'] = PLDall # kept in memory for motion correction, PLD subsets are views on it (utils/pld_subsets.py)
 
         # Save data to nifti
         logging.info("Saving ASL data interleaved label control: all PLDs for AAT")
-        logging.info("Saving ASL data interleaved label control: 2-to-last PLDs for CBF")
-        logging.info("Saving ASL data interleaved label control: 1-to-2 PLDs for ATA")
         logging.info("Saving M0 image")
 
         save_data_nifti(PLDall, context_data['PLDall_controllabel_path'], context_data['sourceNIFTI_path'], 1, None, None)    
-        save_data_nifti(PLD2tolast, context_data['PLD2tolast_controllabel_path'], context_data['sourceNIFTI_path'], 1, None, None)
-        save_data_nifti(PLD1to2, context_data['PLD1to2_controllabel_path'], context_data['sourceNIFTI_path'], 1, None, None)
         save_data_nifti(context_data['M0'], context_data['M0_path'] , context_data['sourceNIFTI_path'], 1, None, None)
 
     elif subject['ASL scan'] == 'multi-delay variable-TR':
@@ -117,6 +116,8 @@ def asl_prepare_asl_data(subject, context_tag):
         # Reverse the scaling to get raw data,  as nibabel nib.load.get_fdata consumes the slope and intercept: scaled = raw*slope + intercept 
         raw = (img.get_fdata() - intercept) / slope
         context_data['ASL_controllabel_allPLD'] = raw
+        context_data['PLDall_controllabel'] = raw # kept in memory for motion correction
+        context_data['affine'] = img.affine # affine of the data grid, used to hand data in memory to ANTs
 
         img_m0 = nib.load(nifti_m0_path)
         slope_m0 = 1.0
@@ -133,4 +134,10 @@ def asl_prepare_asl_data(subject, context_tag):
         save_data_nifti(context_data['ASL_controllabel_allPLD'] , context_data['PLDall_controllabel_path'], context_data['sourceNIFTI_path'], 'samescaling', None, None)  
         save_data_nifti(context_data['M0'], context_data['M0_path'] , context_data['sourceNIFTI_M0_path'], 'samescaling', None, None)
 
+    # Working grid of the ASL data, M0 and mask used for quantification: the native grid, unless the stimulus data are
+    # resampled onto the baseline grid (single resampling, see asl_registration_stimulus_to_baseline_grid)
+    context_data['gridNIFTI_path'] = context_data['sourceNIFTI_path']
+    context_data['gridM0_path'] = context_data['M0_path']
+    context_data['gridmask_path'] = context_data['mask_path']
+
     return subject
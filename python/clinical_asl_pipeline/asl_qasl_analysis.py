@@ -10,15 +10,38 @@ Algorithm code author: Thomas Kirk, Quantified Imaging
 
 Description:
     Performs QASL - by Quantified Imaging (T.Kirk) (Quantitative Arterial Spin Labeling) analysis on ASL data using the Oxford ASL toolbox.
-    This script provides the asl_qasl_analysis() function, which builds and runs a command-line call to the QASL tool,
-    passing all relevant parameters for quantification.
+    This script provides the asl_qasl_analysis() function, which builds the QASL arguments, passing all relevant
+    parameters for quantification, and runs QASL either in-process (the qasl console script function imported once and
+    called with the same command line arguments and files, saving only the interpreter start-up and imports per fit) or
+    as a command-line call (fallback).
+    With nslabs > 1 the volume is split into slabs of slices, fitted by concurrent single-threaded QASL processes and
+    stitched back together (voxelwise fits; with the spatial prior of ssvb the slabs overlap by halo slices).
 
 License: BSD 3-Clause License
 """
 
+import os
+import sys
 import time
+import shlex
+import shutil
 import logging
+import threading
+import subprocess
+import nibabel as nib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import entry_points
 from clinical_asl_pipeline.utils.run_command_with_logging import run_command_with_logging
+from clinical_asl_pipeline.asl_m0_calibration import asl_apply_m0_calibration
+from clinical_asl_pipeline.asl_kinetic_fit import asl_kinetic_fit
+from clinical_asl_pipeline.utils.slabs import slab_ranges, write_slab, stitch_slabs
+
+# Halo slices on both sides of a slab for the spatial prior of ssvb (voxelwise vaby: no halo)
+SSVB_HALO_SLICES = 2
+
+# One in-process QASL run at a time: the console script function reads its arguments from the process-wide sys.argv
+QASL_INPROCESS_LOCK = threading.Lock()
 
 def asl_qasl_analysis(
     subject,
@@ -31,6 +54,10 @@ def asl_qasl_analysis(
     tau_list,
     inference_method='ssvb', # or vaby, for BASIL-like output
     artoff=None,
+    backend='cli',
+    location_calib=None,
+    nslabs=1,
+    threads=4,
 ):
     # Perform QASL analysis on ASL data using the Oxford ASL toolbox.
     # Parameters:
@@ -50,10 +77,29 @@ def asl_qasl_analysis(
     # tau_list: list of bolus durations (tau) in seconds
     # inference_method: inference method for QASL ('ssvb' or 'vaby')
     # artoff: optional, set to 'artoff' to disable arterial component modeling
+    # backend: 'inprocess' runs the qasl console script function in this interpreter with the same arguments and files
+    #          as the command line tool, saving only the interpreter start-up and imports per fit (QASL still reads the
+    #          files and calibrates); the fits are serialized by QASL_INPROCESS_LOCK (sys.argv is process-wide)
+    #          'cli' runs the qasl command line tool (the default); 'inprocess' falls back to 'cli' when QASL cannot be imported.
+    #          'native' fits the kinetic model in-package (asl_kinetic_fit, no arterial component), same output files
+    # location_calib: optional path to the precomputed voxelwise calibration M0 of this context (asl_m0_calibration),
+    #                 QASL then fits uncalibrated (no -c, no calibration registration) and the perfusion is calibrated afterwards
+    # nslabs: number of slabs of slices fitted concurrently by single-threaded QASL processes (1: one QASL run)
+    # threads: number of threads of the QASL run
     #
-    # This function builds and runs a command-line call to the QASL tool,
-    # passing all relevant parameters for quantification. It times the execution,
-    # prints progress messages, and ensures the command is run with error checking.    
+    # This function builds the QASL arguments, passing all relevant parameters for quantification,
+    # and runs QASL. It times the execution, prints progress messages, and ensures QASL is run with error checking.
+    # Both backends take the same arguments and write the same output files in output_map.
+
+    if backend == 'native':
+        asl_kinetic_fit(subject, ANALYSIS_PARAMETERS, location_asl_controllabel_pld_nifti, location_m0, location_mask,
+                        output_map, pld_list, tau_list, artoff, location_calib)
+        return
+
+    if nslabs > 1:
+        asl_qasl_slab_analysis(subject, ANALYSIS_PARAMETERS, location_asl_controllabel_pld_nifti, location_m0, location_mask,
+                               output_map, pld_list, tau_list, inference_method, artoff, location_calib, nslabs)
+        return
 
     # Generate comma-separated PLD string
     pld_string = ",".join([f"{pld:.5g}" for pld in pld_list])
@@ -64,7 +110,7 @@ def asl_qasl_analysis(
     tau_string = ",".join([f"{tau:.5g}" for tau in tau_list])
 
     # Arterial component off (optional)
-    artoff_string = " --artoff" if artoff == "artoff" else ""
+    artoff_arguments = ["--artoff"] if artoff == "artoff" else []
 
     # Extract parameter values and convert to string
     T1t = str(ANALYSIS_PARAMETERS['T1t'])
@@ -76,66 +122,151 @@ def asl_qasl_analysis(
     # Timing the execution
     start_time = time.time()
 
-    # Build qasl command
+    # Build qasl arguments
     if subject['ASL scan'] == 'multi-delay Look-Locker':
-        cmd = (
-            f"qasl -i {location_asl_controllabel_pld_nifti} "
-            f"-c {location_m0} "
-            f"-m {location_mask} "
-            f"-o {output_map} "
-            f"--inference-method={inference_method} "
-            f"{artoff_string} "
-            f"--bolus={tau_string} "
-            f"--slicedt={slicetime} "
-            f"--t1={T1t} "
-            f"--t1b={T1b} "
-            f"--t1t={T1t} "
-            f"--plds={pld_string} "
-            f"--tr={TR_M0} "
-            f"--alpha={alpha} "
-            f"--iaf=tc "
-            f"--ibf=tis "
-            f"--casl "
-            f"--cgain 1.00 "
-            f"--calib-aslreg "
-            f"--biascorr-method=none "
-            f"--readout={readout} "
-            f"--save-calib "
-            f"--overwrite "
-            f"--threads=4"
-        )
+        timing_arguments = [f"--bolus={tau_string}", f"--slicedt={slicetime}"]
+        iaf = "tc"
     elif subject['ASL scan'] == 'multi-delay variable-TR':
-                cmd = (
-            f"qasl -i {location_asl_controllabel_pld_nifti} "
-            f"-c {location_m0} "
-            f"-m {location_mask} "
-            f"-o {output_map} "
-            f"--inference-method={inference_method} "
-            f"{artoff_string} "
-            f"--bolus={tau_string} "
-            f"--t1={T1t} "
-            f"--t1b={T1b} "
-            f"--t1t={T1t} "
-            f"--plds={pld_string} "
-            f"--tr={TR_M0} "
-            f"--alpha={alpha} "
-            f"--iaf=ct "
-            f"--ibf=tis "
-            f"--casl "
-            f"--cgain 1.00 "
-            f"--calib-aslreg "
-            f"--biascorr-method=none "
-            f"--readout={readout} "
-            f"--save-calib "
-            f"--overwrite "
-            f"--threads=4"
-        )
-
-
-    # Run command
+        timing_arguments = [f"--bolus={tau_string}"]
+        iaf = "ct"
+    else:
+        raise ValueError(f"Unsupported ASL scan for QASL: '{subject['ASL scan']}'")
+
+    # calibration by QASL (M0 registered to the ASL data, voxelwise M0), or precomputed once per context
+    if location_calib is None:
+        calibration_arguments = ["-c", location_m0, f"--tr={TR_M0}", "--cgain", "1.00", "--calib-aslreg", "--save-calib"]
+    else:
+        calibration_arguments = []
+
+    arguments = [
+        "-i", location_asl_controllabel_pld_nifti,
+        *calibration_arguments,
+        "-m", location_mask,
+        "-o", output_map,
+        f"--inference-method={inference_method}",
+        *artoff_arguments,
+        *timing_arguments,
+        f"--t1={T1t}",
+        f"--t1b={T1b}",
+        f"--t1t={T1t}",
+        f"--plds={pld_string}",
+        f"--alpha={alpha}",
+        f"--iaf={iaf}",
+        "--ibf=tis",
+        "--casl",
+        "--biascorr-method=none",
+        f"--readout={readout}",
+        "--overwrite",
+        f"--threads={threads}",
+    ]
+
+    if backend not in ('inprocess', 'cli'):
+        raise ValueError(f"Unknown qasl_backend: '{backend}', use 'inprocess', 'cli' or 'native'")
+    qasl_main = load_qasl_main() if backend == 'inprocess' else None
+    if backend == 'inprocess' and qasl_main is None:
+        logging.warning("QASL could not be imported in-process, falling back to the qasl command line tool")
+
+    # Run QASL
     logging.info("Running QASL analysis...")
-    run_command_with_logging(cmd)
+    if qasl_main is not None:
+        run_qasl_inprocess(qasl_main, arguments)
+    else:
+        run_command_with_logging(shlex.join(["qasl", *arguments]))
+
+    if location_calib is not None:
+        asl_apply_m0_calibration(output_map, location_calib, float(alpha))
 
     logging.info("QASL analysis finished")
     elapsed = round(time.time() - start_time, 2)
     logging.info(f"..this took: {elapsed} s")
+
+def asl_qasl_slab_analysis(
+    subject,
+    ANALYSIS_PARAMETERS,
+    location_asl_controllabel_pld_nifti,
+    location_m0,
+    location_mask,
+    output_map,
+    pld_list,
+    tau_list,
+    inference_method,
+    artoff,
+    location_calib,
+    nslabs,
+):
+    # QASL analysis in slabs of slices: one single-threaded QASL process (command line) per slab, run concurrently,
+    # the output/ files of the slabs stitched into output_map (same files as one QASL run)
+    # Parameters as asl_qasl_analysis. The slabs are balanced by the number of brain voxels; with ssvb (spatial prior)
+    # every slab is extended by SSVB_HALO_SLICES on both sides, which are trimmed when stitching.
+    # 2D Look-Locker readout: QASL counts the slice timing from the first slice of its input, so the PLDs of a slab
+    # are shifted by the slice timing of its first slice.
+    start_time = time.time()
+    halo = SSVB_HALO_SLICES if inference_method == 'ssvb' else 0
+    ranges = slab_ranges(nib.load(location_mask).get_fdata(), nslabs, halo)
+    slabs_map = os.path.join(output_map, 'slabs')
+    os.makedirs(slabs_map, exist_ok=True)
+    logging.info(f"QASL in {len(ranges)} slabs of slices {[(start, stop) for start, stop, _, _ in ranges]} (halo {halo}), one thread each")
+
+    def run_slab(index, start, stop):
+        slab_map = os.path.join(slabs_map, f'slab{index}')
+        os.makedirs(slab_map, exist_ok=True)
+
+        def slab_input(location, name):
+            return write_slab(location, os.path.join(slab_map, f'{name}.nii'), start, stop) if location is not None else None
+
+        slab_plds = list(pld_list)
+        if subject['ASL scan'] == 'multi-delay Look-Locker':
+            slab_plds = [pld + start * subject['slicetime'] / 1000 for pld in pld_list]
+        asl_qasl_analysis(subject, ANALYSIS_PARAMETERS,
+                          slab_input(location_asl_controllabel_pld_nifti, 'asl'),
+                          slab_input(location_m0, 'm0'),
+                          slab_input(location_mask, 'mask'),
+                          slab_map, slab_plds, tau_list, inference_method, artoff,
+                          backend='cli',
+                          location_calib=slab_input(location_calib, 'calib'),
+                          threads=1)
+        return slab_map
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(run_slab, index, start, stop) for index, (start, stop, _, _) in enumerate(ranges)]
+        slab_maps = [future.result() for future in futures]
+
+    stitched = stitch_slabs(slab_maps, ranges, output_map, location_mask, relative_path='output')
+    shutil.rmtree(slabs_map)
+    logging.info(f"QASL slabs stitched: {len(stitched)} output files in {output_map}")
+    logging.info(f"..this took: {round(time.time() - start_time, 2)} s")
+
+@lru_cache(maxsize=None)
+def load_qasl_main():
+    # Import QASL once per process: the function behind the 'qasl' console script (the command line tool)
+    # Returns:
+    #   callable QASL main, or None when QASL is not installed in this Python environment
+    matches = [entry_point for entry_point in entry_points(group='console_scripts') if entry_point.name == 'qasl']
+    if not matches:
+        return None
+    try:
+        qasl_main = matches[0].load()
+    except ImportError as e:
+        logging.warning(f"Importing QASL failed: {e}")
+        return None
+    logging.info(f"QASL loaded in-process from {matches[0].value}")
+    return qasl_main
+
+def run_qasl_inprocess(qasl_main, arguments):
+    # Run QASL in this interpreter with the command line arguments (as the console script would), with error checking
+    # qasl_main reads its arguments from sys.argv, which is restored afterwards; concurrent calls (threads) wait for
+    # QASL_INPROCESS_LOCK, the data are passed as files as for the command line tool
+    logging.info(f"Running QASL in-process: qasl {shlex.join(arguments)}")
+    with QASL_INPROCESS_LOCK:
+        saved_argv = sys.argv
+        sys.argv = ["qasl", *arguments]
+        try:
+            retcode = qasl_main()
+        except SystemExit as e:
+            retcode = e.code
+        finally:
+            sys.argv = saved_argv
+
+    # the console script exit code: None or 0 is success
+    if retcode not in (None, 0):
+        raise subprocess.CalledProcessError(retcode if isinstance(retcode, int) else 1, ["qasl", *arguments])
@@ -16,62 +16,153 @@ License: BSD 3-Clause License
 """
 
 import os
+import time
+import tempfile
+import json
 import logging
 import shutil
 import ants
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from clinical_asl_pipeline.utils.ants_image import numpy_to_ants, ants_to_numpy
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Registration settings of the M0 stimulus to baseline registration, per registration_mode
+# 'standard': the original rigid registration, centre of mass of the full images as initial transform
+#             (note: ANTsPy uses aff_iterations for 'Rigid', i.e. (2100, 1200, 1200, 10) at shrink factors 6x4x2x1, reg_iterations is not used)
+# 'fast': centre of mass of the brain masked M0s as initial transform, metric restricted to the brain masks and a
+#         shorter pyramid; the iterations are an upper bound, antsRegistration stops each level on its default convergence
+#         criterion (ANTsPy does not pass a convergence threshold or window for 'Rigid')
+#         Not the default: the benchmark (benchmarks/benchmark_registration_stimulus_to_baseline.py) shows no consistent accuracy gain
+REGISTRATION_SETTINGS = {
+    'standard': {
+        'type_of_transform': 'Rigid',
+        'metric': 'Mattes',
+        'reg_iterations': (1000, 500, 250, 100),
+    },
+    'fast': {
+        'type_of_transform': 'Rigid',
+        'aff_metric': 'mattes',
+        'aff_sampling': 32,
+        'aff_random_sampling_rate': 0.25,
+        'aff_iterations': (200, 100, 50),
+        'aff_shrink_factors': (4, 2, 1),
+        'aff_smoothing_sigmas': (2, 1, 0),
+    },
+}
 
 def asl_registration_stimulus_to_baseline(subject):
     # Register post-ACZ ASL data to pre-ACZ ASL data using ANTsPy
     # subject is a dictionary containing paths to the necessary files.
     # The dictionary should contain the following keys:
     # 'baseline': {
-    #     'M0_path', 'CBF_path', 'AAT_path', 'ATA_path', 'mask_path'
+    #     'M0', 'affine', 'QASL_CBF_path', 'QASL_AAT_path', 'QASL_ATA_path', 'mask', 'gridNIFTI_path'
     # },
     # 'stimulus': {
-    #     'M0_path', 'CBF_path', 'AAT_path', 'ATA_path', 'mask_path',
+    #     'M0', 'affine', 'QASL_CBF_path', 'QASL_AAT_path', 'QASL_ATA_path', 'mask',
     #     'M0_2baseline_path', 'CBF_2baseline_path', 'AAT_2baseline_path',
     #     'ATA_2baseline_path', 'mask_2baseline_path'
     # },
     # 'ASLdir'
-    # resulting transform will be saved in 'ASLdir' as 'rigid_stimulus_to_baseline.mat'
+    # M0 and mask are taken from memory, the QASL maps are read once; the registered images are kept in memory
+    # ('M0_2baseline', 'CBF_2baseline', ...) for saving the results, and saved as NIfTI.
+    # resulting transform will be saved in 'ASLdir' as 'rigid_stimulus_to_baseline.mat',
+    # the registration mode and parameters used as 'rigid_stimulus_to_baseline.json'
+    # With single resampling (asl_registration_stimulus_to_baseline_grid ran before motion correction) the stimulus
+    # maps were quantified on the baseline grid already: they are taken over as '*_2baseline' without a second warp.
+
+    baseline = subject['baseline']
+    stimulus = subject['stimulus']
+    template_path = baseline['gridNIFTI_path']
+    interpolator = 'bSpline'
+
+    map_paths = {'CBF_2baseline': stimulus['QASL_CBF_path'], 'AAT_2baseline': stimulus['QASL_AAT_path']}
+    if subject['dicom_typetags_by_context']['baseline'].__contains__('ATA'): # only if ATA is present in baseline, e.g. ATA not yet generated for vTR data
+        map_paths['ATA_2baseline'] = stimulus['QASL_ATA_path']
+
+    if stimulus.get('grid_transforms'):
+        logging.info("Single resampling: stimulus maps quantified on the baseline grid, no registration to baseline needed")
+        for output_key, path in map_paths.items():
+            stimulus[output_key] = nib.load(path).get_fdata()
+            save_data_nifti(stimulus[output_key], stimulus[f'{output_key}_path'], template_path, 1, None, None)
+        return
+
+    fixed, reg = asl_register_m0_stimulus_to_baseline(subject)
+
+    # Apply same transform to CBF, AAT, ATA (bSpline) and mask (NearestNeighbor interpolation)
+    # reference grid: the baseline QASL maps share the grid of the baseline M0, so the fixed image is reused
+    def load_map(path):
+        img = nib.load(path)
+        return img.get_fdata(), img.affine
+
+    images = {output_key: (*load_map(path), interpolator) for output_key, path in map_paths.items()}
+    images['mask_2baseline'] = (stimulus['mask'], stimulus['affine'], 'nearestNeighbor')
+
+    logging.info(f"Registration {', '.join(key.replace('_2baseline', '') for key in images)} stimulus to baseline (ANTsPy)")
+    warped = apply_transforms_to_images(fixed, images, reg['fwdtransforms'], stack=subject.get('stack_resampled_maps', True))
+    for output_key, data in warped.items():
+        stimulus[output_key] = data
+        save_data_nifti(data, stimulus[f'{output_key}_path'], template_path, 1, None, None)
+
+def asl_registration_stimulus_to_baseline_grid(subject):
+    # Single resampling path: estimate the stimulus to baseline transform before motion correction of the stimulus data.
+    # Motion correction then composes it with the per-volume motion transforms and resamples the stimulus ASL series
+    # straight onto the baseline grid in one pass; quantification runs on the baseline grid with the registered M0 and mask.
+    # Sets in subject['stimulus']:
+    #   'M0_2baseline', 'mask_2baseline': registered M0 and brain mask (also saved as NIfTI), 'gridM0_path', 'gridmask_path' to these
+    #   'grid_transforms': transform list stimulus to baseline, 'grid_shape', 'grid_affine', 'gridNIFTI_path', 'grid_crop': the baseline grid
+    # Not for a 2D readout: the slices resampled onto the baseline grid no longer match the slice timing of the readout
+    # (QASL --slicedt, Look-Locker slice timing), single resampling is switched off and the standard registration is used.
+    baseline = subject['baseline']
+    stimulus = subject['stimulus']
+
+    if subject.get('readout') == '2D':
+        logging.warning("Single resampling is not supported for a 2D readout (slice timing), "
+                        "the stimulus maps are registered to baseline after quantification")
+        subject['single_resampling'] = False
+        return subject
+
+    fixed, reg = asl_register_m0_stimulus_to_baseline(subject)
+
+    logging.info("Registration mask stimulus to baseline (ANTsPy)")
+    images = {'mask_2baseline': (stimulus['mask'], stimulus['affine'], 'nearestNeighbor')}
+    stimulus['mask_2baseline'] = apply_transforms_to_images(fixed, images, reg['fwdtransforms'])['mask_2baseline']
+    save_data_nifti(stimulus['mask_2baseline'], stimulus['mask_2baseline_path'], baseline['gridNIFTI_path'], 1, None, None)
+
+    stimulus['grid_transforms'] = [stimulus['transform_2baseline_path']]
+    stimulus['grid_shape'] = baseline['M0'].shape
+    stimulus['grid_affine'] = baseline['affine']
+    stimulus['gridNIFTI_path'] = baseline['gridNIFTI_path']
+    stimulus['grid_crop'] = baseline.get('grid_crop')
+    stimulus['gridM0_path'] = stimulus['M0_2baseline_path']
+    stimulus['gridmask_path'] = stimulus['mask_2baseline_path']
+    logging.info("Single resampling: stimulus ASL data will be motion corrected and resampled onto the baseline grid in one pass")
+    return subject
+
+def asl_register_m0_stimulus_to_baseline(subject):
+    # Rigid registration of the stimulus M0 to the baseline M0 (registration_mode from the config)
+    # Saves the registered M0 ('M0_2baseline'), the transform in 'ASLdir' as 'rigid_stimulus_to_baseline.mat'
+    # (path in subject['stimulus']['transform_2baseline_path']) and the registration parameters as 'rigid_stimulus_to_baseline.json'
+    # Returns:
+    #   fixed: ANTs image of the baseline M0 (the baseline grid), reg: the ants.registration result
+    baseline = subject['baseline']
+    stimulus = subject['stimulus']
 
     # Load fixed and moving images for registration
     logging.info("Registration M0 stimulus to baseline data (ANTsPy) *********************************************************************")
 
-    fixed = ants.image_read(subject['baseline']['M0_path'])
-    moving = ants.image_read(subject['stimulus']['M0_path'])
+    fixed = numpy_to_ants(baseline['M0'], baseline['affine'])
+    moving = numpy_to_ants(stimulus['M0'], stimulus['affine'])
     
     # Run registration
-    reg = ants.registration(fixed=fixed, moving=moving, type_of_transform='Rigid', metric='Mattes', reg_iterations=(1000, 500, 250, 100)) 
-    interpolator = 'bSpline'
+    mode = subject.get('registration_mode', 'standard')
+    reg, registration_parameters = register_m0(fixed, moving, mode,
+                                               fixed_mask=numpy_to_ants(baseline['mask'], baseline['affine']),
+                                               moving_mask=numpy_to_ants(stimulus['mask'], stimulus['affine']))
     # Save transformed moving image
-    ants.image_write(reg['warpedmovout'], subject['stimulus']['M0_2baseline_path'])
-
-    # Apply same transform to CBF, AAT, ATA, mask
-    def apply_transform(moving_path, reference_path, output_path, transformlist, interpolation):
-        moving_img = ants.image_read(moving_path)
-        reference_img = ants.image_read(reference_path)
-        warped = ants.apply_transforms(fixed=reference_img, moving=moving_img,
-                                        transformlist=transformlist,
-                                        interpolator=interpolation)
-        ants.image_write(warped, output_path)
-
-    # CBF
-    logging.info("Registration CBF stimulus to baseline (ANTsPy)")
-    apply_transform(subject['stimulus']['QASL_CBF_path'], subject['baseline']['QASL_CBF_path'], subject['stimulus']['CBF_2baseline_path'], reg['fwdtransforms'], interpolator)
-
-    # AAT
-    logging.info("Registration AAT stimulus to baseline (ANTsPy)")
-    apply_transform(subject['stimulus']['QASL_AAT_path'], subject['baseline']['QASL_AAT_path'], subject['stimulus']['AAT_2baseline_path'], reg['fwdtransforms'], interpolator)
-
-    # ATA
-    if subject['dicom_typetags_by_context']['baseline'].__contains__('ATA'): # only if ATA is present in baseline, e.g. ATA not yet generated for vTR data
-        logging.info("Registration ATA stimulus to baseline (ANTsPy)")
-        apply_transform(subject['stimulus']['QASL_ATA_path'], subject['baseline']['QASL_ATA_path'], subject['stimulus']['ATA_2baseline_path'], reg['fwdtransforms'], interpolator)
-
-    # Mask (NearestNeighbor interpolation)
-    logging.info("Registration mask stimulus to baseline (ANTsPy)")
-    apply_transform(subject['stimulus']['mask_path'], subject['baseline']['mask_path'], subject['stimulus']['mask_2baseline_path'], reg['fwdtransforms'], 'nearestNeighbor')
+    stimulus['M0_2baseline'] = ants_to_numpy(reg['warpedmovout'])
+    save_data_nifti(stimulus['M0_2baseline'], stimulus['M0_2baseline_path'], baseline['gridNIFTI_path'], 1, None, None)
 
     transform_path = reg['fwdtransforms'][0]
 
@@ -79,4 +170,81 @@ def asl_registration_stimulus_to_baseline(subject):
     output_transform_path = os.path.join(subject['ASLdir'], 'rigid_stimulus_to_baseline.mat')
 
     # Copy it to save location
-    shutil.copy(transform_path, output_transform_path)
\ No newline at end of file
+    shutil.copy(transform_path, output_transform_path)
+    stimulus['transform_2baseline_path'] = output_transform_path
+
+    # Save the registration mode and parameters next to the transform
+    with open(os.path.splitext(output_transform_path)[0] + '.json', 'w') as f:
+        json.dump(registration_parameters, f, indent=2)
+
+    return fixed, reg
+
+def apply_transforms_to_images(reference, images, transformlist, stack=True):
+    # Resample images onto the reference grid with the same transform(s), concurrently in threads
+    # reference: ANTs image defining the output grid
+    # images: dict output_key -> (3D numpy array, NIfTI affine, interpolator)
+    # transformlist: list of transform files, as from ants.registration 'fwdtransforms'
+    # stack: stack the images that share interpolator and grid into one 4D (multi-component) image,
+    #        resampled as time series in a single ITK pass (spline coefficients and transform evaluated once per voxel)
+    # Returns:
+    #   dict output_key -> resampled 3D numpy array on the reference grid
+    jobs = []
+    for key, (data, affine, interpolator) in images.items():
+        job = next((job for job in jobs if stack and job['interpolator'] == interpolator and np.allclose(job['affine'], affine)), None)
+        if job is None:
+            jobs.append({'keys': [key], 'affine': affine, 'interpolator': interpolator})
+        else:
+            job['keys'].append(key)
+
+    def run_job(job):
+        if len(job['keys']) == 1:
+            moving = numpy_to_ants(images[job['keys'][0]][0], job['affine'])
+            warped = ants.apply_transforms(fixed=reference, moving=moving, transformlist=transformlist,
+                                           interpolator=job['interpolator'])
+            return {job['keys'][0]: ants_to_numpy(warped)}
+        moving = numpy_to_ants(np.stack([images[key][0] for key in job['keys']], axis=3), job['affine'])
+        warped = ants_to_numpy(ants.apply_transforms(fixed=reference, moving=moving, transformlist=transformlist,
+                                                     interpolator=job['interpolator'], imagetype=3))
+        return {key: warped[..., k] for k, key in enumerate(job['keys'])}
+
+    warped = {}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        for result in executor.map(run_job, jobs):
+            warped.update(result)
+    return {key: warped[key] for key in images}
+
+def register_m0(fixed, moving, mode='standard', fixed_mask=None, moving_mask=None):
+    # Rigid registration of the moving M0 to the fixed M0 with the settings of REGISTRATION_SETTINGS[mode]
+    # fixed, moving: ANTs images of the baseline and stimulus M0
+    # mode: 'standard' or 'fast'
+    # fixed_mask, moving_mask: ANTs brain masks of the fixed and moving M0, used by 'fast' only
+    # Returns:
+    #   reg: the ants.registration result
+    #   registration_parameters: dict with the mode, the registration parameters, initial translation (mm) and runtime (s)
+    if mode not in REGISTRATION_SETTINGS:
+        raise ValueError(f"Unknown registration_mode: '{mode}', use one of {list(REGISTRATION_SETTINGS)}")
+    settings = dict(REGISTRATION_SETTINGS[mode])
+    registration_parameters = {'registration_mode': mode, **settings}
+
+    # the initial transform file only lives for the registration
+    with tempfile.TemporaryDirectory() as transform_dir:
+        start_time = time.time()
+        if mode == 'fast':
+            # initial transform: translation that aligns the centres of mass of the brain masked M0s
+            fixed_mask = ants.threshold_image(fixed_mask, 0.5, None)
+            moving_mask = ants.threshold_image(moving_mask, 0.5, None)
+            translation = (np.array(ants.get_center_of_mass(moving * moving_mask)) -
+                           np.array(ants.get_center_of_mass(fixed * fixed_mask)))
+            initial_transform = ants.create_ants_transform(transform_type='Euler3DTransform', dimension=3, translation=tuple(translation))
+            initial_transform_path = os.path.join(transform_dir, 'initial_transform.mat')
+            ants.write_transform(initial_transform, initial_transform_path)
+            settings.update(initial_transform=[initial_transform_path], mask=fixed_mask, moving_mask=moving_mask)
+            registration_parameters['initial_transform'] = 'centre of mass of brain masked M0'
+            registration_parameters['initial_translation_mm'] = [round(float(t), 3) for t in translation]
+            registration_parameters['metric_mask'] = 'baseline and stimulus brain masks'
+
+        reg = ants.registration(fixed=fixed, moving=moving, **settings)
+    registration_parameters['runtime_s'] = round(time.time() - start_time, 2)
+
+    logging.info(f"Registration mode '{mode}', parameters: {json.dumps(registration_parameters)}")
+    return reg, registration_parameters
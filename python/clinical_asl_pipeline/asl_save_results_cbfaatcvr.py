@@ -22,7 +22,8 @@ Description:
         * NIfTI: for quantitative analysis and further processing.
         * DICOM: for clinical PACS integration, using appropriate tags and templates.
         * PNG: for quick visualization and quality control.
-    - Modular helper functions are used for saving in each format, with logging for traceability.
+    - Modular helper functions build the export jobs for each format, the jobs run concurrently (threads for the file
+      writes, worker processes for the matplotlib figures), with a per-job timing summary in the log for traceability.
 
     This script is intended to be called as part of the ClinicalASL pipeline after ASL quantification
     and registration steps are complete.
@@ -31,47 +32,69 @@ License: BSD 3-Clause License
 """
 
 import os
+import time
 import logging
 import numpy as np
 import nibabel as nib
 from pydicom.uid import generate_uid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from clinical_asl_pipeline.asl_smooth_image import asl_smooth_image
+from clinical_asl_pipeline.asl_crop_to_brain import pad_to_source, recrop
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
 from clinical_asl_pipeline.utils.save_figure_to_png import save_figure_to_png
 from clinical_asl_pipeline.utils.save_png_to_dicom import save_png_to_dicom  
 from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
-from clinical_asl_pipeline.utils.save_data_dicom_grayscale import save_data_dicom as save_data_dicom_grayscale
-from clinical_asl_pipeline.utils.save_data_dicom_color import save_data_dicom as save_data_dicom_color
+from clinical_asl_pipeline.utils.save_data_dicom import save_data_dicom
+from clinical_asl_pipeline.utils.parallel_workers import resolve_num_workers, get_spawn_context, start_worker_log_listener, init_worker_logging
 
 def asl_save_results_cbfaatcvr(subject):
+    # === Helper: registered stimulus data are handed over in memory by the registration step, else read from disk ===
+    def get_registered(key):
+        if subject['stimulus'].get(key) is None:
+            subject['stimulus'][key] = nib.load(subject['stimulus'][f'{key}_path']).get_fdata()
+        return subject['stimulus'][key]
+
     # === Load data ===
     subject['baseline']['CBF'] = nib.load(subject['baseline']['QASL_CBF_path']).get_fdata()
     subject['stimulus']['CBF'] = nib.load(subject['stimulus']['QASL_CBF_path']).get_fdata()
-    subject['stimulus']['CBF_2baseline'] = nib.load(subject['stimulus']['CBF_2baseline_path']).get_fdata()
+    get_registered('CBF_2baseline')
     subject['baseline']['AAT'] = nib.load(subject['baseline']['QASL_AAT_path']).get_fdata()
     subject['stimulus']['AAT'] = nib.load(subject['stimulus']['QASL_AAT_path']).get_fdata()
-    subject['stimulus']['AAT_2baseline'] = nib.load(subject['stimulus']['AAT_2baseline_path']).get_fdata()
+    get_registered('AAT_2baseline')
 
     if subject['dicom_typetags_by_context']['baseline'].__contains__('ATA'): # only if ATA is present in baseline, e.g. ATA not yet generated for vTR data
         subject['baseline']['ATA'] = nib.load(subject['baseline']['QASL_ATA_path']).get_fdata()
         subject['stimulus']['ATA'] = nib.load(subject['stimulus']['QASL_ATA_path']).get_fdata()
-        subject['stimulus']['ATA_2baseline'] = nib.load(subject['stimulus']['ATA_2baseline_path']).get_fdata()
+        get_registered('ATA_2baseline')
 
     subject['baseline']['mask'] = nib.load(subject['baseline']['mask_path']).get_fdata()
     subject['stimulus']['mask'] = nib.load(subject['stimulus']['mask_path']).get_fdata()
-    subject['stimulus']['mask_2baseline'] = nib.load(subject['stimulus']['mask_2baseline_path']).get_fdata()
+    get_registered('mask_2baseline')
+
+    # === Cropped grids (crop_to_brain): the stimulus maps in native space stay on the stimulus crop box for export. Where they are
+    # combined voxelwise with the baseline grid masks, they are recropped onto the baseline crop box (or the mask onto theirs) ===
+    baseline_crop = subject['baseline'].get('grid_crop')
+    stimulus_crop = subject['stimulus'].get('grid_crop')
+
     subject['baseline']['nanmask'] = np.where(subject['baseline']['mask'], 1.0, np.nan)
     subject['stimulus']['nanmask'] = np.where(subject['stimulus']['mask_2baseline'], 1.0, np.nan)
 
     # === Mask prep ===
     subject['stimulus']['nanmask_2baseline'] = np.where(subject['stimulus']['mask_2baseline'], 1.0, np.nan)
     subject['nanmask_combined'] = subject['baseline']['nanmask'] * subject['stimulus']['nanmask_2baseline']
+    # brain voxels (Nvox) of the masks, the voxelwise statistics and smoothing inputs only use these voxels
+    baseline_voxels = MaskedVoxels.from_dense(subject['baseline']['mask'], subject['baseline']['mask'])
+    stimulus_voxels = MaskedVoxels.from_dense(subject['stimulus']['mask_2baseline'], subject['stimulus']['mask_2baseline'])
+    stimulus_mask_native = recrop(subject['stimulus']['mask_2baseline'], baseline_crop, stimulus_crop)
+    stimulus_native_voxels = MaskedVoxels.from_dense(stimulus_mask_native, stimulus_mask_native)
+    combined_voxels = MaskedVoxels.from_dense(subject['baseline']['mask'], (subject['baseline']['mask'] > 0) & (subject['stimulus']['mask_2baseline'] > 0))
 
     # === Compute CVR ===
     subject['CVR'] = subject['stimulus']['CBF_2baseline'] - subject['baseline']['CBF']
 
     # === Compute CBF wholebrain ===
 
-    subject['stimulus']['CBF_wholebrain'] = np.nanmedian(subject['stimulus']['CBF'] * subject['stimulus']['nanmask']) # median CBF in stimulus wholebrain mask
+    subject['stimulus']['CBF_wholebrain'] = np.nanmedian(stimulus_voxels.gather(recrop(subject['stimulus']['CBF'], stimulus_crop, baseline_crop), dtype=np.float64)) # median CBF in stimulus wholebrain mask
 
     # === Set range_cbf based on CBF wholebrain during stimulus===
     # Note we use a factor 1/0.8=1.25 to convert whole brain CBF to gray matter CBF  this factor is based on 100+ patients plotting WB CBF vs  CBF GM
@@ -96,7 +119,7 @@ def asl_save_results_cbfaatcvr(subject):
         logging.info(f"GM CBF 60–80 → setting range {subject['range_cbf']} ml/100g/min.")
         
     # === Apply smoothing, use nanmask to preserve outside brain edges ===
-    subject['CVR_smth'] = asl_smooth_image(subject['CVR'] * subject['nanmask_combined'], 2, subject['FWHM'], subject['baseline']['VOXELSIZE'])
+    subject['CVR_smth'] = asl_smooth_image(brain_only(subject['CVR'], combined_voxels), 2, subject['FWHM'], subject['baseline']['VOXELSIZE'])
 
     # do not smooth AAT when using QASL SSVB (inherently does spatial smoothing)
     if subject['inference_method'] == 'ssvb':  
@@ -105,9 +128,24 @@ def asl_save_results_cbfaatcvr(subject):
         subject['stimulus']['AAT_2baseline_smth'] = subject['stimulus']['AAT_2baseline']
     # do smooth AAT when using QASL VABY or BASIl 
     else:
-        subject['baseline']['AAT_smth'] = asl_smooth_image(subject['baseline']['AAT'] * subject['baseline']['nanmask'], 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])
-        subject['stimulus']['AAT_smth'] = asl_smooth_image(subject['stimulus']['AAT'] * subject['stimulus']['nanmask'], 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])
-        subject['stimulus']['AAT_2baseline_smth'] = asl_smooth_image(subject['stimulus']['AAT_2baseline'] * subject['stimulus']['nanmask_2baseline'], 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])   
+        subject['baseline']['AAT_smth'] = asl_smooth_image(brain_only(subject['baseline']['AAT'], baseline_voxels), 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])
+        subject['stimulus']['AAT_smth'] = asl_smooth_image(brain_only(subject['stimulus']['AAT'], stimulus_native_voxels), 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])
+        subject['stimulus']['AAT_2baseline_smth'] = asl_smooth_image(brain_only(subject['stimulus']['AAT_2baseline'], stimulus_voxels), 2, subject['FWHM'], subject['stimulus']['VOXELSIZE'])   
+
+    # === Pad back to the source NIfTI geometry for export (no-op without crop_to_brain), native maps from their own crop box ===
+    for context in subject['ASL_CONTEXT']:
+        for key in ['CBF', 'AAT', 'AAT_smth', 'ATA']:
+            if subject[context].get(key) is not None:
+                subject[context][key] = pad_to_source(subject[context][key], subject[context].get('grid_crop'))
+        for key in ['CBF_2baseline', 'AAT_2baseline', 'AAT_2baseline_smth', 'ATA_2baseline']:
+            if subject[context].get(key) is not None:
+                subject[context][key] = pad_to_source(subject[context][key], baseline_crop)
+        for key in ['nanmask', 'nanmask_2baseline']:
+            if subject[context].get(key) is not None:
+                subject[context][key] = pad_to_source(subject[context][key], baseline_crop, np.nan)
+    subject['CVR'] = pad_to_source(subject['CVR'], baseline_crop)
+    subject['CVR_smth'] = pad_to_source(subject['CVR_smth'], baseline_crop)
+    subject['nanmask_combined'] = pad_to_source(subject['nanmask_combined'], baseline_crop, np.nan)
 
     # === Define output lists ===
     # for all the context data, baseline, stimulus
@@ -131,119 +169,166 @@ def asl_save_results_cbfaatcvr(subject):
         idx = subject['ASL_CONTEXT'].index(context)
         return subject['context_study_tags'][idx]
 
-    # === Helper: Save NIfTI + DICOM ===
-    def save_nifti_and_dicom(context, fields, allow_dicom=True):
+    # === Helper: context of the NIfTI and DICOM templates, single resampling quantifies the stimulus on the baseline grid ===
+    def get_template_context(context):
+        return 'baseline' if subject[context].get('grid_transforms') else context
+
+    # === Helper: NIfTI + DICOM export jobs ===
+    # The SeriesNumbers are fixed here, when the jobs are built, so they do not depend on the order in which the jobs finish
+    def nifti_and_dicom_jobs(context, fields, allow_dicom=True):
         context_study_tag = get_context_study_tag(context)
+        template_context = get_template_context(context)
         series_number_incr = 0  # Initialize series number increment for DICOM, will increment for each DICOM typetag saved except CVR and when allow_dicom is False
+        jobs = []
 
         for field, range_tag, type_tag, cmap, output_path in fields:
             data = subject[context].get(field) if field != 'CVR_smth' else subject['CVR_smth']
             path = subject[context].get(output_path) if field != 'CVR_smth' else subject['output_CVR_path']
-            template = subject[context]['sourceNIFTI_path'] if field != 'CVR_smth' else subject['baseline']['sourceNIFTI_path']
+            template = subject[template_context]['sourceNIFTI_path'] if field != 'CVR_smth' else subject['baseline']['sourceNIFTI_path']
 
             if data is not None and path:
-                save_data_nifti(data, path, template, 1, None, None)
-                
+                jobs.append((f"NIfTI {os.path.basename(path)}", save_data_nifti, (data, path, template, 1, None, None), {}, True))
+
                 if allow_dicom:
                     series_number_incr += 1
-                    try:
-                        dcm_source_path = subject[context].get('sourceDCM_path', None)
-                        dcm_outputdir = subject['DICOMoutputdir']
-
-                        # Compose SeriesDescription
-                        if type_tag == 'CVR':
-                            name = f'ASL {type_tag}'
-                        else:
-                            name = f'ASL {type_tag} {context_study_tag}'
-
-                        # Apply brain mask: non-brain voxels become 0, mapping to
-                        # PALETTE COLOR LUT index 0 (black background)
-                        data_masked = np.nan_to_num(data * subject['nanmask_combined'], nan=0.0)
-
-                        # Quantitative grayscale (for ROI readout, W/L)
-                        save_data_dicom_grayscale(
-                            data_masked,                            
-                            dcm_source_path,
-                            dcm_outputdir,
-                            name, 
-                            subject[range_tag],
-                            type_tag,
-                            series_number_incr,
-                        ) # e.g., "ASL_CBF_postACZ_915_1.dcm"
-
-                        # Color visualization (PALETTE COLOR)
-                        save_data_dicom_color(
-                            data_masked,                            
-                            dcm_source_path,
-                            dcm_outputdir,
-                            f"{name} COLOR", 
-                            subject[range_tag],
-                            type_tag,
-                            series_number_incr + 100, # offset to avoid series number collision
-                            colormap_name=cmap,
-                            mask=subject['nanmask_combined'],
-                        ) # e.g., "ASL_CBF_postACZ_1015_1.dcm"
-                    except Exception as e:
-                        logging.error(f"Failed to save DICOM for {type_tag} ({context_study_tag}): {e}")
-
-    # === Helper: Save PNG ===
-    def save_png(context, fields):
+                    dcm_source_path = subject[template_context].get('sourceDCM_path', None)
+                    dcm_outputdir = subject['DICOMoutputdir']
+
+                    # Compose SeriesDescription
+                    if type_tag == 'CVR':
+                        name = f'ASL {type_tag}'
+                    else:
+                        name = f'ASL {type_tag} {context_study_tag}'
+
+                    # Apply brain mask: non-brain voxels become 0, mapping to
+                    # PALETTE COLOR LUT index 0 (black background)
+                    data_masked = np.nan_to_num(data * subject['nanmask_combined'], nan=0.0)
+
+                    # Quantitative grayscale (for ROI readout, W/L) and color visualization (PALETTE COLOR) from one template preparation,
+                    # the color series SeriesNumber offset by 100 to avoid collision, e.g., "ASL_CBF_postACZ_915_1.dcm", "ASL_CBF_postACZ_1015_1.dcm"
+                    jobs.append((f"DICOM {name} (grayscale + COLOR)", save_data_dicom,
+                                 (data_masked, dcm_source_path, dcm_outputdir, name, subject[range_tag], type_tag, series_number_incr),
+                                 {'colormap_name': cmap, 'mask': subject['nanmask_combined']}, False))
+        return jobs
+
+    # === Helper: PNG export jobs ===
+    def png_jobs(context, fields):
         context_study_tag = get_context_study_tag(context)
+        jobs = []
         for field, range_tag, type_tag, cmap, _ in fields:
-            data = subject[context].get(field) if field != 'CVR_smth' else subject['CVR_smth']            
+            data = subject[context].get(field) if field != 'CVR_smth' else subject['CVR_smth']
             if data is not None:
                 if field == 'CVR_smth':
                     png_name = 'ASL_CVR'
-                    title_name = 'ASL CVR [RESEARCH ONLY]'  # CVR is research only, so we add a clear label to the title   
+                    title_name = 'ASL CVR [RESEARCH ONLY]'  # CVR is research only, so we add a clear label to the title
                 else:
                     png_name = f'ASL_{type_tag}_{context_study_tag}'  # e.g., ASL_CBF_preACZ
                     title_name = f"ASL {type_tag} {context_study_tag} [RESEARCH ONLY]"  # e.g., ASL CBF preACZ
-                
-                save_figure_to_png(data, subject['nanmask_combined'], subject[range_tag],
-                                    subject['RESULTSdir'], png_name, title_name, type_tag, cmap)                
-
-                logging.info(f"Saved PNG: {png_name}.png")
-
-    # === Execute saves ===    
-    #   Save NIfTI and DICOM for baseline and stimulus
-    save_nifti_and_dicom('baseline', fields_main)
-    save_nifti_and_dicom('baseline', fields_cvr)
-    save_nifti_and_dicom('stimulus', fields_main)
-    save_nifti_and_dicom('stimulus', fields_2baseline, allow_dicom=False)
-
-    # Save PNGs for baseline and stimulus
-    save_png('baseline', fields_main + fields_cvr)
-    save_png('stimulus', fields_2baseline)
-        
-    # Save PNG as DICOMs
-    # Generate a unique SeriesInstanceUID for the DICOM PNG series
-    series_instance_uid = generate_uid() 
-
-    png_name = 'ASL_CVR'
-    input_png_path =  os.path.join(subject['RESULTSdir'], f"{png_name}.png")
-    output_dcm_path = os.path.join(subject['DICOMoutputdir'], f"{png_name}.dcm")
-    dcm_source_path = subject['baseline']['sourceDCM_path']
-    series_description = f"ASL CVR" 
-    instance_number = 1  # first instance number for CVR
-    save_png_to_dicom(input_png_path, output_dcm_path, series_description, series_instance_uid, instance_number, dcm_source_path)
-
-    # Save PNGs as DICOM for each context and type_tag
-    for _, _, type_tag, _, _ in fields_main:
-        for context in subject['ASL_CONTEXT']:
-            context_study_tag = get_context_study_tag(context)
-            png_name = f'ASL_{type_tag}_{context_study_tag}' # e.g., ASL_CBF_preACZ
-            input_png_path = os.path.join(subject['RESULTSdir'], f"{png_name}.png")
-            output_dcm_path = os.path.join(subject['DICOMoutputdir'], f"{png_name}.dcm") # e.g., ASL_CBF_preACZ_PNG_999.dcm
-            series_description = f"ASL {type_tag} {context_study_tag}"  # e.g., ASL CBF preACZ
-            instance_number += 1
-            if subject[context].get(type_tag) is not None:
-                try:
+
+                jobs.append((f"PNG {png_name}.png", save_figure_to_png,
+                             (data, subject['nanmask_combined'], subject[range_tag], subject['RESULTSdir'], png_name, title_name, type_tag, cmap),
+                             {}, True))
+        return jobs
+
+    # === Helper: PNG as DICOM export jobs ===
+    # All PNGs go in one series, the InstanceNumbers are fixed here: 1 for CVR, then one per type_tag and context (also when skipped)
+    def png_dicom_jobs():
+        # Generate a unique SeriesInstanceUID for the DICOM PNG series
+        series_instance_uid = generate_uid()
+
+        png_name = 'ASL_CVR'
+        input_png_path = os.path.join(subject['RESULTSdir'], f"{png_name}.png")
+        output_dcm_path = os.path.join(subject['DICOMoutputdir'], f"{png_name}.dcm")
+        dcm_source_path = subject['baseline']['sourceDCM_path']
+        series_description = f"ASL CVR"
+        instance_number = 1  # first instance number for CVR
+        jobs = [(f"PNG DICOM {png_name}", save_png_to_dicom,
+                 (input_png_path, output_dcm_path, series_description, series_instance_uid, instance_number, dcm_source_path), {}, True)]
+
+        # Save PNGs as DICOM for each context and type_tag
+        for _, _, type_tag, _, _ in fields_main:
+            for context in subject['ASL_CONTEXT']:
+                context_study_tag = get_context_study_tag(context)
+                png_name = f'ASL_{type_tag}_{context_study_tag}' # e.g., ASL_CBF_preACZ
+                input_png_path = os.path.join(subject['RESULTSdir'], f"{png_name}.png")
+                output_dcm_path = os.path.join(subject['DICOMoutputdir'], f"{png_name}.dcm") # e.g., ASL_CBF_preACZ_PNG_999.dcm
+                series_description = f"ASL {type_tag} {context_study_tag}"  # e.g., ASL CBF preACZ
+                instance_number += 1
+                if subject[context].get(type_tag) is not None:
                     dcm_source_path = subject[context].get('sourceDCM_path', None)
-                    logging.info(f"Saving PNG as DICOM for {context_study_tag} {type_tag} to {output_dcm_path}")
-                    save_png_to_dicom(input_png_path, output_dcm_path, series_description, series_instance_uid, instance_number, dcm_source_path )
-                except Exception as e:
-                    logging.error(f"Failed to save PNG as DICOM for {type_tag} {context_study_tag}: {e}")
-                    continue  # Skip to the next one
+                    jobs.append((f"PNG DICOM {png_name}", save_png_to_dicom,
+                                 (input_png_path, output_dcm_path, series_description, series_instance_uid, instance_number, dcm_source_path), {}, False))
+        return jobs
+
+    # === Execute saves ===
+    # NIfTI and DICOM for baseline and stimulus, PNGs for baseline and stimulus, and the PNGs as DICOMs
+    file_jobs = (nifti_and_dicom_jobs('baseline', fields_main)
+                 + nifti_and_dicom_jobs('baseline', fields_cvr)
+                 + nifti_and_dicom_jobs('stimulus', fields_main)
+                 + nifti_and_dicom_jobs('stimulus', fields_2baseline, allow_dicom=False))
+    figure_jobs = png_jobs('baseline', fields_main + fields_cvr) + png_jobs('stimulus', fields_2baseline)
+    figure_dicom_jobs = png_dicom_jobs()
+
+    asl_export_jobs(file_jobs, figure_jobs, figure_dicom_jobs, n_workers=subject.get('export_workers'))
 
     # === Final log ===
     logging.info(f"Results complete: PACS-ready DICOMS, NIFTI, .png's saved for subject {subject['SUBJECTdir']}")
+
+def asl_export_jobs(file_jobs, figure_jobs, figure_dicom_jobs, n_workers=None):
+    # Run the export jobs concurrently: file writes (NIfTI, DICOM) in a thread pool, the matplotlib figures in a process pool
+    # (matplotlib is not thread safe), and the PNG as DICOM jobs in the thread pool once all PNGs are rendered.
+    # The log records and warnings of the worker processes go to the pipeline log (init_worker_logging), every saved
+    # PNG is logged here when its job completes.
+    # Jobs: lists of (label, function, args, kwargs, required), a failing job is logged, a failing required job then raises
+    # n_workers: number of threads and of worker processes, None -> all available cores
+    start_time = time.time()
+    n_threads = resolve_num_workers(n_workers, n_jobs=len(file_jobs) + len(figure_dicom_jobs))
+    n_processes = resolve_num_workers(n_workers, n_jobs=len(figure_jobs))
+    logging.info(f"Exporting {len(file_jobs) + len(figure_jobs) + len(figure_dicom_jobs)} results with {n_threads} threads and {n_processes} worker processes")
+
+    timings = []
+    mp_context = get_spawn_context()
+    log_queue, log_listener = start_worker_log_listener(mp_context)
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as thread_pool, \
+             ProcessPoolExecutor(max_workers=n_processes, mp_context=mp_context,
+                                 initializer=init_worker_logging, initargs=(log_queue, logging.getLogger().getEffectiveLevel())) as process_pool:
+            file_futures = [(job, thread_pool.submit(timed_export_job, *job[1:4])) for job in file_jobs]
+            figure_futures = {process_pool.submit(timed_export_job, *job[1:4]): job for job in figure_jobs}
+            for future in as_completed(figure_futures):
+                job = figure_futures[future]
+                if collect_export_job(job, future, timings):
+                    logging.info(f"Saved {job[0]}")
+            figure_dicom_futures = [(job, thread_pool.submit(timed_export_job, *job[1:4])) for job in figure_dicom_jobs]
+            for job, future in file_futures + figure_dicom_futures:
+                collect_export_job(job, future, timings)
+    finally:
+        log_listener.stop()
+
+    # per job timing summary, slowest first
+    for label, elapsed in sorted(timings, key=lambda timing: timing[1], reverse=True):
+        logging.info(f"  {label}: {elapsed:.2f} s")
+    logging.info(f"Export finished, {len(timings)} results saved, this took: {round(time.time() - start_time, 2)} s")
+
+def timed_export_job(function, args, kwargs):
+    # Run one export job (in a worker thread or process) and return its duration in s
+    start_time = time.time()
+    function(*args, **kwargs)
+    return time.time() - start_time
+
+def collect_export_job(job, future, timings):
+    # Wait for an export job and add its (label, duration) to timings
+    # Returns: True if the job succeeded; a failure is logged with the label (file name) of the job, and raised if required
+    label, _, _, _, required = job
+    try:
+        timings.append((label, future.result()))
+    except Exception as e:
+        logging.error(f"Failed to save {label}: {e!r}")
+        if required:
+            raise
+        return False
+    return True
+
+def brain_only(data, voxels):
+    # Dense copy of data with the brain voxels only (NaN outside), as input for NaN-aware smoothing
+    return voxels.scatter(voxels.gather(data, dtype=np.float64), fill_value=np.nan)
@@ -20,6 +20,7 @@ import numpy as np
 import nibabel as nib
 
 from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
 
 def asl_t1_from_m0(subject, context_tag):  
     
@@ -31,7 +32,7 @@ def asl_t1_from_m0(subject, context_tag):
     # context_tag:      String context_tag for the subject's data, eg 'baseline', 'stimulus', etc.
     #
     # Returns the updated subject dictionary with T1w image and masks.
-    # Ensure that the subject dictionary contains necessary keys like 'ASLdir', 'PLDS', 'NPLDS', 'LookLocker_correction_factor_perPLD', etc.
+    # Ensure that the subject dictionary contains necessary keys like 'ASLdir', 'PLDS', 'NPLDS', 'LookLocker_correction_factor_perslice', etc.
     # Example usage:      
     # subject = asl_t1_from_m0(subject, 'baseline')  for baseline ASL data before diamox #  
     #       
@@ -39,7 +40,7 @@ def asl_t1_from_m0(subject, context_tag):
     # Use a shorter alias for context_data
     context_data = subject[context_tag]     
     
-    LookLocker_correction_factor_perPLD = context_data['LookLocker_correction_factor_perPLD']
+    LookLocker_correction_factor_perslice = context_data['LookLocker_correction_factor_perslice']  # (NSLICES x NPLDS)
     T1fromM0_path = context_data['T1fromM0_path']
     sourceNIFTI_path = context_data['sourceNIFTI_path']
     M0_allPLD = context_data['M0_allPLD']
@@ -47,7 +48,7 @@ def asl_t1_from_m0(subject, context_tag):
     PLDS =  context_data['PLDS']
 
     # Remove the Look-Locker correction (by multiplication) to compute the T1w profile (vectorized)
-    M0_allPLD_noLLcorr = M0_allPLD * LookLocker_correction_factor_perPLD[None, None, None, :]
+    M0_allPLD_noLLcorr = M0_allPLD * LookLocker_correction_factor_perslice[None, None, :, :]
     logging.info('ASL T1-from-M0 computation started')
 
     # Compute T1w image from multi-PLD M0 and save nifti
@@ -65,46 +66,30 @@ def asl_t1_from_m0_compute(DATA4D, MASK, TIMEARRAY):
     # DATA4D: 4D numpy array of M0 data (x, y, z, PLD)
     # MASK: 3D numpy array of brain mask (x, y, z)
     # TIMEARRAY: 1D numpy array of PLD times in seconds
-    DATA4D_shape = DATA4D.shape
-    DATA2D = DATA4D.reshape(-1, DATA4D_shape[3])
-    brain_voxels = MASK.flatten() > 0
+    # The fit time = c0 + c1 * log(M0) is solved for all brain voxels at once (least squares on the masked voxels),
+    # voxels with non-finite log(M0) are skipped (fit 0)
+    brain = MaskedVoxels.from_dense(DATA4D, MASK, dtype=np.float64)
 
-    with np.errstate(divide='ignore'):
-        DATA2D_log = np.log(DATA2D)
-
-    CONSTANTARRAY = np.ones((DATA2D_log.shape[1], 1))
-    T1fit = np.zeros((DATA2D_log.shape[0], 2))
-    b = TIMEARRAY.reshape(-1, 1)
-
-    for i in range(DATA2D_log.shape[0]):
-        if not brain_voxels[i]:
-            continue
-
-        A_row = DATA2D_log[i, :]
-        if np.any(np.isnan(A_row)) or np.any(np.isinf(A_row)):
-            continue
-
-        A = np.hstack([CONSTANTARRAY, A_row.reshape(-1, 1)])
-        try:
-            fit_result = np.linalg.lstsq(A, b, rcond=None)[0]
-            T1fit[i, :] = fit_result.flatten()
-        except np.linalg.LinAlgError:
-            T1fit[i, :] = [0, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        DATA2D_log = np.log(brain.values)  # (Nvox, PLD)
+    valid = np.all(np.isfinite(DATA2D_log), axis=1)
 
-    data_R1fit = T1fit[:, 1].reshape(DATA4D_shape[0], DATA4D_shape[1], DATA4D_shape[2])
+    # least squares slope c1 of time on log(M0), per voxel
+    b = np.asarray(TIMEARRAY, dtype=np.float64).ravel()
+    A_centered = DATA2D_log[valid] - DATA2D_log[valid].mean(axis=1, keepdims=True)
+    R1fit = np.zeros(brain.nvox)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R1fit[valid] = (A_centered @ (b - b.mean())) / (A_centered ** 2).sum(axis=1)
 
     with np.errstate(divide='ignore', invalid='ignore'):
-        data_T1fit_brain = (-1 / data_R1fit) * MASK * 1e3
-        data_T1fit_brain[~np.isfinite(data_T1fit_brain)] = 0  # Clean NaNs and Infs
-        data_T1fit_brain = abs(data_T1fit_brain) # take magnitude of the data so to avoid negative values
+        T1fit_brain_1D = (-1 / R1fit) * 1e3
+        T1fit_brain_1D[~np.isfinite(T1fit_brain_1D)] = 0  # Clean NaNs and Infs
+        T1fit_brain_1D = abs(T1fit_brain_1D) # take magnitude of the data so to avoid negative values
     
-    data_T1fit_brain_1D = data_T1fit_brain.flatten()[brain_voxels]
-    THRESHOLDMASK_FACTOR = np.median(data_T1fit_brain_1D) + 2 * np.std(data_T1fit_brain_1D) # take median + 2 x std as threshold to remove extremely high values
+    THRESHOLDMASK_FACTOR = np.median(T1fit_brain_1D) + 2 * np.std(T1fit_brain_1D) # take median + 2 x std as threshold to remove extremely high values
     
-    valid_range_mask = (data_T1fit_brain > 0) & (data_T1fit_brain <= THRESHOLDMASK_FACTOR)
-    T1fromM0 = data_T1fit_brain * valid_range_mask
+    valid_range_mask = (T1fit_brain_1D > 0) & (T1fit_brain_1D <= THRESHOLDMASK_FACTOR)
+    T1fromM0 = brain.scatter(T1fit_brain_1D * valid_range_mask)
     T1fromM0[np.isnan(T1fromM0)] = 0
 
     return T1fromM0
-
-
@@ -0,0 +1,107 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Closed-form arrival time (AAT) estimate from the signal-weighted delay (Dai et al., MRM 2012): the deltaM-weighted
+    mean of the PLDs, WD = sum(deltaM(PLD) * PLD) / sum(deltaM(PLD)), is mapped to the arrival time through a lookup table
+    of the kinetic model (asl_kinetic_model). One vectorized pass over the brain voxels, no fit: QASL-free fast path
+    for the AAT map (triage).
+    The lookup table depends only on (PLDs, tau, T1b, T1t) and is built once and cached; with the slice timing of a
+    2D Look-Locker readout every slice has its own PLDs, and so its own table.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import time
+import logging
+import numpy as np
+import nibabel as nib
+from functools import lru_cache
+from clinical_asl_pipeline.asl_kinetic_model import tissue_signal
+from clinical_asl_pipeline.utils.pld_subsets import pld_deltaM, pld_series_voxels
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# Arrival times (s) of the lookup table, and the nominal CBF of the model curves (WD hardly depends on CBF, via T1app only)
+LOOKUP_ARRIVAL_TIMES = np.arange(0.0, 3.5 + 1e-9, 0.005)
+LOOKUP_CBF = 60.0
+
+def asl_weighted_delay_aat(subject, context_tag, output_map):
+    # AAT map of a context from the signal-weighted delay of its PLD ordered control/label data (in memory)
+    # Parameters:
+    #   subject: dict containing subject information including paths and parameters, 'T1t', 'T1b'
+    #   context_tag: string, e.g. 'baseline' or 'stimulus' context_tag for the keys in the subject dictionary to store results
+    #   output_map: output folder, the AAT map is written as output/native/arrival.nii.gz (QASL layout)
+    # Returns:
+    #   AAT map saved as NIfTI, context_data['QASL_AAT_path'] pointing to it
+    start_time = time.time()
+    context_data = subject[context_tag]
+    NPLDS = context_data['NPLDS']
+    mask = nib.load(context_data['gridmask_path']).get_fdata() > 0  # on the grid of the data (single resampling: baseline grid)
+
+    # deltaM (Nvox x PLD): mean over repeats of control - tag (pairs tag-control for Look-Locker, QASL --iaf=tc, else control-tag)
+    asl = pld_series_voxels(context_data, mask)
+    deltaM = pld_deltaM(asl.values, NPLDS, subject['ASL scan'])
+
+    plds = np.asarray(context_data['PLDS'], dtype=np.float64)
+    slicedt = (context_data.get('slicetime') or 0) / 1000 if subject['ASL scan'] == 'multi-delay Look-Locker' else 0.0
+    tau = tau_key(context_data['tau'], NPLDS)
+    slice_index = np.unravel_index(asl.flat_index, asl.shape)[2]
+
+    WD = weighted_delay(deltaM, plds)
+    AAT = np.zeros(asl.nvox)
+    for z in np.unique(slice_index):
+        # PLDs of slice z, WD relative to the PLDs of the slice
+        in_slice = slice_index == z
+        slice_plds = tuple(np.round(plds + z * slicedt, 6))
+        AAT[in_slice] = aat_from_weighted_delay(WD[in_slice] + z * slicedt, slice_plds, tau, subject['T1b'], subject['T1t'])
+    AAT[~np.isfinite(WD)] = 0
+
+    context_data['QASL_AAT_path'] = os.path.join(output_map, 'output', 'native', 'arrival.nii.gz')
+    os.makedirs(os.path.dirname(context_data['QASL_AAT_path']), exist_ok=True)
+    save_data_nifti(asl.scatter(AAT), context_data['QASL_AAT_path'], context_data['gridmask_path'], 1, None, None)
+
+    logging.info(f"AAT from the signal-weighted delay ({context_tag}): {asl.nvox} voxels, this took: {round(time.time() - start_time, 2)} s")
+    return subject
+
+def tau_key(tau, npld):
+    # Hashable label duration for the lookup table cache: float, or tuple of one tau per PLD
+    tau = np.atleast_1d(np.asarray(tau, dtype=np.float64))
+    return tuple(float(t) for t in tau) if tau.size == npld and npld > 1 else float(tau[0])
+
+def weighted_delay(deltaM, plds):
+    # Signal-weighted delay per voxel: sum(deltaM * PLD) / sum(deltaM), negative deltaM (noise) is not weighted
+    # deltaM: (Nvox x PLD); plds: (PLD) in seconds. Returns (Nvox), NaN without positive signal
+    weights = np.clip(deltaM, 0, None)
+    total = weights.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, weights @ np.asarray(plds) / total, np.nan)
+
+@lru_cache(maxsize=None)
+def weighted_delay_lookup_table(plds, tau, T1b, T1t):
+    # Lookup table weighted delay -> arrival time of the kinetic model for the given PLDs (tuple), tau (float or tuple), T1b, T1t
+    # Returns: (WD, AAT) numpy arrays, WD strictly increasing (the arrival times with signal at the PLDs)
+    plds = np.asarray(plds)
+    tau = np.asarray(tau)
+    curves = tissue_signal(plds[None, :], LOOKUP_CBF, LOOKUP_ARRIVAL_TIMES[:, None], tau, T1t, T1b)
+    total = curves.sum(axis=1)
+    valid = total > 0
+    WD = curves[valid] @ plds / total[valid]
+    AAT = LOOKUP_ARRIVAL_TIMES[valid]
+    # keep the invertible part: WD is constant for arrival times before the first PLD (all PLDs after the bolus), then
+    # increases with the arrival time up to its maximum; strictly increasing points up to the maximum
+    peak = np.argmax(WD) + 1
+    WD, AAT = WD[:peak], AAT[:peak]
+    increasing = np.concatenate([[True], WD[1:] > np.maximum.accumulate(WD)[:-1]])
+    return WD[increasing], AAT[increasing]
+
+def aat_from_weighted_delay(WD, plds, tau, T1b, T1t):
+    # Arrival time from the weighted delay by the (cached) lookup table, clipped to the table range
+    WD_table, AAT_table = weighted_delay_lookup_table(plds, tau, float(T1b), float(T1t))
+    return np.interp(WD, WD_table, AAT_table)
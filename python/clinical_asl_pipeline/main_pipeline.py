@@ -26,12 +26,19 @@ from clinical_asl_pipeline.asl_convert_dicom_to_nifti import asl_convert_dicom_t
 from clinical_asl_pipeline.asl_extract_params_dicom import asl_extract_params_dicom
 from clinical_asl_pipeline.asl_look_locker_correction import asl_look_locker_correction
 from clinical_asl_pipeline.asl_prepare_asl_data import asl_prepare_asl_data
+from clinical_asl_pipeline.asl_crop_to_brain import asl_crop_to_brain
 from clinical_asl_pipeline.asl_motion_correction import asl_motion_correction
 from clinical_asl_pipeline.asl_outlier_removal import asl_outlier_removal
 from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
-from clinical_asl_pipeline.asl_registration_stimulus_to_baseline import asl_registration_stimulus_to_baseline
+from clinical_asl_pipeline.asl_m0_calibration import asl_m0_calibration
+from clinical_asl_pipeline.asl_joint_quantification import asl_joint_quantification_paths, asl_joint_ata
+from clinical_asl_pipeline.asl_weighted_delay import asl_weighted_delay_aat
+from clinical_asl_pipeline.asl_direct_ata import asl_direct_ata
+from clinical_asl_pipeline.asl_cohort_quantification import asl_cohort_quantification, asl_release_dense_arrays
+from clinical_asl_pipeline.asl_registration_stimulus_to_baseline import asl_registration_stimulus_to_baseline, asl_registration_stimulus_to_baseline_grid
 from clinical_asl_pipeline.asl_save_results_cbfaatcvr import asl_save_results_cbfaatcvr
 from clinical_asl_pipeline.utils.run_bet_mask import run_bet_mask
+from clinical_asl_pipeline.utils.pld_subsets import write_pld_subsets, remove_pld_subsets
 
 def prepare_subject_paths(subject, inputdir, outputdir, workingdir):
     # Prepare output folder structure for subject.
@@ -202,6 +209,43 @@ def mri_diamox_umcu_clinicalasl_cvr(inputdir, outputdir, workingdir, ANALYSIS_PA
     # Parameters:
     #     inputdir (str): Path to the input directory containing extracted PACS DICOM files.
     #     outputdir (str): Path to the output directory where ASL derived images and generated DICOMS will be saved.
+
+    ###### Step 1-9: subject dictionary, DICOM to NIFTI, preprocessing of every ASL context tag
+    subject = asl_preprocess_subject(inputdir, outputdir, workingdir, ANALYSIS_PARAMETERS)
+
+    ###### Step 10: ASL Quantification analysis of every ASL context tag
+    for context in subject['ASL_CONTEXT']:
+        subject = asl_quantification(subject, context, ANALYSIS_PARAMETERS)
+
+    ###### Step 11-12: registration and results
+    asl_finish_subject(subject)
+
+def mri_diamox_umcu_clinicalasl_cvr_cohort(exams, batchdir, ANALYSIS_PARAMETERS):
+    # Cohort version of mri_diamox_umcu_clinicalasl_cvr: the exams are preprocessed one by one, quantified together in
+    # pseudo-volume batches of the same protocol (asl_cohort_quantification, voxelwise inference), and finished one by one
+    # Parameters:
+    #     exams (list): dicts with 'inputdir', 'outputdir' and 'workingdir' of every exam (as mri_diamox_umcu_clinicalasl_cvr)
+    #     batchdir (str): Path to the working directory of the cohort batches (pseudo-volumes and their QASL outputs)
+    subjects = []
+    for exam in exams:
+        logging.info(f"=== Preprocessing exam {exam['inputdir']} ===")
+        subject = asl_preprocess_subject(exam['inputdir'], exam['outputdir'], exam['workingdir'], ANALYSIS_PARAMETERS)
+        # the subjects wait for the whole cohort: keep the brain voxels of the series only, memory does not grow with the dense arrays
+        subjects.append(asl_release_dense_arrays(subject))
+
+    ###### Step 10: ASL Quantification analysis of all exams in batches
+    subjects = asl_cohort_quantification(subjects, ANALYSIS_PARAMETERS, batchdir)
+
+    for subject in subjects:
+        logging.info(f"=== Results of exam {subject['DICOMinputdir']} ===")
+        asl_finish_subject(subject)
+
+def asl_preprocess_subject(inputdir, outputdir, workingdir, ANALYSIS_PARAMETERS):
+    # Steps 1-9 of the pipeline for a subject: subject dictionary, DICOM to NIFTI, and for every ASL context tag the
+    # source data, scan parameters, Look-Locker correction, data preparation, brain extraction, motion correction and
+    # outlier removal (up to quantification)
+    # Parameters as mri_diamox_umcu_clinicalasl_cvr
+    # Returns: subject dictionary
     # Initialize subject dictionary with input and output directories
 
     subject = {}
@@ -219,7 +263,7 @@ def mri_diamox_umcu_clinicalasl_cvr(inputdir, outputdir, workingdir, ANALYSIS_PA
     ###### Step 2: Convert DICOM to NIFTI, move input PACS DICOMSinputdir to DICOMsubjectdir for further processing
     subject = asl_convert_dicom_to_nifti(subject)
 
-    ###### Step 3-11: Unified loop for each ASL context tag: 'baseline', 'stimulus'
+    ###### Step 3-9: Unified loop for each ASL context tag: 'baseline', 'stimulus'
     for i, context in enumerate(subject['ASL_CONTEXT']):
         context_study_tag = subject['context_study_tags'][i] # e.g 'preACZ' and 'postACZ'
 
@@ -241,48 +285,126 @@ def mri_diamox_umcu_clinicalasl_cvr(inputdir, outputdir, workingdir, ANALYSIS_PA
 
     ###### Step 7: Brain extraction on M0 using HD-BET CLI
         subject = run_bet_mask(subject, context_tag=context)
+
+    ###### Step 7a: Crop ASL data, M0 and mask to the brain bounding box (plus margin), processing runs on the cropped grid
+        if subject.get('crop_to_brain', False):
+            subject = asl_crop_to_brain(subject, context_tag=context)
     
+    ###### Step 7b: Single resampling: register stimulus M0 to baseline before motion correction, so the stimulus data are resampled onto the baseline grid in one pass
+        if context == 'stimulus' and subject.get('single_resampling', False):
+            subject = asl_registration_stimulus_to_baseline_grid(subject)
+
     ###### Step 8: Motion correction of ASL data using ANTsPy
         subject = asl_motion_correction(subject, context_tag=context)
 
     ###### Step 9: Outlier timepoint rejection: 2.5 x std + mean CBF (deltaM) 
         subject = asl_outlier_removal(subject, context_tag=context, usermask=None)
 
-    ###### Step 10: ASL Quantification analysis
-        context_data = subject[context]
-        # all PLD for AAT (arterial arrival time map)
+    return subject
+
+def asl_quantification(subject, context, ANALYSIS_PARAMETERS):
+    # Step 10 of the pipeline: ASL quantification analysis of a context (CBF, AAT, ATA maps)
+    # Parameters:
+    #   subject: dict containing subject information, preprocessed (asl_preprocess_subject)
+    #   context: string, e.g. 'baseline' or 'stimulus'
+    #   ANALYSIS_PARAMETERS: processing parameters
+    # Returns: subject dictionary
+    context_data = subject[context]
+    # voxelwise M0 calibration: once per context for all its fits ('native'), or by every QASL fit ('qasl')
+    location_calib = None
+    if subject.get('m0_calibration', 'qasl') == 'native':
+        subject = asl_m0_calibration(subject, context_tag=context)
+        location_calib = context_data['calibM0_path']
+    # quantification: 'three_fit' (all PLDs for AAT, 2-to-last PLDs for CBF, PLDs 1-2 without arterial component for ATA)
+    # or 'joint' (experimental, one fit of all PLDs with arterial component: CBF, AAT, and ATA derived with the kinetic model)
+    quantification_mode = subject.get('quantification_mode', 'three_fit')
+    if quantification_mode == 'joint':
+        logging.warning("quantification_mode 'joint' is not validated against 'three_fit' (see benchmarks/benchmark_quantification_modes.py)")
+        # the ATA map is derived from the arterial component (aCBV), which the native backend does not fit
+        if subject.get('qasl_backend', 'cli') == 'native':
+            raise ValueError("quantification_mode 'joint' needs a QASL backend ('cli' or 'inprocess'), the 'native' backend fits no arterial component")
+        output_map = os.path.join(subject['ASLdir'], f'{context}_QASL_allPLD_joint')       # output folder name QASL
+        subject = asl_joint_quantification_paths(subject, context, output_map)
         asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
                         context_data['PLDall_controllabel_path'], 
-                        context_data['M0_path'], 
-                        context_data['mask_path'], 
-                        os.path.join(subject['ASLdir'], f'{context}_QASL_allPLD_forAAT'),       # output folder name QASL
+                        context_data['gridM0_path'], 
+                        context_data['gridmask_path'], 
+                        output_map,
                         context_data['PLDS'][0:],
                         context_data['tau'], 
-                        subject['inference_method']
-                        )
-        # 2-to-last PLD for CBF map
-        asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
-                        context_data['PLD2tolast_controllabel_path'], 
-                        context_data['M0_path'], 
-                        context_data['mask_path'], 
-                        os.path.join(subject['ASLdir'], f'{context}_QASL_2tolastPLD_forCBF'),   # output folder name QASL
-                        context_data['PLDS'][1:],
-                        context_data['tau'], 
-                        subject['inference_method']
-                        )
-        # 1to2 PLDs for ATA map ->  then do no fit for the arterial component 'artoff'
-        asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
-                        context_data['PLD1to2_controllabel_path'], 
-                        context_data['M0_path'], 
-                        context_data['mask_path'], 
-                        os.path.join(subject['ASLdir'], f'{context}_QASL_1to2PLD_forATA'),      # output folder name QASL
-                        context_data['PLDS'][0:2],
-                        context_data['tau'],
                         subject['inference_method'],
-                        'artoff'
+                        backend=subject.get('qasl_backend', 'cli'),
+                        nslabs=subject.get('qasl_slabs', 1),
+                        location_calib=location_calib
                         )
+        subject = asl_joint_ata(subject, context_tag=context)
+    elif quantification_mode == 'three_fit':
+        # write the PLD subsets (views on the PLDall series) as uncompressed NIfTIs for QASL, removed after quantification (also when a fit fails)
+        write_pld_subsets(context_data)
+        try:
+            # all PLD for AAT (arterial arrival time map): QASL fit ('qasl') or signal-weighted delay without fit ('weighted_delay')
+            aat_engine = subject.get('aat_engine', 'qasl')
+            if aat_engine == 'weighted_delay':
+                subject = asl_weighted_delay_aat(subject, context, os.path.join(subject['ASLdir'], f'{context}_QASL_allPLD_forAAT'))
+            elif aat_engine == 'qasl':
+                asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
+                                context_data['PLDall_controllabel_path'], 
+                                context_data['gridM0_path'], 
+                                context_data['gridmask_path'], 
+                                os.path.join(subject['ASLdir'], f'{context}_QASL_allPLD_forAAT'),       # output folder name QASL
+                                context_data['PLDS'][0:],
+                                context_data['tau'], 
+                                subject['inference_method'],
+                                backend=subject.get('qasl_backend', 'cli'),
+                                nslabs=subject.get('qasl_slabs', 1),
+                                location_calib=location_calib
+                                )
+            else:
+                raise ValueError(f"Unknown aat_engine: '{aat_engine}', use 'qasl' or 'weighted_delay'")
+            # 2-to-last PLD for CBF map
+            asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
+                            context_data['PLD2tolast_controllabel_path'], 
+                            context_data['gridM0_path'], 
+                            context_data['gridmask_path'], 
+                            os.path.join(subject['ASLdir'], f'{context}_QASL_2tolastPLD_forCBF'),   # output folder name QASL
+                            context_data['PLDS'][1:],
+                            context_data['tau'], 
+                            subject['inference_method'],
+                            backend=subject.get('qasl_backend', 'cli'),
+                            nslabs=subject.get('qasl_slabs', 1),
+                            location_calib=location_calib
+                            )
+            # 1to2 PLDs for ATA map ->  then do no fit for the arterial component 'artoff'
+            # QASL fit ('qasl') or closed form from the PLD 1-2 deltaM with the AAT and CBF maps above ('direct')
+            ata_engine = subject.get('ata_engine', 'qasl')
+            if ata_engine == 'direct':
+                subject = asl_direct_ata(subject, context, os.path.join(subject['ASLdir'], f'{context}_QASL_1to2PLD_forATA'), location_calib,
+                                         location_aat=context_data['QASL_AAT_path'], location_cbf=context_data['QASL_CBF_path'])
+            elif ata_engine == 'qasl':
+                asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
+                                context_data['PLD1to2_controllabel_path'], 
+                                context_data['gridM0_path'], 
+                                context_data['gridmask_path'], 
+                                os.path.join(subject['ASLdir'], f'{context}_QASL_1to2PLD_forATA'),      # output folder name QASL
+                                context_data['PLDS'][0:2],
+                                context_data['tau'],
+                                subject['inference_method'],
+                                'artoff',
+                                backend=subject.get('qasl_backend', 'cli'),
+                                nslabs=subject.get('qasl_slabs', 1),
+                                location_calib=location_calib
+                                )
+            else:
+                raise ValueError(f"Unknown ata_engine: '{ata_engine}', use 'qasl' or 'direct'")
+        finally:
+            remove_pld_subsets(context_data)
+    else:
+        raise ValueError(f"Unknown quantification_mode: '{quantification_mode}', use 'three_fit' or 'joint'")
+    return subject
 
-    ###### Step 11: register post-ACZ ASL data to pre-ACZ ASL data using Elastix 
+def asl_finish_subject(subject):
+    # Steps 11-12 of the pipeline for a quantified subject: registration stimulus to baseline, and results
+    ###### Step 11: register post-ACZ ASL data to pre-ACZ ASL data using ANTsPy (maps already on the baseline grid with single resampling)
     asl_registration_stimulus_to_baseline(subject)
 
     ###### Step 12: Generate CBF/AAT/ATA/CVR results (nifti, dicom PACS, .pngs) for pre- and postACZ, including registration of postACZ to preACZ as reference data, and target for computed CVR map
@@ -27,7 +27,7 @@ from clinical_asl_pipeline.asl_extract_params_dicom import asl_extract_params_di
 from clinical_asl_pipeline.asl_prepare_asl_data import asl_prepare_asl_data
 from clinical_asl_pipeline.asl_motion_correction import asl_motion_correction
 from clinical_asl_pipeline.asl_qasl_analysis import asl_qasl_analysis
-from clinical_asl_pipeline.asl_registration_stimulus_to_baseline import asl_registration_stimulus_to_baseline
+from clinical_asl_pipeline.asl_registration_stimulus_to_baseline import asl_registration_stimulus_to_baseline, asl_registration_stimulus_to_baseline_grid
 from clinical_asl_pipeline.asl_save_results_cbfaatcvr import asl_save_results_cbfaatcvr
 from clinical_asl_pipeline.utils.run_bet_mask import run_bet_mask
 
@@ -246,6 +246,10 @@ def mri_diamox_umcu_clinicalasl_cvr(inputdir, outputdir, workingdir, ANALYSIS_PA
     ###### Step 7: Brain extraction on M0 using HD-BET CLI
         subject = run_bet_mask(subject, context_tag=context)
     
+    ###### Step 7b: Single resampling: register stimulus M0 to baseline before motion correction, so the stimulus data are resampled onto the baseline grid in one pass
+        if context == 'stimulus' and subject.get('single_resampling', False):
+            subject = asl_registration_stimulus_to_baseline_grid(subject)
+
     ###### Step 8: Motion correction of ASL data using ANTsPy
         subject = asl_motion_correction(subject, context_tag=context)
 
@@ -254,15 +258,15 @@ def mri_diamox_umcu_clinicalasl_cvr(inputdir, outputdir, workingdir, ANALYSIS_PA
         # all PLD for CBF and AAT (arterial arrival time map)
         # asl_qasl_analysis(context_data, ANALYSIS_PARAMETERS, 
         #                 context_data['PLDall_controllabel_path'], 
-        #                 context_data['M0_path'], 
-        #                 context_data['mask_path'], 
+        #                 context_data['gridM0_path'], 
+        #                 context_data['gridmask_path'], 
         #                 os.path.join(subject['ASLdir'], f'{context}_QASL_allPLD'),       # output folder name QASL
         #                 context_data['PLDS'], 
         #                 context_data['tau'],
         #                 subject['inference_method']
         #                 )        
 
-    ###### Step 11: register post-ACZ ASL data to pre-ACZ ASL data using Elastix 
+    ###### Step 11: register post-ACZ ASL data to pre-ACZ ASL data using ANTsPy (maps already on the baseline grid with single resampling)
     asl_registration_stimulus_to_baseline(subject)
 
     ###### Step 12: Generate CBF/AAT/ATA/CVR results (nifti, dicom PACS, .pngs) for pre- and postACZ, including registration of postACZ to preACZ as reference data, and target for computed CVR map
@@ -0,0 +1,95 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the cohort quantification helpers: the pseudo-volume layout (CohortLayout) of contexts with different grids,
+    and the protocol key of the batches.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_cohort_quantification import CohortLayout, protocol_key, asl_release_dense_arrays, DENSE_KEYS
+from clinical_asl_pipeline.utils.pld_subsets import pld_series_voxels
+
+def make_masks(rng):
+    # Brain masks of three contexts on grids of different sizes (also different numbers of slices)
+    return [rng.random(shape) > 0.4 for shape in [(6, 5, 4), (8, 7, 4), (5, 5, 6)]]
+
+def test_cohort_layout_shape():
+    masks = make_masks(np.random.default_rng(0))
+    layout = CohortLayout(masks)
+    nslices = max(mask.shape[2] for mask in masks)
+    # per slice, the brain voxels of all contexts side by side
+    voxels_per_slice = sum(np.bincount(np.nonzero(mask)[2], minlength=nslices) for mask in masks)
+    assert layout.shape == (voxels_per_slice.max(), 1, nslices)
+
+def test_cohort_layout_unique_positions():
+    masks = make_masks(np.random.default_rng(1))
+    layout = CohortLayout(masks)
+    positions = np.concatenate([columns * layout.shape[2] + slices for columns, slices in zip(layout.columns, layout.slices)])
+    assert np.unique(positions).size == positions.size
+    # every brain voxel stays in its own slice
+    for mask, slices in zip(masks, layout.slices):
+        np.testing.assert_array_equal(slices, np.nonzero(mask)[2])
+
+def test_cohort_layout_roundtrip_3d():
+    rng = np.random.default_rng(2)
+    masks = make_masks(rng)
+    layout = CohortLayout(masks)
+    volumes = [rng.normal(size=mask.shape) for mask in masks]
+    pseudo = layout.pack([volume[mask] for volume, mask in zip(volumes, masks)])
+    assert pseudo.shape == layout.shape
+    assert pseudo.dtype == np.float32
+    for index, (volume, mask) in enumerate(zip(volumes, masks)):
+        dense = layout.unpack(pseudo, index)
+        assert dense.shape == mask.shape
+        np.testing.assert_allclose(dense[mask], volume[mask], rtol=1e-6)
+        np.testing.assert_array_equal(dense[~mask], 0)
+
+def test_cohort_layout_roundtrip_4d():
+    rng = np.random.default_rng(3)
+    masks = make_masks(rng)
+    layout = CohortLayout(masks)
+    series = [rng.normal(size=mask.shape + (5,)) for mask in masks]
+    pseudo = layout.pack([volume[mask] for volume, mask in zip(series, masks)])
+    assert pseudo.shape == layout.shape + (5,)
+    for index, (volume, mask) in enumerate(zip(series, masks)):
+        dense = layout.unpack(pseudo, index)
+        assert dense.shape == volume.shape
+        np.testing.assert_allclose(dense[mask], volume[mask], rtol=1e-6)
+
+def test_protocol_key_without_slicetime(tmp_path):
+    location_mask = str(tmp_path / 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 3), dtype=np.float32), np.eye(4)), location_mask)
+    context_data = {'tau': 2, 'PLDS': [0.5, 1.0, 1.5], 'slicetime': None, 'gridmask_path': location_mask}
+    subject = {'ASL scan': 'multi-delay Look-Locker', 'baseline': context_data}
+    assert protocol_key(subject, 'baseline') == ('multi-delay Look-Locker', (0.5, 1.0, 1.5), (2.0,), 0.0, 3)
+    context_data['slicetime'] = 40.0
+    assert protocol_key(subject, 'baseline')[3] == 40.0
+
+def test_release_dense_arrays(tmp_path):
+    rng = np.random.default_rng(4)
+    mask = rng.random((5, 4, 3)) > 0.5
+    location_mask = str(tmp_path / 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), np.eye(4)), location_mask)
+    PLDall = rng.normal(size=mask.shape + (8,))
+    context_data = {'gridmask_path': location_mask, 'PLDall_controllabel': PLDall, 'M0': np.ones(mask.shape),
+                    'M0ASL_allPLD': np.zeros(mask.shape + (2, 2, 2)), 'ASL_controllabel_allPLD': np.zeros(mask.shape + (4, 2)),
+                    'M0_allPLD': np.zeros(mask.shape + (2,))}
+    subject = {'ASL_CONTEXT': ['baseline'], 'baseline': context_data, 'DICOMinputdir': str(tmp_path)}
+    expected = pld_series_voxels(context_data, mask).values
+    asl_release_dense_arrays(subject)
+    assert not any(key in context_data for key in DENSE_KEYS)
+    assert 'M0' in context_data
+    # the series in the brain voxels is kept, the same voxels as gathered from the dense series
+    np.testing.assert_array_equal(pld_series_voxels(context_data, mask).values, expected)
+    np.testing.assert_array_equal(context_data['PLDall_controllabel_voxels'].mask, mask)
@@ -0,0 +1,45 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the precomputed voxelwise M0 calibration against its closed form. The comparison with the calibrated
+    output of QASL itself needs QASL: python/benchmarks/benchmark_m0_calibration.py.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.asl_m0_calibration import voxelwise_calibration_m0, asl_apply_m0_calibration, QASL_PERFUSION, QASL_PERFUSION_CALIB
+
+def test_voxelwise_calibration_m0_recovers_blood_m0():
+    # M0 of tissue with saturation recovery within TR_M0: M0a * lambda * (1 - exp(-TR_M0 / T1t))
+    TR_M0, T1t, partition_coefficient, M0a = 4.0, 1.3, 0.9, 1000.0
+    mask = np.zeros((3, 3, 2), dtype=bool)
+    mask[1:, 1:] = True
+    M0 = M0a * partition_coefficient * (1 - np.exp(-TR_M0 / T1t)) * np.ones(mask.shape)
+    calibM0 = voxelwise_calibration_m0(M0, mask, TR_M0, T1t, partition_coefficient)
+    np.testing.assert_allclose(calibM0[mask], M0a)
+    np.testing.assert_array_equal(calibM0[~mask], 0)
+
+def test_apply_m0_calibration(tmp_path):
+    affine = np.eye(4)
+    perfusion = np.full((3, 3, 2), 0.5)
+    calibM0 = np.full((3, 3, 2), 1000.0)
+    calibM0[0] = 0  # outside the brain
+    os.makedirs(os.path.dirname(os.path.join(tmp_path, QASL_PERFUSION)))
+    nib.save(nib.Nifti1Image(perfusion, affine), os.path.join(tmp_path, QASL_PERFUSION))
+    nib.save(nib.Nifti1Image(calibM0, affine), os.path.join(tmp_path, 'calibM0.nii.gz'))
+    asl_apply_m0_calibration(str(tmp_path), os.path.join(tmp_path, 'calibM0.nii.gz'), 0.85)
+    perfusion_calib = nib.load(os.path.join(tmp_path, QASL_PERFUSION_CALIB)).get_fdata()
+    # ml/100g/min: 6000 * perfusion / (M0a * alpha)
+    np.testing.assert_allclose(perfusion_calib[1:], 6000 * 0.5 / (1000 * 0.85))
+    np.testing.assert_array_equal(perfusion_calib[0], 0)
@@ -0,0 +1,128 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the QASL slab analysis without QASL: the per-slab fits are replaced by a stand-in that records the inputs
+    of every slab and writes its input slab as output, to check the PLD shift of the 2D readout and the stitching.
+    Tests of the in-process backend with a stand-in for the qasl console script function: arguments, exit code and
+    concurrent calls (serialized, sys.argv restored).
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+import nibabel as nib
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from clinical_asl_pipeline import asl_qasl_analysis as qasl_module
+
+AFFINE = np.diag([3.0, 3.0, 6.0, 1.0])
+
+@pytest.fixture
+def slab_inputs(tmp_path):
+    # ASL series (x, y, z, t) with the slice index as value, and a mask with brain voxels in slices 1-8 of 10
+    asl = np.broadcast_to(np.arange(10, dtype=np.float32)[None, None, :, None], (4, 4, 10, 4)).copy()
+    mask = np.zeros((4, 4, 10), dtype=np.float32)
+    mask[1:3, 1:3, 1:9] = 1
+    paths = {name: str(tmp_path / f'{name}.nii.gz') for name in ['asl', 'm0', 'mask']}
+    nib.save(nib.Nifti1Image(asl, AFFINE), paths['asl'])
+    nib.save(nib.Nifti1Image(asl[..., 0], AFFINE), paths['m0'])
+    nib.save(nib.Nifti1Image(mask, AFFINE), paths['mask'])
+    return paths
+
+def run_slab_analysis(monkeypatch, tmp_path, slab_inputs, scan, inference_method, nslabs=2):
+    # Run asl_qasl_slab_analysis with the slab fits replaced, returns the recorded slab fits and the output map
+    fits = []
+
+    def fake_slab_fit(subject, ANALYSIS_PARAMETERS, location_asl, location_m0, location_mask, output_map, pld_list, *args, **kwargs):
+        first_slice = int(nib.load(location_asl).get_fdata()[0, 0, 0, 0])
+        fits.append({'first_slice': first_slice, 'plds': pld_list, 'threads': kwargs['threads'], 'backend': kwargs['backend']})
+        os.makedirs(os.path.join(output_map, 'output', 'native'))
+        nib.save(nib.load(location_m0), os.path.join(output_map, 'output', 'native', 'perfusion.nii.gz'))
+
+    monkeypatch.setattr(qasl_module, 'asl_qasl_analysis', fake_slab_fit)
+    subject = {'ASL scan': scan, 'slicetime': 40.0}
+    output_map = str(tmp_path / 'QASL')
+    qasl_module.asl_qasl_slab_analysis(subject, {}, slab_inputs['asl'], slab_inputs['m0'], slab_inputs['mask'], output_map,
+                                       [0.5, 1.0, 1.5, 2.0], 2.0, inference_method, None, None, nslabs)
+    return sorted(fits, key=lambda fit: fit['first_slice']), output_map
+
+def test_slab_plds_shifted_by_slice_timing(monkeypatch, tmp_path, slab_inputs):
+    fits, _ = run_slab_analysis(monkeypatch, tmp_path, slab_inputs, 'multi-delay Look-Locker', 'vaby')
+    assert [fit['first_slice'] for fit in fits] == [1, 5]
+    for fit in fits:
+        # QASL counts the slice timing from the first slice of the slab
+        np.testing.assert_allclose(fit['plds'], np.array([0.5, 1.0, 1.5, 2.0]) + fit['first_slice'] * 0.040)
+        assert fit['threads'] == 1 and fit['backend'] == 'cli'
+
+def test_slab_plds_halo(monkeypatch, tmp_path, slab_inputs):
+    # ssvb: the slabs start SSVB_HALO_SLICES before their core, the PLD shift follows the first slice with halo
+    fits, _ = run_slab_analysis(monkeypatch, tmp_path, slab_inputs, 'multi-delay Look-Locker', 'ssvb')
+    assert [fit['first_slice'] for fit in fits] == [0, 5 - qasl_module.SSVB_HALO_SLICES]
+    for fit in fits:
+        np.testing.assert_allclose(fit['plds'], np.array([0.5, 1.0, 1.5, 2.0]) + fit['first_slice'] * 0.040)
+
+def test_slab_plds_unshifted_without_look_locker(monkeypatch, tmp_path, slab_inputs):
+    fits, _ = run_slab_analysis(monkeypatch, tmp_path, slab_inputs, 'single-delay', 'vaby')
+    for fit in fits:
+        assert fit['plds'] == [0.5, 1.0, 1.5, 2.0]
+
+def test_slab_outputs_stitched(monkeypatch, tmp_path, slab_inputs):
+    _, output_map = run_slab_analysis(monkeypatch, tmp_path, slab_inputs, 'multi-delay Look-Locker', 'ssvb')
+    stitched = nib.load(os.path.join(output_map, 'output', 'native', 'perfusion.nii.gz')).get_fdata()
+    # brain slices 1-8 back in place (halo trimmed), slices without brain voxels 0, slab folders removed
+    np.testing.assert_array_equal(stitched[0, 0, 1:9], np.arange(1, 9))
+    np.testing.assert_array_equal(stitched[:, :, [0, 9]], 0)
+    assert not os.path.exists(os.path.join(output_map, 'slabs'))
+
+def test_run_qasl_inprocess_restores_argv():
+    seen = []
+
+    def fake_qasl_main():
+        seen.append(list(sys.argv))
+
+    saved_argv = sys.argv
+    qasl_module.run_qasl_inprocess(fake_qasl_main, ['-i', 'asl.nii', '--overwrite'])
+    assert seen == [['qasl', '-i', 'asl.nii', '--overwrite']]
+    assert sys.argv is saved_argv
+
+def test_run_qasl_inprocess_error():
+    def failing_qasl_main():
+        sys.exit(2)
+
+    saved_argv = sys.argv
+    with pytest.raises(subprocess.CalledProcessError):
+        qasl_module.run_qasl_inprocess(failing_qasl_main, ['-i', 'asl.nii'])
+    assert sys.argv is saved_argv
+
+def test_run_qasl_inprocess_concurrent():
+    # concurrent in-process fits are serialized: every fit sees its own arguments in sys.argv for its whole run
+    running = []
+    overlaps = []
+
+    def fake_qasl_main():
+        arguments = list(sys.argv)
+        running.append(arguments)
+        overlaps.append(len(running) > 1)
+        time.sleep(0.01)
+        assert sys.argv == arguments
+        running.remove(arguments)
+
+    saved_argv = sys.argv
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(qasl_module.run_qasl_inprocess, fake_qasl_main, ['-o', f'fit{index}']) for index in range(8)]
+        for future in futures:
+            future.result()
+    assert len(overlaps) == 8 and not any(overlaps)
+    assert sys.argv is saved_argv
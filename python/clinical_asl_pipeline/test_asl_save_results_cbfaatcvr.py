@@ -0,0 +1,59 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the concurrent export jobs (asl_export_jobs) with stand-in figure jobs in the spawned worker processes:
+    the worker log records and warnings reach the pipeline log, saved PNGs are logged, and failures are logged with
+    their file name.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import warnings
+import pytest
+from clinical_asl_pipeline.asl_save_results_cbfaatcvr import asl_export_jobs
+
+def fake_figure(path):
+    # Stand-in for save_figure_to_png in a worker process: logs, warns and writes the file
+    logging.info(f"rendering {os.path.basename(path)}")
+    warnings.warn(f"worker warning for {os.path.basename(path)}")
+    with open(path, 'w') as f:
+        f.write('png')
+
+def failing_figure(path):
+    raise ValueError(f"cannot render {os.path.basename(path)}")
+
+def figure_job(function, path, required=True):
+    return (f"PNG {os.path.basename(path)}", function, (path,), {}, required)
+
+def test_export_jobs_worker_logging(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    paths = [str(tmp_path / f'ASL_CBF_{index}.png') for index in range(2)]
+    failing = str(tmp_path / 'ASL_ATA.png')
+    figure_jobs = [figure_job(fake_figure, path) for path in paths] + [figure_job(failing_figure, failing, required=False)]
+    asl_export_jobs([], figure_jobs, [], n_workers=2)
+
+    messages = [record.getMessage() for record in caplog.records]
+    for path in paths:
+        name = os.path.basename(path)
+        assert os.path.exists(path)
+        assert f"rendering {name}" in messages
+        assert any(f"worker warning for {name}" in message for message in messages)
+        assert f"Saved PNG {name}" in messages
+    assert any(message.startswith("Failed to save PNG ASL_ATA.png") and "cannot render ASL_ATA.png" in message for message in messages)
+    assert "Saved PNG ASL_ATA.png" not in messages
+
+def test_export_jobs_required_failure(tmp_path, caplog):
+    figure_jobs = [figure_job(failing_figure, str(tmp_path / 'ASL_CVR.png'))]
+    with pytest.raises(ValueError, match='ASL_CVR.png'):
+        asl_export_jobs([], figure_jobs, [], n_workers=1)
+    assert any(record.getMessage().startswith("Failed to save PNG ASL_CVR.png") for record in caplog.records)
@@ -0,0 +1,50 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Little utility functions to hand numpy arrays to ANTsPy and back, without writing and
+    reading (compressed) NIfTI files in between pipeline steps.
+
+License: BSD 3-Clause License
+"""
+
+import ants
+import numpy as np
+
+# NIfTI affines are in RAS+ world coordinates, ITK/ANTs uses LPS+
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+def nifti_affine_to_ants_geometry(affine):
+    # Convert a NIfTI (nibabel) 4x4 affine to ANTs origin, spacing and direction (LPS convention)
+    # Returns:
+    #   origin (tuple), spacing (tuple), direction (3x3 np.ndarray)
+    affine = np.asarray(affine, dtype=np.float64)
+    spacing = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    direction = RAS_TO_LPS @ (affine[:3, :3] / spacing)
+    origin = RAS_TO_LPS @ affine[:3, 3]
+    return tuple(origin), tuple(spacing), direction
+
+def numpy_to_ants(data, affine):
+    # Build an ANTs image from a 3D or 4D numpy array in NIfTI voxel order (x, y, z[, t]) and its NIfTI affine.
+    # For 4D data the time axis gets unit spacing, as for ants.image_read of a 4D NIfTI without TR.
+    origin, spacing, direction = nifti_affine_to_ants_geometry(affine)
+    data = np.asarray(data, dtype=np.float32)
+
+    if data.ndim == 4:
+        origin = origin + (0.0,)
+        spacing = spacing + (1.0,)
+        direction4D = np.eye(4)
+        direction4D[:3, :3] = direction
+        direction = direction4D
+
+    return ants.from_numpy(data, origin=origin, spacing=spacing, direction=direction)
+
+def ants_to_numpy(img):
+    # Return the voxel data of an ANTs image as float64 numpy array in NIfTI voxel order
+    return img.numpy().astype(np.float64)
@@ -12,6 +12,7 @@ Contact: j.c.w.siero@umcutrecht.nl
 Description:
     Little utility functions for ClinicalASL, such as appending '_mc' to filenames for motion corrected files.
     Little utility functions for ClinicalASL, such as appending '_or' to filenames for outlier removed files.
+    Little utility functions for ClinicalASL, such as changing '.nii.gz' to '.nii' for uncompressed (temporary) files.
 
 
 License: BSD 3-Clause License
@@ -28,4 +29,10 @@ def append_or(filename):
     # Append '_or' before .nii.gz in filename (for outlier removedd files)."""
     if filename.endswith('.nii.gz'):
         return filename[:-7] + '_or.nii.gz'
-    return filename
\ No newline at end of file
+    return filename
+
+def uncompressed_nii(filename):
+    # Change .nii.gz to .nii in filename (for uncompressed, temporary files, e.g. QASL input)."""
+    if filename.endswith('.nii.gz'):
+        return filename[:-7] + '.nii'
+    return filename
@@ -0,0 +1,59 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Colormap loading utility module.
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Utility function to load a colormap by name, matplotlib built-ins and the custom .mat colormaps shipped with
+    ClinicalASL (vik, devon). Colormaps are loaded once per process and shared by the PNG and DICOM writers.
+
+License: BSD 3-Clause License
+"""
+
+import matplotlib.pyplot as plt
+import importlib.resources as pkg_resources
+from functools import lru_cache
+from matplotlib.colors import ListedColormap
+from scipy.io import loadmat
+
+def load_colormap(colormap_name):
+    """
+    Load a colormap by name, supporting both matplotlib built-ins and
+    custom .mat colormaps shipped with ClinicalASL (vik, devon).
+
+    The colormap is cached per process, the returned object is shared and must not be modified.
+
+    Parameters
+    ----------
+    colormap_name : str
+        'viridis', 'jet', 'vik', 'devon', or any matplotlib colormap name.
+
+    Returns
+    -------
+    cmap : matplotlib.colors.Colormap
+    """
+    return _load_colormap(colormap_name.lower())
+
+@lru_cache(maxsize=None)
+def _load_colormap(name_lower):
+    if name_lower in ['vik', 'devon']:
+        try:
+            with pkg_resources.files('clinical_asl_pipeline.colormaps').joinpath(f'{name_lower}.mat').open('rb') as f:
+                mat = loadmat(f)
+        except FileNotFoundError:
+            raise ValueError(f"Missing colormap file: {name_lower}.mat")
+
+        cmap_data = mat.get(name_lower)
+        if cmap_data is None:
+            raise ValueError(f"Could not find colormap data in {name_lower}.mat")
+        cmap = ListedColormap(cmap_data)
+    else:
+        cmap = plt.get_cmap(name_lower)
+
+    return cmap
@@ -41,6 +41,21 @@ def load_parameters(config_path=None):
         "range_ATA": [0, 125],
         "inference_method": "ssvb",
         "device": "cpu",
+        "motion_correction_engine": "parallel",
+        "motion_correction_workers": None,
+        "itk_threads_per_worker": 1,
+        "motion_estimation": "per_volume",
+        "registration_mode": "standard",
+        "stack_resampled_maps": True,
+        "single_resampling": False,
+        "crop_to_brain": True,
+        "crop_margin": 4,
+        "qasl_backend": "cli",
+        "m0_calibration": "qasl",
+        "aat_engine": "qasl",
+        "ata_engine": "qasl",
+        "qasl_slabs": 1,
+        "export_workers": None,
         "ASL_CONTEXT": ["baseline", "stimulus"],
         "context_study_tags": ["preACZ", "postACZ"],
         "dicomseries_description_patterns": ["*SOURCE*ASL*"]
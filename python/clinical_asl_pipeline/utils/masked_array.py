@@ -0,0 +1,67 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Compact masked-voxel representation for voxelwise computations: only the brain voxels of a dense 3D (or 3D + extra
+    dimensions) array are stored, as a contiguous (Nvox, ...) float32 block plus the flat index map of the mask.
+    Dense volumes are only rebuilt (scatter) when writing outputs.
+
+License: BSD 3-Clause License
+"""
+
+import numpy as np
+
+class MaskedVoxels:
+    # Brain voxels of a dense array as contiguous (Nvox, ...) block
+    # Attributes:
+    #   values: numpy array (Nvox, ...) of the voxel values, float32 by default
+    #   flat_index: 1D numpy array (Nvox) of the flat (C order) indices of the voxels in the 3D grid
+    #   shape: tuple (x, y, z) of the 3D grid
+    # Example:
+    #   voxels = MaskedVoxels.from_dense(PLDall, mask)    # (Nvox, t)
+    #   dense = voxels.scatter(fill_value=np.nan)        # (x, y, z, t)
+
+    def __init__(self, values, flat_index, shape):
+        self.values = values
+        self.flat_index = flat_index
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, data, mask, dtype=np.float32):
+        # Gather the voxels of data (x, y, z, ...) inside mask (x, y, z), voxels are in C order of the grid
+        mask = np.asarray(mask) > 0
+        flat_index = np.flatnonzero(mask)
+        values = np.ascontiguousarray(np.asarray(data).reshape(-1, *np.shape(data)[3:])[flat_index], dtype=dtype)
+        return cls(values, flat_index, mask.shape)
+
+    @property
+    def nvox(self):
+        return self.flat_index.size
+
+    @property
+    def mask(self):
+        # Dense boolean mask (x, y, z) of the voxels
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.flat_index] = True
+        return mask.reshape(self.shape)
+
+    def gather(self, data, dtype=np.float32):
+        # Gather the same voxels from another dense array (x, y, z, ...) on the same grid
+        return np.ascontiguousarray(np.asarray(data).reshape(-1, *np.shape(data)[3:])[self.flat_index], dtype=dtype)
+
+    def with_values(self, values):
+        # New container with the same voxels and other values (Nvox, ...), e.g. the result of a voxelwise computation
+        return MaskedVoxels(values, self.flat_index, self.shape)
+
+    def scatter(self, values=None, fill_value=0.0, dtype=np.float64):
+        # Dense array (x, y, z, ...) with the voxel values inside the mask and fill_value outside
+        values = self.values if values is None else np.asarray(values)
+        dense = np.full((int(np.prod(self.shape)),) + values.shape[1:], fill_value, dtype=dtype)
+        dense[self.flat_index] = values
+        return dense.reshape(self.shape + values.shape[1:])
@@ -0,0 +1,158 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+DICOM Palette Color LUT utility module.
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Utility functions to generate the 16-bit Palette Color LUTs of the PALETTE COLOR DICOM series,
+    mapping the stored uint16 pixel values through the colormap used for the PNG output.
+    The stored values are scaled by the value range of the map, so the LUT of a colormap is generated once per process.
+
+License: BSD 3-Clause License
+"""
+import numpy as np
+from functools import lru_cache
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
+from clinical_asl_pipeline.utils.load_colormap import load_colormap
+
+# Default colormap per map type (matches save_figure_to_png usage)
+DEFAULT_COLORMAPS = {
+    'CBF': 'viridis',
+    'CVR': 'vik',       # custom .mat, diverging
+    'AAT': 'devon',     # custom .mat
+    'ATA': 'viridis',
+}
+
+# Number of entries of the Palette Color LUT (16-bit stored pixel values)
+PALETTE_LEVELS = 65536
+
+
+def palette_scaling(value_range):
+    """
+    RescaleSlope and RescaleIntercept of the stored pixel values of a PALETTE COLOR series.
+
+    The stored values depend only on the value range: 0 is the background (black), 1 to
+    PALETTE_LEVELS - 1 span vmin to vmax linearly. The Palette Color LUT of a colormap is
+    therefore the same for every map and range (see palette_lut).
+        real_value = stored_value * slope + intercept
+
+    Parameters
+    ----------
+    value_range : tuple
+        (vmin, vmax) for colormap normalization (same as used for PNG output).
+
+    Returns
+    -------
+    slope, intercept : float
+    """
+    vmin, vmax = value_range
+    slope = (vmax - vmin) / (PALETTE_LEVELS - 2) if vmax != vmin else 1.0
+    return slope, vmin - slope
+
+
+def palette_stored_values(image, value_range):
+    """
+    Stored uint16 pixel values of a PALETTE COLOR series (see palette_scaling).
+
+    Values are clipped to value_range, zero values are set to 0 (black), matching PNG output.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Real values, NaN-free.
+    value_range : tuple
+        (vmin, vmax) for colormap normalization (same as used for PNG output).
+
+    Returns
+    -------
+    np.ndarray (uint16, shape of image)
+    """
+    vmin, vmax = value_range
+    if vmax == vmin:
+        normalized = np.full(image.shape, 0.5)
+    else:
+        normalized = np.clip((image - vmin) / (vmax - vmin), 0, 1)
+    stored = (1 + np.round(normalized * (PALETTE_LEVELS - 2))).astype(np.uint16)
+    stored[image == 0] = 0
+    return stored
+
+
+def generate_palette_lut(cmap):
+    """
+    Generate 65536-entry 16-bit Palette Color LUT that maps the stored uint16
+    pixel values of palette_stored_values through the colormap.
+
+    Index 0 is set to black (background/zero values), matching PNG output.
+
+    Parameters
+    ----------
+    cmap : matplotlib.colors.Colormap
+        Colormap to apply.
+
+    Returns
+    -------
+    red, green, blue : np.ndarray (uint16, length 65536)
+    """
+    indices = np.arange(PALETTE_LEVELS, dtype=np.float64)
+
+    # Stored values 1 to PALETTE_LEVELS - 1 span the colormap
+    normalized = np.clip((indices - 1) / (PALETTE_LEVELS - 2), 0, 1)
+
+    # Apply colormap
+    colors = cmap(normalized)[:, :3]  # (65536, 3) float [0,1]
+
+    # Set index 0 to black (background / zero values), matching PNG output
+    colors[0] = [0, 0, 0]
+
+    lut16 = (colors * 65535).astype(np.uint16)
+    return lut16[:, 0], lut16[:, 1], lut16[:, 2]
+
+
+@lru_cache(maxsize=None)
+def palette_lut(colormap_name):
+    """
+    Palette Color LUT of generate_palette_lut for a colormap by name, cached per process.
+
+    The stored values are scaled by value range (palette_stored_values), so the LUT depends
+    only on the colormap and is shared by all PALETTE COLOR series of that colormap.
+
+    Parameters
+    ----------
+    colormap_name : str
+        Colormap name, see load_colormap.
+
+    Returns
+    -------
+    red, green, blue : np.ndarray (uint16, length 65536, read-only)
+    """
+    lut = generate_palette_lut(load_colormap(colormap_name))
+    for channel in lut:
+        channel.flags.writeable = False
+    return lut
+
+
+def set_palette_color_tags(ds, red, green, blue):
+    """
+    Set DICOM Palette Color LUT tags on a dataset.
+
+    Parameters
+    ----------
+    ds : pydicom.Dataset
+    red, green, blue : np.ndarray (uint16, length 65536)
+    """
+    ds.PhotometricInterpretation = "PALETTE COLOR"
+    # 0 encodes 65536 entries per DICOM convention (PS3.3 C.7.6.3.1.6)
+    # Explicitly set VR to 'US' to resolve the ambiguous 'US or SS' VR for these tags
+    ds[Tag(0x0028, 0x1101)] = DataElement(Tag(0x0028, 0x1101), 'US', [0, 0, 16])
+    ds[Tag(0x0028, 0x1102)] = DataElement(Tag(0x0028, 0x1102), 'US', [0, 0, 16])
+    ds[Tag(0x0028, 0x1103)] = DataElement(Tag(0x0028, 0x1103), 'US', [0, 0, 16])
+    ds.RedPaletteColorLookupTableData = red.tobytes()
+    ds.GreenPaletteColorLookupTableData = green.tobytes()
+    ds.BluePaletteColorLookupTableData = blue.tobytes()
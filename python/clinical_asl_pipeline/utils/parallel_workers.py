@@ -0,0 +1,64 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Little utility functions for running pipeline steps concurrently in worker processes,
+    such as choosing the number of workers, limiting the ITK threads used per worker, and passing the log records
+    (and warnings) of the workers to the log handlers of the pipeline.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+
+def resolve_num_workers(requested=None, n_jobs=None, threads_per_worker=1):
+    # Number of worker processes to use.
+    # requested: user supplied number of workers (config), None or 0 -> use all available cores
+    # n_jobs: number of independent jobs, never start more workers than jobs
+    # threads_per_worker: threads each worker uses internally (e.g. ITK threads), cores are shared accordingly
+    if requested:
+        n_workers = int(requested)
+    else:
+        n_workers = max(1, (os.cpu_count() or 1) // max(1, int(threads_per_worker)))
+    if n_jobs is not None:
+        n_workers = min(n_workers, n_jobs)
+    return max(1, n_workers)
+
+def get_spawn_context():
+    # Use 'spawn' start method for worker processes: forking a process with active ITK/ANTs threads is not safe
+    return multiprocessing.get_context('spawn')
+
+def set_itk_threads(itk_threads):
+    # Limit the number of threads ITK (ANTs) uses in this process.
+    # Must be called before the first ITK filter runs in the process, i.e. in the worker initializer.
+    if itk_threads:
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(int(itk_threads))
+
+class _ParentLogHandler(logging.Handler):
+    # Pass a log record of a worker to the logger of the same name in this process (and so to the pipeline log handlers)
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+def start_worker_log_listener(mp_context):
+    # Queue for the log records of worker processes, and the started listener handling them in this process
+    # Returns: (queue, listener), pass the queue to init_worker_logging (initializer), stop the listener after the pool
+    queue = mp_context.Queue()
+    listener = QueueListener(queue, _ParentLogHandler())
+    listener.start()
+    return queue, listener
+
+def init_worker_logging(queue, level=logging.INFO):
+    # Worker initializer: send the log records and warnings of this (spawned, unconfigured) worker to the parent queue
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(queue)]
+    root.setLevel(level)
+    logging.captureWarnings(True)
@@ -0,0 +1,73 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Little utility functions for the PLD subsets of the multi-delay ASL series (2-to-last PLDs for CBF, 1-to-2 PLDs for ATA),
+    and the deltaM per PLD of the PLD ordered series.
+    The subsets are volume-index views on the PLD ordered master series context_data['PLDall_controllabel'], they are
+    only written to disk (uncompressed) right before QASL quantification and removed afterwards.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import logging
+import numpy as np
+from clinical_asl_pipeline.utils.append_filename import uncompressed_nii
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+# PLD subsets: key prefix in context_data -> (first PLD, last PLD + 1), None = up to the last PLD
+PLD_SUBSETS = {
+    'PLD2tolast': (1, None),  # 2-to-last PLDs for CBF
+    'PLD1to2': (0, 2),        # 1-to-2 PLDs for ATA
+}
+
+def pld_subset_view(context_data, subset):
+    # Volume-index view of a PLD subset on the PLD ordered master series (no copy)
+    # time order in PLDall is PLD (outer), repeat, control/label (inner), the number of volumes per PLD follows
+    # from the current series (i.e. after outlier removal)
+    PLDall = context_data['PLDall_controllabel']
+    n_vols_per_pld = PLDall.shape[3] // context_data['NPLDS']
+    first_pld, last_pld = PLD_SUBSETS[subset]
+    last_pld = context_data['NPLDS'] if last_pld is None else last_pld
+    return PLDall[:, :, :, first_pld * n_vols_per_pld:last_pld * n_vols_per_pld]
+
+def pld_series_voxels(context_data, mask):
+    # PLD ordered control/label series of a context in the brain voxels of mask (MaskedVoxels, float32): the compact copy
+    # kept for a cohort run (context_data['PLDall_controllabel_voxels'], asl_cohort_quantification.asl_release_dense_arrays),
+    # else gathered from the dense series in memory
+    voxels = context_data.get('PLDall_controllabel_voxels')
+    if voxels is not None:
+        return voxels
+    return MaskedVoxels.from_dense(context_data['PLDall_controllabel'], mask)
+
+def write_pld_subsets(context_data):
+    # Write the PLD subsets as uncompressed NIfTIs for QASL, updating context_data['<subset>_controllabel_path']
+    for subset in PLD_SUBSETS:
+        path = uncompressed_nii(context_data[f'{subset}_controllabel_path'])
+        logging.info(f"Writing PLD subset for quantification: {os.path.basename(path)}")
+        save_data_nifti(pld_subset_view(context_data, subset), path, context_data['gridNIFTI_path'], 1, None, None)
+        context_data[f'{subset}_controllabel_path'] = path
+
+def remove_pld_subsets(context_data):
+    # Remove the PLD subset NIfTIs written by write_pld_subsets
+    for subset in PLD_SUBSETS:
+        path = context_data[f'{subset}_controllabel_path']
+        if os.path.exists(path):
+            os.remove(path)
+
+def pld_deltaM(values, NPLDS, asl_scan):
+    # Mean difference signal control - tag per PLD of PLD ordered control/label voxel data
+    # values: (Nvox, time) voxel data in the PLD ordered layout, pairs tag-control for multi-delay Look-Locker (QASL --iaf=tc),
+    #         control-tag otherwise (--iaf=ct)
+    # Returns: (Nvox, NPLDS) deltaM, mean over the repeats
+    pairs = np.asarray(values, dtype=np.float64).reshape(values.shape[0], NPLDS, -1, 2)
+    deltaM = (pairs[..., 1] - pairs[..., 0]).mean(axis=2)
+    return deltaM if asl_scan == 'multi-delay Look-Locker' else -deltaM
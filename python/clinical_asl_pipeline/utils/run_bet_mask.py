@@ -26,14 +26,15 @@ def run_bet_mask(subject, context_tag):
     #
     # Run HD-BET CLI on the given M0 image, save result as expected mask_path.
     # default it uses the M0 as image to genreate the mask 
-    # extradata _path can be used to augment to the default image to base the brain mask on - ie the ASL data ith all the label/control data
+    # extradata can be used to augment to the default image to base the brain mask on - ie the ASL data ith all the label/control data,
+    # taken from memory (context_data['M0'] and context_data['PLDall_controllabel'])
     #
     #Returns:
     #    mask (np.ndarray): Boolean brain mask.
     #    nanmask (np.ndarray): Nan-masked brain mask.
     context_data = subject[context_tag]
     inputdata_path = context_data['M0_path']
-    extradata_path = context_data['PLDall_controllabel_path']
+    extradata = context_data.get('PLDall_controllabel')
     mask_output_path = context_data['mask_path']    
     sourceNIFTI_path = context_data['sourceNIFTI_path']
     device = subject['device']
@@ -43,10 +44,9 @@ def run_bet_mask(subject, context_tag):
     # Build HD-BET CLI command
     cmd = f"MKL_THREADING_LAYER=GNU hd-bet -i {inputdata_path} -o {mask_output_path} -device {device} --disable_tta --save_bet_mask"
 
-    if extradata_path and os.path.exists(extradata_path):
-        # Load input and extra data
-        inputdata = nib.load(inputdata_path).get_fdata()
-        extradata = nib.load(extradata_path).get_fdata()
+    if extradata is not None:
+        # Input and extra data from memory
+        inputdata = context_data['M0']
 
         # Ensure inputdata is 4D for concatenation
         if inputdata.ndim == 3:
@@ -59,7 +59,7 @@ def run_bet_mask(subject, context_tag):
         temp_bet_path = os.path.join(os.path.dirname(mask_output_path), "temp_for_bet.nii.gz")
         save_data_nifti(combineddata, temp_bet_path, sourceNIFTI_path, 1)
 
-        logging.info(f"Using combined data set for brain masking: sum of  {inputdata_path} and {extradata_path}")
+        logging.info(f"Using combined data set for brain masking: sum of  {inputdata_path} and the ASL control/label data")
         inputdata_path = temp_bet_path
         # run command HD-BET
         run_command_with_logging(cmd)
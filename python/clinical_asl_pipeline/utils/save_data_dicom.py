@@ -0,0 +1,568 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+DICOM saving utility module (quantitative grayscale and PALETTE COLOR output).
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Utility functions to save data as DICOM series using header information from a template file.
+    One export prepares the 16-bit scaling of a map once, and writes both the MONOCHROME2 (quantitative grayscale) and the
+    PALETTE COLOR series from that shared state. The PALETTE COLOR pixels are scaled by the value range of the map, so
+    its Palette Color LUT depends only on the colormap and is cached per process (palette_color_lut). The derived output template of a source DICOM (cleaned header, frame
+    selection, source reference) is built once per source (context) and cloned for every output series.
+    save_data_dicom_grayscale and save_data_dicom_color are thin wrappers writing one of the two series.
+
+License: BSD 3-Clause License
+"""
+import os
+import copy
+import logging
+import numpy as np
+import pydicom
+import datetime
+from functools import lru_cache
+from pydicom.uid import generate_uid
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.sequence import Sequence
+from pydicom.dataset import Dataset
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
+from clinical_asl_pipeline.__version__ import __version__ as TOOL_VERSION
+from clinical_asl_pipeline.utils.palette_color_lut import DEFAULT_COLORMAPS, palette_lut, palette_scaling, palette_stored_values, set_palette_color_tags
+
+IMPLEMENTATION_UID_ROOT = "1.3.6.1.4.1.54321.1.1" # Example root UID for ClinicalASL, fake PEN
+COLOR_SERIES_NUMBER_OFFSET = 100 # SeriesNumber offset of the PALETTE COLOR series to avoid collision with the grayscale series
+
+UNIT_STR = {
+    'CBF': 'ml/100g/min',
+    'CVR': 'ml/100g/min',
+    'ATA': 'ml/100g/min',
+    'AAT': 's'
+}
+
+# SOP classes of the output series: (MediaStorageSOPClassUID, SOPClassUID) per (series kind, multiframe)
+SOP_CLASS_UIDS = {
+    ('grayscale', True): ("1.2.840.10008.5.1.4.1.1.4", "1.2.840.10008.5.1.4.1.1.4.1"), # multiframe Enhanced MR Image Storage
+    ('grayscale', False): ("1.2.840.10008.5.1.4.1.1.4", "1.2.840.10008.5.1.4.1.1.4"), # singleframe MR Image Storage
+    ('color', True): ("1.2.840.10008.5.1.4.1.1.7.4", "1.2.840.10008.5.1.4.1.1.7.4"), # Multi-frame True Color Secondary Capture (SC) Image Storage
+    ('color', False): ("1.2.840.10008.5.1.4.1.1.7", "1.2.840.10008.5.1.4.1.1.7"), # Secondary Capture (SC) Image Storage
+}
+
+def set_common_metadata(ds, name, unit_str, type_tag, TOOL_VERSION):
+    now = datetime.datetime.now()
+    ds.ContentDate = now.strftime('%Y%m%d')
+    ds.ContentTime = now.strftime('%H%M%S.%f')
+    ds.ContentLabel = type_tag.upper()
+    ds.ContentDescription = f"ClinicalASL-Siero: {type_tag.upper()} [{unit_str}]"
+    ds.SeriesDescription = f"{name} - (RESEARCH ONLY - ClinicalASL)"
+    ds.DerivationDescription =  f"RESEARCH ONLY - ClinicalASL-Siero: {type_tag.upper()}"
+
+    # Document the derivation as post-processing in the DICOM metadata. This is important for traceability and to ensure that the DICOM files are correctly identified as derived products in PACS and other DICOM viewers.
+    code_item = Dataset()
+    code_item.CodeValue = "126302" # DCM:126302 identifies this image as a post-processed derivative.: Perfusion analysis by Arterial Spin Labeling (ASL) MR techniques, see DICOM PS3.16 2026b, Table D-1
+    code_item.CodingSchemeDesignator = "DCM"
+    code_item.CodeMeaning = "Post-processing"
+
+    ds.DerivationCodeSequence = Sequence([code_item])
+    ds.SoftwareVersions = f'ClinicalASL v{TOOL_VERSION}, https://github.com/JSIERO/ClinicalASL'
+    ds.InstitutionName = getattr(ds, 'InstitutionName', 'University Medical Center Utrecht')
+    ds.Manufacturer = f"ClinicalASL v{TOOL_VERSION}, https://github.com/JSIERO/ClinicalASL"
+    ds.ImageComments = "FOR RESEARCH PURPOSES ONLY"
+
+    ds.SeriesDescription = ds.SeriesDescription[:64]  # VR LO max length
+    ds.Manufacturer = ds.Manufacturer[:64]  # VR LO max length
+    ds.SoftwareVersions = ds.SoftwareVersions[:64]  # VR LO max length
+    ds.InstitutionName = ds.InstitutionName[:64]  # VR LO max length
+
+    ds.ProtocolName = name
+
+def read_source_dicom_reference(source_dicom_path):
+    # Read the SeriesInstanceUID, SOPInstanceUID and SOPClassUID of a source DICOM file for the ReferencedSeriesSequence.
+    # Returns: (series_uid, instance_uid, sop_class_uid), or None if the source DICOM cannot be read or misses UID fields
+    try:
+        return source_dicom_reference(pydicom.dcmread(source_dicom_path, stop_before_pixels=True))
+    except Exception as e:
+        logging.warning(f"Failed to add ReferencedSeriesSequence: {e}")
+    return None
+
+def source_dicom_reference(ref_ds):
+    # SeriesInstanceUID, SOPInstanceUID and SOPClassUID of a source DICOM header, None if it misses UID fields
+    ref_series_uid = getattr(ref_ds, 'SeriesInstanceUID', None)
+    ref_instance_uid = getattr(ref_ds, 'SOPInstanceUID', None)
+    ref_sop_class_uid = getattr(ref_ds, 'SOPClassUID', None)
+
+    if ref_series_uid and ref_instance_uid and ref_sop_class_uid:
+        return ref_series_uid, ref_instance_uid, ref_sop_class_uid
+    logging.warning("Source DICOM missing UID fields, skipping ReferencedSeriesSequence.")
+    return None
+
+def set_source_dicom_reference(ds, reference):
+    # Add a ReferencedSeriesSequence to the DICOM dataset from read_source_dicom_reference (None: nothing added)
+    if reference is None:
+        return
+    ref_series_uid, ref_instance_uid, ref_sop_class_uid = reference
+
+    referenced_instance = Dataset()
+    referenced_instance.ReferencedSOPClassUID = ref_sop_class_uid
+    referenced_instance.ReferencedSOPInstanceUID = ref_instance_uid
+
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = ref_series_uid
+    referenced_series.ReferencedInstanceSequence = Sequence([referenced_instance])
+
+    ds.ReferencedSeriesSequence = Sequence([referenced_series])
+    ds.ReferencedSOPInstanceUID = ref_instance_uid
+    ds.ReferencedSOPClassUID = ref_sop_class_uid
+
+def add_source_dicom_reference(ds, source_dicom_path):
+    # Add a ReferencedSeriesSequence to the DICOM dataset based on a source DICOM file.
+    # This function reads the source DICOM file to extract SeriesInstanceUID, SOPInstanceUID,
+    # and SOPClassUID, and adds them to the dataset's ReferencedSeriesSequence.
+    # Parameters
+    # ----------
+    # ds : pydicom.dataset.Dataset
+    #     The DICOM dataset to which the reference sequence will be added.
+    # source_dicom_path : str
+    #     Path to the source DICOM file from which to extract the reference information.
+    set_source_dicom_reference(ds, read_source_dicom_reference(source_dicom_path))
+
+def save_data_dicom(image, source_dicom_path, output_dicom_dir, name, value_range, type_tag, series_number_incr,
+                    grayscale=True, color=True, colormap_name=None, mask=None):
+    #
+    # Save a 3D ASL-derived image as a quantitative grayscale (MONOCHROME2) and a PALETTE COLOR DICOM series,
+    # either multiframe or single-frame, based on the structure of the provided reference DICOM.
+    # The template DICOM(s), frame selection, source reference and 16-bit scaling are prepared once for both series.
+
+    # Parameters
+    # ----------
+    # image : np.ndarray
+    #     3D ASL image array (Height, Width, Slices), typically from a NIfTI file.
+    # source_dicom_path : str
+    #     Path to a source DICOM file for referencing and as template in the output DICOM.
+    # output_dicom_dir : str
+    #     Directory where the output DICOM file(s) will be saved.
+    # name : str
+    #     Base for filename and Series/Protocol name of the grayscale series, the color series is named f"{name} COLOR".
+    # value_range : tuple
+    #     (min, max) specifying the value range for the VOI LUT (grayscale) and colormap normalization (color).
+    # type_tag : str
+    #     Label describing the quantitative map type, e.g., 'CBF', 'CVR', 'AAT', or 'ATA'.
+    # series_number_incr : int
+    #     Incremental value to set the SeriesNumber of the grayscale series, + COLOR_SERIES_NUMBER_OFFSET for the color series.
+    # grayscale, color : bool
+    #     Which of the two series to write.
+    # colormap_name : str or None
+    #     Colormap name of the color series. If None, uses DEFAULT_COLORMAPS[type_tag].
+    # mask : np.ndarray or None
+    #     3D mask array (same shape as image). Non-brain voxels (NaN or 0) are set to pixel value 0 in the color series,
+    #     mapping to black in the Palette Color LUT. Required for correct background rendering of signed data (e.g., CVR).
+    export = prepare_dicom_export(image, source_dicom_path, type_tag)
+    if grayscale:
+        write_dicom_series(export, output_dicom_dir, name, value_range, series_number_incr)
+    if color:
+        write_dicom_series(export, output_dicom_dir, f"{name} COLOR", value_range, series_number_incr + COLOR_SERIES_NUMBER_OFFSET,
+                           color=True, colormap_name=colormap_name, mask=mask)
+
+def prepare_dicom_export(image, source_dicom_path, type_tag):
+    # Prepare the shared state of the DICOM series of one map: the 16-bit scaled image and the derived output template
+    # of the source DICOM (built once per source, see derived_dicom_template).
+    # Returns: dict, input for write_dicom_series
+    # Notes
+    # -----
+    # - The image is scaled to 16-bit integer range for DICOM compatibility, signed (int16) for CVR; the PALETTE COLOR
+    #   series is scaled by its value range instead (color_pixels).
+    # - Output format is chosen based on whether the template DICOM is multiframe or single-frame.
+    if not type_tag:
+        raise ValueError("Please supply a type_tag such as 'CBF', 'CVR', 'AAT', or 'ATA'")
+
+    use_signed = type_tag.upper() == 'CVR'
+    image = np.nan_to_num(image, nan=0.0)
+
+    if use_signed:
+        abs_max = np.max(np.abs(image))
+        scalingfactor = (2**15 - 1) / abs_max
+        image_scaled = (image * scalingfactor).clip(-2**15, 2**15 - 1).astype(np.int16)
+    else:
+        scalingfactor = (2**16 - 1) / np.nanmax(image)
+        image_scaled = (image * scalingfactor).clip(0, 2**16 - 1).astype(np.uint16)
+
+    return {
+        'type_tag': type_tag,
+        'unit_str': UNIT_STR.get(type_tag.upper(), ''),
+        'use_signed': use_signed,
+        'scalingfactor': scalingfactor,
+        'image': image,
+        'image_scaled': image_scaled,
+        'template': derived_dicom_template(source_dicom_path, image.shape[2]),
+    }
+
+@lru_cache(maxsize=8)
+def derived_dicom_template(source_dicom_path, num_slices_needed):
+    # DerivedDicomTemplate of a source DICOM, built once per source (context) and shared by all its output series
+    return DerivedDicomTemplate(source_dicom_path, num_slices_needed)
+
+class DerivedDicomTemplate:
+    # Derived output template of one source ASL DICOM series: the cleaned header(s) without pixel data and the source
+    # reference, read and cleaned once. Output series are cheap clones (clone_dataset) of the template, only the UIDs,
+    # SeriesNumber, rescale values, display tags and PixelData are set per series. The template is never modified.
+    # Templates are read without their pixel data (stop_before_pixels), the output PixelData replaces it: the source
+    # pixels (all slices x PLDs x dynamics) are never loaded, decoded or decompressed.
+    # Attributes:
+    #   multiframe: True for an Enhanced (multiframe) template
+    #   header: multiframe header, with NumberOfFrames and the per-frame items of the slices only
+    #   frame_items: multiframe PerFrameFunctionalGroupsSequence items of the first PLD, dynamic and condition, one per slice
+    #   slice_headers: single-frame headers of the first dynamic and PLD, one per slice, sorted by slice position
+    #   reference: source reference (read_source_dicom_reference), the template is the source DICOM
+
+    def __init__(self, source_dicom_path, num_slices_needed):
+        header = pydicom.dcmread(source_dicom_path, force=True, stop_before_pixels=True)
+        self.reference = source_dicom_reference(header)
+        self.multiframe = hasattr(header, 'PerFrameFunctionalGroupsSequence')
+        logging.info(f"Template DICOM is {'multiframe' if self.multiframe else 'single-frame'}.")
+
+        if self.multiframe:
+            self.header, self.frame_items = self.multiframe_template(header)
+            self.slice_headers = None
+        else:
+            self.header, self.frame_items = None, None
+            self.slice_headers = [self.single_frame_template(ds, i)
+                                  for i, ds in enumerate(read_single_frame_templates(source_dicom_path, num_slices_needed))]
+
+        # parse all (raw) data elements now: from here on the template is only read, also by concurrent export threads
+        for ds in [self.header] if self.multiframe else self.slice_headers:
+            for _ in ds.iterall():
+                pass
+
+    def multiframe_template(self, ds):
+        # Clean the multiframe header: frame selection, pixel spacing, derived image and patient/study tags
+        if not hasattr(ds, "file_meta") or not hasattr(ds.file_meta, "TransferSyntaxUID"):
+            ds.file_meta = ds.file_meta or pydicom.dataset.FileMetaDataset()
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        # Extract scan dimensions from private tags
+        try:
+            private_seq = ds.PerFrameFunctionalGroupsSequence[0].get((0x2005, 0x140f))
+            nplds = int(ds.get((0x2001, 0x1017)).value)
+            ndyns = int(private_seq[0].get((0x0020, 0x0105)).value)
+            nslices = int(ds.get((0x2001, 0x1018)).value)
+            total_frames = int(ds.NumberOfFrames)
+            nconditions = total_frames // (nplds * ndyns * nslices)
+
+            logging.info(f"Template structure: {nslices} slices x {nplds} PLDs x {ndyns} dynamics x {nconditions} conditions")
+        except Exception as e:
+            raise ValueError(f"Failed to extract dimensions from private tags: {e}")
+
+        # Filter frames based on Z-position: the frames of the first PLD, dynamic and condition
+        selected_indices = get_frame_indices(pld=0, dynamic=0, condition=0, nslices=nslices, ndyns=ndyns, nplds=nplds)
+        original_pffs = ds.PerFrameFunctionalGroupsSequence
+        frame_items = [original_pffs[i] for i in selected_indices]
+        ds.PerFrameFunctionalGroupsSequence = Sequence(frame_items)
+        ds.NumberOfFrames = nslices
+
+        for frame in frame_items:
+            if hasattr(frame, "FrameVOILUTSequence"):
+                if 'CardiacSynchronizationSequence' in frame:
+                    cs_seq = frame.CardiacSynchronizationSequence
+                    for item in cs_seq:
+                        if 'TriggerTime' in item:
+                            del item.TriggerTime # Remove TriggerTime if present, not relevant for ASL-derived maps, PACS compatibility
+                if 'MRVelocityEncodingSequence' in frame:
+                    for item in frame.MRVelocityEncodingSequence:
+                        if 'VelocityEncodingDirection' in item:
+                            delattr(item, 'VelocityEncodingDirection')  # Remove VelocityEncodingDirection if present, not relevant for ASL-derived maps, PACS compatibility
+
+        # Pixel spacing and thickness
+        first_frame = frame_items[0]
+        try:
+            spacing = first_frame.PixelMeasuresSequence[0].PixelSpacing
+            ds.PixelSpacing = [float(spacing[0]), float(spacing[1])]
+        except Exception as e:
+            logging.warning(f"Failed to extract PixelSpacing: {e}")
+            ds.PixelSpacing = [1.0, 1.0]
+
+        try:
+            thickness = first_frame.PixelMeasuresSequence[0].SliceThickness
+            ds.SliceThickness = float(thickness)
+        except Exception:
+            ds.SliceThickness = 1.0
+
+        set_derived_image_tags(ds)
+        set_source_dicom_reference(ds, self.reference)
+        return ds, frame_items
+
+    def single_frame_template(self, ds, i):
+        # Clean the header of slice i: one dynamic and PLD, derived image and patient/study tags
+        if 'TriggerTime' in ds:
+            del ds.TriggerTime # Removing TriggerTime from DICOM as it is not applicable for ASL-derived map
+
+        private_tag = Tag(0x2005, 0x140f)  # Private Per-Frame Sequence
+        velocity_tag = Tag(0x0018, 0x9090)  # VelocityEncodingDirection
+        if private_tag in ds:
+            sequence = ds[private_tag].value
+            for item in sequence:
+                if velocity_tag in item:
+                    del item[velocity_tag]
+
+        if 'NumberOfTemporalPositions' in ds: # Ensure NumberOfTemporalPositions is set to 1 or it will cause issues with PACS slice ordering
+            ds.NumberOfTemporalPositions = 1
+        if Tag(0x2001, 0x1081) in ds: # Ensure number of dynamics, Tag(0x2001, 0x1081) is set to 'IS' and has a value of 1
+            ds[Tag(0x2001, 0x1081)] = DataElement(Tag(0x2001, 0x1081), 'IS', 1)
+        if 'TemporalPositionIdentifier' in ds: # Ensure TemporalPositionIdentifier is set to 1 or it will cause issues with PACS slice ordering
+            ds.TemporalPositionIdentifier = 1
+
+        ds.InstanceNumber = i + 1
+        ds.PixelSpacing = getattr(ds, 'PixelSpacing', [1.0, 1.0])
+        ds.SliceThickness = getattr(ds, 'SliceThickness', 1.0)
+
+        set_derived_image_tags(ds)
+        set_source_dicom_reference(ds, self.reference)
+        return ds
+
+def clone_dataset(ds):
+    # Cheap clone of a pydicom dataset: new top-level data elements sharing their values (sequences are not copied).
+    # Setting or deleting a top-level element of the clone leaves ds unchanged; nested items must be cloned before changing them
+    clone = Dataset()
+    for elem in ds:
+        clone.add(copy.copy(elem))
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is not None:
+        clone.file_meta = pydicom.dataset.FileMetaDataset(clone_dataset(file_meta))
+    return clone
+
+def get_frame_indices(pld, dynamic, condition, nslices, ndyns, nplds):
+    # Indices of the frames of all slices of one PLD, dynamic and condition in the multiframe template
+    return [
+        condition * nslices * ndyns * nplds +
+        s * ndyns * nplds +
+        dynamic * nplds +
+        pld
+        for s in range(nslices)
+    ]
+
+def read_single_frame_templates(template_dicom_path, num_slices_needed):
+    # Read the single-frame template DICOMs of the first dynamic and PLD, one per slice, sorted by slice position.
+    # Returns: list of pydicom datasets without pixel data (stop_before_pixels), up to num_slices_needed
+
+    # Get directory and prefix
+    template_dir = os.path.dirname(template_dicom_path)
+    template_prefix = os.path.basename(template_dicom_path).rsplit('_', 1)[0] + '_'
+
+    # Get all matching DICOM files
+    template_files = [
+        f for f in os.listdir(template_dir)
+        if f.startswith(template_prefix) and os.path.isfile(os.path.join(template_dir, f))
+    ]
+
+    # Read files and extract ImagePostionPatient, only select files with TemporalPositionIdentifier == 1, and Phase number (private tag 2001,1008, PLD) == 1
+    file_slice_pairs = []
+    headers = {}
+    for f in template_files:
+        path = os.path.join(template_dir, f)
+        try:
+            ds = pydicom.dcmread(path, force=True, stop_before_pixels=True)
+            temporal_pos = getattr(ds, 'TemporalPositionIdentifier', None)
+            phase_number = ds.get((0x2001, 0x1008), None).value
+            if temporal_pos == 1 and phase_number == 1:
+                image_position = getattr(ds, 'ImagePositionPatient', None)
+                image_z_coord = image_position[2]
+                if image_z_coord is not None:
+                    file_slice_pairs.append((f, image_z_coord))
+                    headers[f] = ds
+                else:
+                    logging.warning(f"Template DICOM {f} missing SliceLocation.")
+        except Exception as e:
+            logging.error(f"Error reading DICOM {f}: {e}")
+
+    # Sort by unique slice locations and pick the top N slices
+    unique_slices = {}
+    for f, image_z_coord in file_slice_pairs:
+        if image_z_coord not in unique_slices:
+            unique_slices[image_z_coord] = f
+    # Sort by slice location and select up to num_slices_needed
+    template_files_sorted = [
+        unique_slices[loc] for loc in sorted(unique_slices.keys())
+    ][:num_slices_needed]
+
+    return [headers[fname] for fname in template_files_sorted]
+
+def color_pixels(export, value_range, mask=None):
+    # Unsigned pixel values of the PALETTE COLOR series and their RescaleSlope and RescaleIntercept
+    # PALETTE COLOR requires unsigned pixel data (PixelRepresentation=0): the values (also signed CVR) are scaled by the
+    # value range, independent of the map, so that one cached LUT per colormap serves all series (palette_color_lut).
+    # Values outside the value range are clipped, the grayscale series keeps the full quantitative range.
+    image_scaled = palette_stored_values(export['image'], value_range)
+    rescale_slope, rescale_intercept = palette_scaling(value_range)
+
+    # Apply mask: set non-brain voxels to 0 so they map to LUT index 0 (black)
+    if mask is not None:
+        brain_mask = np.isfinite(mask) & (mask != 0)
+        image_scaled[~brain_mask] = 0
+    return image_scaled, rescale_slope, rescale_intercept
+
+def set_pixel_data(ds, pixels):
+    # Set the 16-bit PixelData, with an explicit VR (OW) as there is no source PixelData element to take it from
+    ds[Tag(0x7FE0, 0x0010)] = DataElement(Tag(0x7FE0, 0x0010), 'OW', pixels.tobytes())
+
+def set_derived_image_tags(ds):
+    # Tags shared by all derived output series of a template: image type, 16-bit single sample pixels, patient/study defaults
+    ds.ImageType = ['DERIVED', 'SECONDARY', 'QUANTITATIVE']
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.SamplesPerPixel = 1
+    ds.StudyInstanceUID = getattr(ds, 'StudyInstanceUID', generate_uid(prefix=IMPLEMENTATION_UID_ROOT + '.'))
+    ds.StudyID = getattr(ds, 'StudyID', 'Unknown')
+    ds.PatientName = getattr(ds, 'PatientName', 'Anonymous^Patient')
+    ds.PatientID = getattr(ds, 'PatientID', '000000')
+    ds.PatientBirthDate = getattr(ds, 'PatientBirthDate', '')
+    ds.PatientSex = getattr(ds, 'PatientSex', '')
+    ds.ReferringPhysicianName = getattr(ds, 'ReferringPhysicianName', 'Unknown^Referring Physician')
+    ds.StudyDate = getattr(ds, 'StudyDate', '')
+    ds.StudyTime = getattr(ds, 'StudyTime', '')
+    ds.AccessionNumber = getattr(ds, 'AccessionNumber', '')
+
+def set_series_identity(ds, sop_class_uids, series_number_incr, type_tag):
+    # New SOP instance UIDs and file meta, and the SeriesNumber of an output dataset
+    media_storage_sop_class_uid, sop_class_uid = sop_class_uids
+    uid = generate_uid(prefix=IMPLEMENTATION_UID_ROOT + '.')
+    ds.file_meta = ds.file_meta or pydicom.dataset.FileMetaDataset()
+    ds.file_meta.MediaStorageSOPInstanceUID = uid
+    ds.file_meta.MediaStorageSOPClassUID = pydicom.uid.UID(media_storage_sop_class_uid)
+    ds.file_meta.FileMetaInformationVersion = b'\x00\x01'
+    ds.file_meta.ImplementationClassUID = IMPLEMENTATION_UID_ROOT
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds.SOPInstanceUID = uid
+    ds.SOPClassUID = pydicom.uid.UID(sop_class_uid)
+
+    ds.SeriesNumber = int(getattr(ds, 'SeriesNumber', 0)) + 10 + series_number_incr # Increment SeriesNumber to avoid conflicts with existing series
+    if type_tag.upper() == 'CVR':
+        ds.SeriesNumber = 888  # Special case for CVR to avoid conflicts with CBF series
+
+def write_dicom_series(export, output_dicom_dir, name, value_range, series_number_incr, color=False, colormap_name=None, mask=None):
+    # Write one DICOM series of a prepared export (prepare_dicom_export): quantitative grayscale (MONOCHROME2),
+    # or PALETTE COLOR with an embedded colormap LUT for direct color rendering in PACS viewers (color=True).
+    # Quantitative values are preserved via RescaleSlope/RescaleIntercept in both.
+    # Notes
+    # -----
+    # - For multiframe, the image is stored as a single DICOM file with multiple frames.
+    # - For single-frame, each slice is saved as a separate DICOM file with InstanceNumber.
+    # - Orientation/layout is matched to Philips DICOM conventions.
+    # - The datasets are clones of the derived output template (export['template']), which is left unchanged.
+    type_tag = export['type_tag']
+    scalingfactor = export['scalingfactor']
+    template = export['template']
+    kind = 'color' if color else 'grayscale'
+    label = 'PALETTE COLOR DICOM' if color else 'DICOM'
+
+    if color:
+        if colormap_name is None:
+            colormap_name = DEFAULT_COLORMAPS.get(type_tag.upper(), 'viridis')
+        image_scaled, rescale_slope, rescale_intercept = color_pixels(export, value_range, mask)
+        # 65536-entry Palette Color LUT of the colormap (generated once per process)
+        lut_red, lut_green, lut_blue = palette_lut(colormap_name)
+        logging.info(f"Applying PALETTE COLOR with colormap '{colormap_name}', range {value_range} for {type_tag}")
+        pixel_representation = 0  # always unsigned for PALETTE COLOR
+    else:
+        image_scaled = export['image_scaled']
+        rescale_slope = 1.0 / scalingfactor
+        rescale_intercept = 0.0
+        pixel_representation = 1 if export['use_signed'] else 0
+
+    if template.multiframe:
+        ds = clone_dataset(template.header)
+
+        # Slice pixel data and assign
+        image_fordicom = np.flip(np.transpose(image_scaled, (2, 1, 0)), axis=1)
+        set_pixel_data(ds, image_fordicom)
+
+        ds.SeriesInstanceUID = generate_uid(prefix=IMPLEMENTATION_UID_ROOT + '.')
+        set_series_identity(ds, SOP_CLASS_UIDS[(kind, True)], series_number_incr, type_tag)
+        ds.PixelRepresentation = pixel_representation
+        if color:
+            # PALETTE COLOR with embedded LUT (replaces MONOCHROME2)
+            set_palette_color_tags(ds, lut_red, lut_green, lut_blue)
+        else:
+            ds.PhotometricInterpretation = "MONOCHROME2"
+
+        smallest = int(np.min(image_scaled))
+        largest = int(np.max(image_scaled))
+        vr = 'SS' if pixel_representation else 'US'
+        ds[Tag(0x0028, 0x0106)] = DataElement(Tag(0x0028, 0x0106), vr, smallest)
+        ds[Tag(0x0028, 0x0107)] = DataElement(Tag(0x0028, 0x0107), vr, largest)
+
+        set_common_metadata(ds, name, export['unit_str'], type_tag, TOOL_VERSION)
+
+        # Per-frame sequences: clone the frame items of the template, with the rescale and W/L of this series
+        frames = []
+        for template_frame in template.frame_items:
+            frame = clone_dataset(template_frame)
+            if hasattr(frame, "PixelValueTransformationSequence"):
+                transformation = clone_dataset(frame.PixelValueTransformationSequence[0])
+                transformation.RescaleSlope = f"{rescale_slope:.10g}"
+                transformation.RescaleIntercept = f"{rescale_intercept:.10g}" if color else 0.0
+                frame.PixelValueTransformationSequence = Sequence([transformation])
+            if hasattr(frame, "FrameVOILUTSequence"):
+                if color:
+                    del frame.FrameVOILUTSequence # W/L not meaningful for PALETTE COLOR, the LUT defines the display mapping
+                else:
+                    voi_lut = clone_dataset(frame.FrameVOILUTSequence[0])
+                    voi_lut.WindowCenter = f"{np.mean(value_range):.10g}"
+                    voi_lut.WindowWidth = f"{np.ptp(value_range):.10g}"
+                    frame.FrameVOILUTSequence = Sequence([voi_lut])
+            frames.append(frame)
+        ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+
+        output_filename = f"{name.replace(' ', '_')}_{ds.SeriesNumber}.dcm"
+        output_path = os.path.join(output_dicom_dir, f"{output_filename}")
+
+        ds.save_as(output_path, enforce_file_format=True)
+        logging.info(f"Saved multi-frame {label}: {output_path}")
+
+    else:
+        # --- SINGLEFRAME EXPORT ---
+        series_instance_uid = generate_uid(prefix=IMPLEMENTATION_UID_ROOT + '.')
+
+        for i, slice_header in enumerate(template.slice_headers):
+            ds = clone_dataset(slice_header)
+            ds.SeriesInstanceUID = series_instance_uid
+            set_series_identity(ds, SOP_CLASS_UIDS[(kind, False)], series_number_incr, type_tag)
+
+            ds.RescaleSlope = f"{rescale_slope:.10g}"
+            ds.RescaleIntercept = f"{rescale_intercept:.10g}" if color else 0.0
+            ds.PixelRepresentation = pixel_representation
+            if color:
+                # PALETTE COLOR with embedded LUT (replaces MONOCHROME2)
+                set_palette_color_tags(ds, lut_red, lut_green, lut_blue)
+                # Remove W/L - not meaningful for PALETTE COLOR, the LUT defines the display mapping
+                if hasattr(ds, 'WindowCenter'):
+                    del ds.WindowCenter
+                if hasattr(ds, 'WindowWidth'):
+                    del ds.WindowWidth
+            else:
+                ds.PhotometricInterpretation = "MONOCHROME2"
+                ds.WindowCenter = f"{np.mean(value_range):.10g}"
+                ds.WindowWidth = f"{np.ptp(value_range):.10g}"
+
+            slice_img = np.flipud(image_scaled[:, :, i].T)
+            ds.Rows, ds.Columns = slice_img.shape
+            set_pixel_data(ds, slice_img)
+
+            set_common_metadata(ds, name, export['unit_str'], type_tag, TOOL_VERSION)
+
+            output_filename = f"{name.replace(' ', '_')}_{ds.SeriesNumber}_{ds.InstanceNumber}.dcm"
+            output_path = os.path.join(output_dicom_dir, output_filename)
+
+            ds.save_as(output_path, enforce_file_format=True)
+            logging.info(f"Saved single-frame {label}: {output_path}")
+            # logging of key metadata
+            logging.info(f"StudyID singleframe-derived DICOM: {ds.StudyID}")
+            logging.info(f"StudyInstanceUID singleframe-derived DICOM: {ds.StudyInstanceUID}")
+            logging.info(f"PatientID singleframe-derived DICOM: {ds.PatientID}")
+            logging.info(f"StudyDate singleframe-derived DICOM: {ds.StudyDate}")
+            logging.info(f"StudyTime singleframe-derived DICOM: {ds.StudyTime}")
@@ -18,9 +18,8 @@ License: BSD 3-Clause License
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-import importlib.resources as pkg_resources
 from matplotlib.colors import ListedColormap
-from scipy.io import loadmat
+from clinical_asl_pipeline.utils.load_colormap import load_colormap
 
 def save_figure_to_png(data, mask, datarange, outputloc, suffix, title,  label, colormap='viridis'):
     # Save a 3D data montage to PNG with black background and white labels.
@@ -45,25 +44,10 @@ def save_figure_to_png(data, mask, datarange, outputloc, suffix, title,  label,
     #   - Saves the figure as a PNG with a black background.
     # -----------------------------------------------------------------------------
     
-    # Load colormap
-    if colormap.lower() == 'viridis':
-        cmap = plt.get_cmap('viridis')
-    elif colormap.lower() == 'jet':
-        cmap = plt.get_cmap('jet')
-    elif colormap.lower() in ['vik', 'devon']:
-        try:
-            with pkg_resources.files('clinical_asl_pipeline.colormaps').joinpath(f'{colormap.lower()}.mat').open('rb') as f:
-                mat = loadmat(f)
-        except FileNotFoundError:
-            raise ValueError(f"Missing colormap file: {colormap.lower()}.mat")
-
-        cmap_data = mat.get(colormap.lower())
-        if cmap_data is None:
-            raise ValueError(f"Could not find colormap data in {colormap.lower()}.mat")
-        
-        cmap = ListedColormap(cmap_data)
-    else:
+    # Load colormap (cached per process, shared with the DICOM writers)
+    if colormap.lower() not in ['viridis', 'jet', 'vik', 'devon']:
         raise ValueError(f"Unknown colormap: {colormap}")
+    cmap = load_colormap(colormap)
 
     # Set first color to black (for background/zero values)
     cmap_array = cmap(np.linspace(0, 1, 256))
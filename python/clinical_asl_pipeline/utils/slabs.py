@@ -0,0 +1,75 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Little utility functions to split a volume into slabs of slices for parallel voxelwise fits, and to stitch the
+    outputs of the slab fits back together.
+    A slab is a contiguous range of slices, optionally extended with halo slices on both sides (for fits with a spatial
+    prior); only the core slices of a slab are kept when stitching. Slabs are balanced by the number of brain voxels.
+
+License: BSD 3-Clause License
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.utils.save_data_nifti import save_data_nifti
+
+def slab_ranges(mask, nslabs, halo=0):
+    # Split the slices with brain voxels into at most nslabs slabs with about equal numbers of brain voxels
+    # mask: 3D brain mask (x, y, z); nslabs: number of slabs; halo: number of extra slices on both sides of a slab
+    # Returns: list of (start, stop, core_start, core_stop) slice ranges, start/stop with halo, core without
+    voxels_per_slice = np.count_nonzero(np.asarray(mask) > 0, axis=(0, 1))
+    slices = np.flatnonzero(voxels_per_slice)
+    if slices.size == 0:
+        return []
+    nslabs = max(1, min(nslabs, slices.size))
+    # slab boundaries at equal fractions of the cumulative brain voxel count
+    cumulative = np.cumsum(voxels_per_slice[slices])
+    boundaries = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, nslabs) / nslabs, side='right')
+    boundaries = np.unique(np.clip(boundaries, 1, slices.size - 1))
+    ranges = []
+    for first, last in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [slices.size]])):
+        core_start, core_stop = int(slices[first]), int(slices[last - 1]) + 1
+        start, stop = max(0, core_start - halo), min(len(voxels_per_slice), core_stop + halo)
+        ranges.append((start, stop, core_start, core_stop))
+    return ranges
+
+def write_slab(location_nifti, location_slab, start, stop):
+    # Write slices start:stop of a NIfTI (3D or 4D) as a new NIfTI, the affine shifted to the position of the slab
+    img = nib.load(location_nifti)
+    nib.save(img.slicer[:, :, start:stop], location_slab)
+    return location_slab
+
+def stitch_slabs(slab_maps, ranges, output_map, location_template, relative_path=''):
+    # Stitch the NIfTI outputs of the slab fits into full volumes, the core slices of every slab
+    # slab_maps: output folders of the slab fits, in the order of ranges; ranges: slab_ranges
+    # output_map: output folder of the stitched files, same relative paths as in the slab folders
+    # location_template: NIfTI on the full grid for the header and affine (e.g. the brain mask)
+    # relative_path: subfolder of the slab folders to stitch (recursively), e.g. 'output'
+    # Returns: list of the stitched file paths
+    stitched = []
+    first_map = os.path.join(slab_maps[0], relative_path)
+    full_shape = nib.load(location_template).shape[:3]
+    for folder, _, files in os.walk(first_map):
+        for filename in sorted(files):
+            if not filename.endswith(('.nii', '.nii.gz')):
+                continue
+            relative_file = os.path.relpath(os.path.join(folder, filename), slab_maps[0])
+            data = None
+            for slab_map, (start, _, core_start, core_stop) in zip(slab_maps, ranges):
+                slab_data = np.asanyarray(nib.load(os.path.join(slab_map, relative_file)).dataobj)
+                if data is None:
+                    data = np.zeros(full_shape + slab_data.shape[3:], dtype=slab_data.dtype)
+                data[:, :, core_start:core_stop] = slab_data[:, :, core_start - start:core_stop - start]
+            path = os.path.join(output_map, relative_file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_data_nifti(data, path, location_template, 1, None, None)
+            stitched.append(path)
+    return stitched
@@ -0,0 +1,112 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the masked-voxel representation (MaskedVoxels): gather and scatter of 3D and 4D arrays, dtypes and fill values.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import numpy as np
+from clinical_asl_pipeline.utils.masked_array import MaskedVoxels
+
+def make_data(rng, extra_shape=()):
+    # Random data on a small 3D grid (plus extra dimensions) and a mask with about half of the voxels
+    data = rng.normal(size=(4, 5, 3) + extra_shape)
+    mask = rng.random((4, 5, 3)) > 0.5
+    return data, mask
+
+def test_from_dense_3d():
+    data, mask = make_data(np.random.default_rng(0))
+    voxels = MaskedVoxels.from_dense(data, mask)
+    assert voxels.nvox == np.count_nonzero(mask)
+    assert voxels.shape == mask.shape
+    assert voxels.values.dtype == np.float32
+    assert voxels.values.flags['C_CONTIGUOUS']
+    np.testing.assert_array_equal(voxels.mask, mask)
+    # voxels in C order of the grid, as boolean indexing
+    np.testing.assert_array_equal(voxels.values, data[mask].astype(np.float32))
+
+def test_from_dense_4d_dtype():
+    data, mask = make_data(np.random.default_rng(1), extra_shape=(6,))
+    voxels = MaskedVoxels.from_dense(data, mask, dtype=np.float64)
+    assert voxels.values.shape == (np.count_nonzero(mask), 6)
+    assert voxels.values.dtype == np.float64
+    np.testing.assert_array_equal(voxels.values, data[mask])
+
+def test_from_dense_nonboolean_mask():
+    # mask values > 0 are brain voxels, e.g. a float mask read from NIfTI
+    data, mask = make_data(np.random.default_rng(2))
+    voxels = MaskedVoxels.from_dense(data, np.where(mask, 1.0, 0.0))
+    np.testing.assert_array_equal(voxels.mask, mask)
+
+def test_gather():
+    rng = np.random.default_rng(3)
+    data, mask = make_data(rng)
+    voxels = MaskedVoxels.from_dense(data, mask)
+    other = rng.normal(size=mask.shape + (2,))
+    gathered = voxels.gather(other, dtype=np.float64)
+    assert gathered.dtype == np.float64
+    np.testing.assert_array_equal(gathered, other[mask])
+    assert voxels.gather(other).dtype == np.float32
+
+def test_scatter_roundtrip_3d():
+    data, mask = make_data(np.random.default_rng(4))
+    voxels = MaskedVoxels.from_dense(data, mask, dtype=np.float64)
+    dense = voxels.scatter()
+    assert dense.shape == mask.shape
+    assert dense.dtype == np.float64
+    np.testing.assert_array_equal(dense[mask], data[mask])
+    np.testing.assert_array_equal(dense[~mask], 0.0)
+
+def test_scatter_fill_value_and_dtype():
+    data, mask = make_data(np.random.default_rng(5))
+    voxels = MaskedVoxels.from_dense(data, mask)
+    dense = voxels.scatter(fill_value=np.nan)
+    assert np.all(np.isnan(dense[~mask]))
+    assert not np.any(np.isnan(dense[mask]))
+    dense = voxels.scatter(fill_value=-1, dtype=np.float32)
+    assert dense.dtype == np.float32
+    np.testing.assert_array_equal(dense[~mask], -1)
+    np.testing.assert_array_equal(dense[mask], voxels.values)
+
+def test_scatter_roundtrip_4d():
+    data, mask = make_data(np.random.default_rng(6), extra_shape=(3,))
+    voxels = MaskedVoxels.from_dense(data, mask, dtype=np.float64)
+    dense = voxels.scatter(fill_value=np.nan)
+    assert dense.shape == data.shape
+    np.testing.assert_array_equal(dense[mask], data[mask])
+    assert np.all(np.isnan(dense[~mask]))
+
+def test_scatter_other_values():
+    # values of a voxelwise computation, with other trailing dimensions than the stored values
+    data, mask = make_data(np.random.default_rng(7), extra_shape=(3,))
+    voxels = MaskedVoxels.from_dense(data, mask)
+    dense = voxels.scatter(voxels.values.sum(axis=1))
+    assert dense.shape == mask.shape
+    np.testing.assert_allclose(dense[mask], data[mask].sum(axis=1), rtol=1e-5)
+
+def test_with_values():
+    data, mask = make_data(np.random.default_rng(8), extra_shape=(2,))
+    voxels = MaskedVoxels.from_dense(data, mask)
+    result = voxels.with_values(voxels.values[:, 0] * 2)
+    assert result.flat_index is voxels.flat_index
+    assert result.shape == voxels.shape
+    assert result.nvox == voxels.nvox
+    np.testing.assert_allclose(result.scatter()[mask], data[mask][:, 0] * 2, rtol=1e-6)
+    # the original container is unchanged
+    assert voxels.values.shape == (voxels.nvox, 2)
+
+def test_empty_mask():
+    data = np.ones((2, 2, 2))
+    voxels = MaskedVoxels.from_dense(data, np.zeros((2, 2, 2)))
+    assert voxels.nvox == 0
+    assert voxels.values.shape == (0,)
+    np.testing.assert_array_equal(voxels.scatter(fill_value=np.nan), np.full((2, 2, 2), np.nan))
@@ -0,0 +1,53 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the Palette Color LUT utilities: the stored values of the PALETTE COLOR series scaled by value range, their
+    RescaleSlope/RescaleIntercept, and the cached LUT per colormap.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import numpy as np
+from clinical_asl_pipeline.utils.load_colormap import load_colormap
+from clinical_asl_pipeline.utils.palette_color_lut import PALETTE_LEVELS, palette_lut, palette_scaling, palette_stored_values
+
+def test_stored_values_roundtrip():
+    rng = np.random.default_rng(0)
+    value_range = (-50, 50)
+    image = rng.uniform(-50, 50, size=(6, 5, 4))
+    stored = palette_stored_values(image, value_range)
+    assert stored.dtype == np.uint16
+    slope, intercept = palette_scaling(value_range)
+    # real values back within half a stored step
+    np.testing.assert_allclose(stored * slope + intercept, image, atol=slope / 2 + 1e-9)
+
+def test_stored_values_range_and_background():
+    value_range = (0, 100)
+    image = np.array([0.0, -5.0, 0.0001, 50.0, 100.0, 250.0])
+    stored = palette_stored_values(image, value_range)
+    # zero is the background (black), values outside the range are clipped to its ends
+    assert stored[0] == 0
+    assert stored[1] == 1 and stored[2] == 1
+    assert stored[4] == PALETTE_LEVELS - 1 and stored[5] == PALETTE_LEVELS - 1
+    slope, intercept = palette_scaling(value_range)
+    assert abs(stored[3] * slope + intercept - 50.0) <= slope / 2
+
+def test_palette_lut_cached_per_colormap():
+    red, green, blue = palette_lut('viridis')
+    assert palette_lut('viridis')[0] is red
+    assert red.shape == (PALETTE_LEVELS,) and red.dtype == np.uint16
+    assert not red.flags.writeable
+    # index 0 black, stored values 1 and PALETTE_LEVELS - 1 the ends of the colormap
+    assert red[0] == green[0] == blue[0] == 0
+    cmap = load_colormap('viridis')
+    for index, normalized in ((1, 0.0), (PALETTE_LEVELS - 1, 1.0)):
+        expected = (np.asarray(cmap(normalized)[:3]) * 65535).astype(np.uint16)
+        np.testing.assert_array_equal([red[index], green[index], blue[index]], expected)
@@ -0,0 +1,120 @@
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMCU (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    Tests of the slab utilities: voxel-balanced slab ranges, halo slices, writing slabs, and stitching the slab outputs
+    (3D and 4D) back into full volumes.
+    Run with: python -m pytest (from the python folder)
+
+License: BSD 3-Clause License
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+from clinical_asl_pipeline.utils.slabs import slab_ranges, write_slab, stitch_slabs
+
+AFFINE = np.diag([3.0, 3.0, 6.0, 1.0])
+
+def make_mask(voxels_per_slice, shape_xy=(8, 8)):
+    # 3D mask with the given number of brain voxels in every slice
+    mask = np.zeros(shape_xy + (len(voxels_per_slice),), dtype=bool)
+    for z, nvox in enumerate(voxels_per_slice):
+        mask[:, :, z].flat[:nvox] = True
+    return mask
+
+def test_slab_ranges_cover_brain_slices():
+    # slices 0 and 9 without brain voxels
+    mask = make_mask([0, 10, 20, 30, 40, 40, 30, 20, 10, 0])
+    ranges = slab_ranges(mask, 3)
+    assert len(ranges) == 3
+    cores = [(core_start, core_stop) for _, _, core_start, core_stop in ranges]
+    assert cores[0][0] == 1 and cores[-1][1] == 9
+    # contiguous cores, no overlap
+    for (_, stop), (start, _) in zip(cores[:-1], cores[1:]):
+        assert stop == start
+    # without halo, the slabs are the cores
+    assert all(start == core_start and stop == core_stop for start, stop, core_start, core_stop in ranges)
+
+def test_slab_ranges_voxel_balanced():
+    voxels_per_slice = [5, 5, 5, 5, 5, 5, 60, 60, 5, 5]
+    mask = make_mask(voxels_per_slice)
+    ranges = slab_ranges(mask, 2)
+    counts = [mask[:, :, core_start:core_stop].sum() for _, _, core_start, core_stop in ranges]
+    assert sum(counts) == mask.sum()
+    # balanced by brain voxels, not by slices: at most one slice off the equal split
+    assert max(counts) - mask.sum() / 2 <= max(voxels_per_slice)
+    assert ranges[0][3] - ranges[0][2] > ranges[1][3] - ranges[1][2]
+
+def test_slab_ranges_halo():
+    mask = make_mask([10] * 12)
+    ranges = slab_ranges(mask, 3, halo=2)
+    for start, stop, core_start, core_stop in ranges:
+        assert start == max(0, core_start - 2)
+        assert stop == min(12, core_stop + 2)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 12
+
+def test_slab_ranges_more_slabs_than_slices():
+    mask = make_mask([0, 10, 10, 0])
+    assert len(slab_ranges(mask, 8)) == 2
+    assert slab_ranges(mask, 0) == [(1, 3, 1, 3)]
+
+def test_slab_ranges_empty_mask():
+    assert slab_ranges(np.zeros((4, 4, 4)), 2) == []
+
+def test_write_slab_affine(tmp_path):
+    data = np.arange(4 * 4 * 6, dtype=np.float32).reshape(4, 4, 6)
+    location = str(tmp_path / 'volume.nii')
+    nib.save(nib.Nifti1Image(data, AFFINE), location)
+    slab = nib.load(write_slab(location, str(tmp_path / 'slab.nii'), 2, 5))
+    np.testing.assert_array_equal(slab.get_fdata(), data[:, :, 2:5])
+    # voxel (0, 0, 0) of the slab is voxel (0, 0, 2) of the volume
+    np.testing.assert_allclose(slab.affine @ [0, 0, 0, 1], AFFINE @ [0, 0, 2, 1])
+
+def stitch_roundtrip(tmp_path, data, mask, nslabs, halo):
+    # Write the slabs of data as the outputs of slab fits (halo slices overwritten), stitch, and return the stitched volume
+    location_template = str(tmp_path / 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask.astype(np.float32), AFFINE), location_template)
+    ranges = slab_ranges(mask, nslabs, halo)
+    slab_maps = []
+    for index, (start, stop, core_start, core_stop) in enumerate(ranges):
+        slab_map = str(tmp_path / 'slabs' / f'slab{index}')
+        os.makedirs(os.path.join(slab_map, 'output', 'native'))
+        slab_data = data[:, :, start:stop].copy()
+        slab_data[:, :, :core_start - start] = -1  # halo slices are not stitched
+        slab_data[:, :, core_stop - start:] = -1
+        nib.save(nib.Nifti1Image(slab_data, AFFINE), os.path.join(slab_map, 'output', 'native', 'perfusion.nii.gz'))
+        with open(os.path.join(slab_map, 'output', 'logfile'), 'w') as f:
+            f.write('not a NIfTI')
+        slab_maps.append(slab_map)
+
+    output_map = str(tmp_path / 'stitched')
+    stitched = stitch_slabs(slab_maps, ranges, output_map, location_template, relative_path='output')
+    assert stitched == [os.path.join(output_map, 'output', 'native', 'perfusion.nii.gz')]
+    return nib.load(stitched[0])
+
+def test_stitch_slabs_roundtrip_3d(tmp_path):
+    rng = np.random.default_rng(0)
+    mask = make_mask([0, 20, 30, 40, 40, 30, 20, 0])
+    data = rng.normal(size=mask.shape).astype(np.float32)
+    img = stitch_roundtrip(tmp_path, data, mask, nslabs=3, halo=1)
+    stitched = img.get_fdata()
+    assert stitched.shape == mask.shape
+    np.testing.assert_allclose(stitched[:, :, 1:7], data[:, :, 1:7], rtol=1e-6)
+    # slices without brain voxels are in no slab
+    np.testing.assert_array_equal(stitched[:, :, [0, 7]], 0)
+    np.testing.assert_allclose(img.affine, AFFINE)
+
+def test_stitch_slabs_roundtrip_4d(tmp_path):
+    rng = np.random.default_rng(1)
+    mask = make_mask([10, 20, 30, 40, 40, 30])
+    data = rng.normal(size=mask.shape + (3,)).astype(np.float32)
+    stitched = stitch_roundtrip(tmp_path, data, mask, nslabs=2, halo=2).get_fdata()
+    assert stitched.shape == data.shape
+    np.testing.assert_allclose(stitched, data, rtol=1e-6)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+ClinicalASL - Clinical Arterial Spin Labeling processing pipeline
+
+Cohort script for batch reprocessing of ASL MRI data.
+Repository: https://github.com/JSIERO/ClinicalASL
+
+Author: Jeroen Siero
+Institution: UMC Utrecht (University Medical Center Utrecht), The Netherlands
+Contact: j.c.w.siero@umcutrecht.nl
+
+Description:
+    This script runs the main pipeline for a cohort of exams listed in a manifest. Every exam is preprocessed as by
+    run_pipeline.py, the quantification of all exams with the same protocol is done in one QASL run per fit on a
+    pseudo-volume of their brain voxels (voxelwise inference 'vaby', or the native backend), and the results of every
+    exam are saved in its own output directory.
+
+    Manifest: JSON list of exams, e.g.
+    [
+        {"inputdir": "/data/exam1/DICOM", "outputdir": "/results/exam1", "workingdir": "/work/exam1"},
+        {"inputdir": "/data/exam2/DICOM", "outputdir": "/results/exam2", "workingdir": "/work/exam2"}
+    ]
+
+License: BSD 3-Clause License
+"""
+
+import argparse
+import logging
+import sys
+import os
+import json
+from clinical_asl_pipeline import main_pipeline
+from clinical_asl_pipeline.utils.load_parameters import load_parameters
+from clinical_asl_pipeline.utils.setup_logging import setup_logging
+from clinical_asl_pipeline.__version__ import __version__ as TOOL_VERSION
+from clinical_asl_pipeline.utils.banner import log_pipeline_banner
+from run_pipeline import format_config_for_display
+
+def run_cohort(manifest_path, batchdir, inference_method='vaby', config_path=None):
+    print(f"Running cohort pipeline for the exams in: {manifest_path}")
+
+    # Fallback default config if not supplied
+    if config_path is None:
+        config_path = os.path.join(os.path.dirname(__file__), 'clinical_asl_pipeline', 'config', 'config_default.json')
+
+    # Load processing parameters (default or from user-supplied config.json), voxelwise inference for the cohort batches
+    ANALYSIS_PARAMETERS = load_parameters(config_path=config_path)
+    ANALYSIS_PARAMETERS["inference_method"] = inference_method
+
+    with open(manifest_path) as f:
+        exams = json.load(f)
+
+    # Setup logging (saved to the batch dir)
+    setup_logging(batchdir)
+    log_pipeline_banner(TOOL_VERSION)
+    logging.info(f"ClinicalASL cohort pipeline started.")
+    logging.info(f"Manifest: {manifest_path} ({len(exams)} exams)")
+    logging.info(f"Batch Directory: {batchdir}")
+    logging.info(f"Config used: {config_path}")
+    logging.info(f"Inference method: {inference_method}")
+
+    # Format config for display and logging
+    formatted_config = format_config_for_display(ANALYSIS_PARAMETERS)
+    logging.info(f"Configuration parameters:\n{formatted_config}")
+
+    # Save config.json copy for every exam
+    for exam in exams:
+        os.makedirs(exam['outputdir'], exist_ok=True)
+        with open(os.path.join(exam['outputdir'], 'config_used.json'), 'w') as f:
+            json.dump(ANALYSIS_PARAMETERS, f, indent=4)
+
+    # Run main pipeline for the cohort
+    main_pipeline.mri_diamox_umcu_clinicalasl_cvr_cohort(exams, batchdir, ANALYSIS_PARAMETERS)
+
+    logging.info("ClinicalASL cohort pipeline finished successfully.")
+    print("Cohort pipeline finished successfully.")
+
+def main():
+    """Main entry point for the cohort pipeline."""
+    parser = argparse.ArgumentParser(
+        description="Run Clinical ASL CVR Pipeline for a cohort of exams, quantified in batches",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+    Examples:
+    python run_cohort.py /path/to/manifest.json /batchdir
+    python run_cohort.py /path/to/manifest.json /batchdir --config /path/to/config.json
+    """
+    )
+
+    parser.add_argument("manifest", type=str,
+                        help="Path to JSON manifest: list of exams with 'inputdir', 'outputdir' and 'workingdir'")
+    parser.add_argument("batchdir", type=str,
+                        help="Path to working directory for the cohort batches and the log file")
+    parser.add_argument("--inference-method", type=str,
+                        default='vaby',
+                        choices=["vaby"],
+                        help="Voxelwise inference method of the cohort batches (the spatial prior of 'ssvb' would couple exams)")
+    parser.add_argument("--config", type=str, default=None,
+                        help="Optional path to config.json with processing parameters")
+    parser.add_argument("--version", action="version", version=f"ClinicalASL {TOOL_VERSION}")
+
+    args = parser.parse_args()
+
+    try:
+        run_cohort(args.manifest, args.batchdir,
+                   inference_method=args.inference_method,
+                   config_path=args.config)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()